@@ -0,0 +1,228 @@
+"""
+Benchmarks the stages of a diversity report on synthetic NHS cohorts, recording wall time and peak memory.
+
+Run from the root of the repository, eg:
+
+    python benchmarks/run_benchmarks.py --sizes 10k 1M --output benchmarks/results/master.json
+    python benchmarks/run_benchmarks.py --sizes 10k 1M --compare benchmarks/results/master.json
+
+With --compare the run exits with status 1 when a stage got slower or used more memory than the
+baseline by more than the threshold.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diversity_analysis_tool.aggregates import DiversityCounts
+from diversity_analysis_tool.clean_ipums_script import rename_by_code
+from diversity_analysis_tool.diversity import (
+    AssessDiversity,
+    create_age_bands,
+    transform_nhs_ethnicity,
+    transform_nhs_race,
+    transform_nhs_sex,
+    transform_ses_order,
+)
+from diversity_analysis_tool.graph_construction import GraphUtility
+from diversity_analysis_tool.synthetic import (
+    COHORT_SIZES,
+    generate_ipums_cohort,
+    generate_nhs_cohort,
+)
+
+logger = logging.getLogger("diversity_analysis_tool.benchmarks")
+
+COLUMN_NAMES = ("age", "sex", "ethnicity", "race", "ses", "is_deceased")
+
+
+def measure(function, repeat):
+    """
+    Runs function repeat times untraced, keeping the fastest wall time, then once more with tracemalloc to
+    record the peak memory allocated while it runs.
+    Returns: a dictionary with 'seconds' and 'peak_memory_mb'
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(timings), "peak_memory_mb": peak_bytes / 2 ** 20}
+
+
+def benchmark_stages(row_count, output_directory_path):
+    """
+    Returns: a dictionary of stage name to a function running that stage on a cohort of row_count people
+    """
+    cohort_df = generate_nhs_cohort(row_count)
+    ipums_df = generate_ipums_cohort(row_count)
+    assess_diversity = AssessDiversity(
+        transform_nhs_ethnicity,
+        transform_nhs_race,
+        transform_nhs_sex,
+        transform_ses_order,
+    )
+    transformed_df = assess_diversity.transform(cohort_df, 5, *COLUMN_NAMES)
+
+    return {
+        "create_age_bands": lambda: create_age_bands(cohort_df, "age", 0, 90, 5),
+        "transform_nhs_sex": lambda: transform_nhs_sex(cohort_df, "sex"),
+        "transform_nhs_ethnicity": lambda: transform_nhs_ethnicity(
+            cohort_df, "ethnicity"
+        ),
+        "transform_nhs_race": lambda: transform_nhs_race(cohort_df, "race"),
+        "transform_ses_order": lambda: transform_ses_order(cohort_df, "ses"),
+        "rename_ipums_codes": lambda: rename_by_code(ipums_df.copy()),
+        "transform": lambda: assess_diversity.transform(cohort_df, 5, *COLUMN_NAMES),
+        "count_categories": lambda: DiversityCounts.from_frame(transformed_df),
+        "build_graph": lambda: GraphUtility(
+            transformed_df, output_directory_path
+        ).build_graph(),
+        "report": lambda: assess_diversity.create_diversity_analysis_report(
+            cohort_df, 5, *COLUMN_NAMES, output_directory_path
+        ),
+    }
+
+
+def run_benchmarks(size_names, repeat, stage_names=None):
+    results = []
+    with tempfile.TemporaryDirectory() as output_directory_path:
+        for size_name in size_names:
+            row_count = COHORT_SIZES[size_name]
+            stages = benchmark_stages(row_count, output_directory_path)
+            for stage_name, stage in stages.items():
+                if stage_names and stage_name not in stage_names:
+                    continue
+                measurement = measure(stage, repeat)
+                logger.info(
+                    f"{size_name:>4} {stage_name:<24} {measurement['seconds']:9.3f}s "
+                    f"{measurement['peak_memory_mb']:10.1f}MB"
+                )
+                results.append(
+                    {"size": size_name, "rows": row_count, "stage": stage_name, **measurement}
+                )
+    return {"environment": environment(), "results": results}
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor_count": os.cpu_count(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Logs the ratio of each stage against the baseline run.
+    Returns: a list of the (size, stage) pairs that are slower or use more memory than threshold times the
+    baseline
+    """
+    baseline_results = {
+        (result["size"], result["stage"]): result for result in baseline["results"]
+    }
+    regressions = []
+    for result in results["results"]:
+        key = (result["size"], result["stage"])
+        if key not in baseline_results:
+            continue
+        time_ratio = result["seconds"] / max(baseline_results[key]["seconds"], 1e-9)
+        memory_ratio = result["peak_memory_mb"] / max(
+            baseline_results[key]["peak_memory_mb"], 1e-9
+        )
+        regressed = time_ratio > threshold or memory_ratio > threshold
+        logger.info(
+            f"{key[0]:>4} {key[1]:<24} time x{time_ratio:5.2f} memory x{memory_ratio:5.2f}"
+            + ("  REGRESSION" if regressed else "")
+        )
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the diversity report")
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        choices=list(COHORT_SIZES),
+        default=["10k", "1M"],
+        help="Cohort sizes to benchmark.",
+    )
+    parser.add_argument(
+        "--stages", nargs="+", default=None, help="Only benchmark these stages."
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Timed runs per stage, the fastest is kept."
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="Path of a JSON file to store results in."
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="Path of a JSON file of earlier results to compare against.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="Ratio to the baseline above which a stage counts as a regression.",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    # only the benchmark results are logged, not the progress of each stage
+    logging.getLogger("diversity_analysis_tool").setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    results = run_benchmarks(args.sizes, args.repeat, args.stages)
+    if args.output:
+        output_directory_path = os.path.dirname(args.output)
+        if output_directory_path and not os.path.exists(output_directory_path):
+            os.makedirs(output_directory_path)
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            logger.error(f"{len(regressions)} regressions against {args.compare}")
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
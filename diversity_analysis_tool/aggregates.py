@@ -0,0 +1,572 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+COUNT_COLUMN_NAME = "count"
+
+
+class DiversityCounts:
+    """
+    Holds the number of people for every combination of categories of a set of (transformed) demographic
+    columns, including combinations with missing values. Single column counts, two column tables and
+    missingness are all sums over this table, and tables computed from separate chunks or files can be
+    merged, so the row-level data never has to be held in memory at once.
+
+    Each column is stored as integer codes into a list of levels (the category labels), with -1 standing
+    for a missing value, next to a 'count' column.
+    """
+
+    def __init__(self, levels, cube, categorical=None, ordered=None, ranks=None):
+        """
+        Args:
+            levels: dictionary of column name to a pandas Index of the labels of that column
+            cube: data frame with one integer code column per column in levels and a 'count' column
+            categorical (optional): dictionary of column name to whether the column was a categorical
+            ordered (optional): dictionary of column name to whether the categories are ordered
+            ranks (optional): dictionary of column name to a float array with the rank of each of its levels
+            (NaN when unknown), see rank_levels
+        """
+        self.levels = levels
+        self.cube = cube
+        self.categorical = categorical or {column_name: True for column_name in levels}
+        self.ordered = ordered or {column_name: False for column_name in levels}
+        self.ranks = ranks or {}
+
+    @classmethod
+    def from_frame(cls, df, column_names=None, count_column_name=None):
+        """
+        Counts the combinations of values of the given columns in a data frame in a single grouping pass.
+        Args:
+            df: demographic data frame, usually the output of AssessDiversity.transform
+            column_names (optional): the columns to count, defaults to all columns except count_column_name
+            count_column_name (optional): a column holding the number of people in each row. If none each
+            row is one person.
+        Returns: a DiversityCounts
+        """
+        if column_names is None:
+            column_names = [
+                column_name
+                for column_name in df.columns
+                if column_name != count_column_name
+            ]
+        column_names = list(column_names)
+
+        levels, codes, categorical, ordered = {}, {}, {}, {}
+        for column_name in column_names:
+            column = df[column_name]
+            if pd.api.types.is_categorical_dtype(column):
+                levels[column_name] = column.cat.categories
+                codes[column_name] = np.asarray(column.cat.codes, dtype="int64")
+                categorical[column_name] = True
+                ordered[column_name] = bool(column.cat.ordered)
+            else:
+                try:
+                    column_codes, uniques = pd.factorize(column, sort=True)
+                except TypeError:
+                    # mixed types (eg: True and 'True') cannot be sorted
+                    column_codes, uniques = pd.factorize(column)
+                levels[column_name] = pd.Index(uniques)
+                codes[column_name] = column_codes.astype("int64")
+                categorical[column_name] = False
+                ordered[column_name] = False
+
+        weights = None
+        if count_column_name is not None:
+            weights = np.asarray(df[count_column_name], dtype="int64")
+        return cls.from_codes(levels, codes, categorical, ordered, weights, len(df))
+
+    @classmethod
+    def from_codes(
+        cls, levels, codes, categorical=None, ordered=None, weights=None, row_count=None
+    ):
+        """
+        Counts the combinations of codes of columns which are already encoded, eg: the dictionary indices of
+        Arrow columns, without building a data frame of their labels.
+        Args:
+            levels: dictionary of column name to a pandas Index of the labels of that column
+            codes: dictionary of column name to an integer array of positions in its levels, -1 when missing
+            categorical, ordered (optional): see DiversityCounts
+            weights (optional): the number of people in each row. If none each row is one person.
+            row_count (optional): number of rows, only needed when there are no columns
+        Returns: a DiversityCounts
+        """
+        column_names = list(levels)
+        if row_count is None:
+            row_count = len(next(iter(codes.values()))) if codes else 0
+        codes_df = pd.DataFrame(
+            {
+                column_name: np.asarray(codes[column_name], dtype="int64")
+                for column_name in column_names
+            },
+            columns=column_names,
+            index=range(row_count),
+        )
+        codes_df[COUNT_COLUMN_NAME] = (
+            np.ones(row_count, dtype="int64") if weights is None else weights
+        )
+        cube = cls._sum_counts(codes_df, column_names)
+        return cls(levels, cube, categorical, ordered)
+
+    @classmethod
+    def combine(cls, counts_list):
+        """
+        Merges several DiversityCounts over the same columns, eg: one per chunk of a file
+        Args:
+            counts_list: an iterable of DiversityCounts
+        Returns: a DiversityCounts with the summed counts or None if counts_list is empty
+        """
+        combined = None
+        for counts in counts_list:
+            combined = counts if combined is None else combined.merge(counts)
+        return combined
+
+    @classmethod
+    def from_dict(cls, counts_dict):
+        """
+        Args:
+            counts_dict: a dictionary made by DiversityCounts.to_dict, eg: loaded from a JSON file
+        Returns: a DiversityCounts
+        """
+        column_names = counts_dict["column_names"]
+        cube = pd.DataFrame(
+            {
+                column_name: np.asarray(codes, dtype="int64")
+                for column_name, codes in counts_dict["cube"].items()
+            },
+            columns=column_names + [COUNT_COLUMN_NAME],
+        )
+        return cls(
+            {
+                column_name: pd.Index(counts_dict["levels"][column_name])
+                for column_name in column_names
+            },
+            cube,
+            counts_dict["categorical"],
+            counts_dict["ordered"],
+            {
+                column_name: np.asarray(
+                    [np.nan if rank is None else rank for rank in column_ranks],
+                    dtype="float64",
+                )
+                for column_name, column_ranks in counts_dict.get("ranks", {}).items()
+            },
+        )
+
+    def to_dict(self):
+        """
+        Returns: a dictionary of lists, numbers, strings and booleans holding the counts, which can be saved
+        as JSON and turned back into a DiversityCounts with DiversityCounts.from_dict
+        """
+        return {
+            "column_names": self.column_names,
+            "levels": {
+                # labels of nullable integer columns are numpy scalars
+                column_name: [
+                    level.item() if isinstance(level, np.generic) else level
+                    for level in levels
+                ]
+                for column_name, levels in self.levels.items()
+            },
+            "categorical": self.categorical,
+            "ordered": self.ordered,
+            "ranks": {
+                column_name: [
+                    None if np.isnan(rank) else float(rank) for rank in column_ranks
+                ]
+                for column_name, column_ranks in self.ranks.items()
+            },
+            "cube": {
+                column_name: self.cube[column_name].tolist()
+                for column_name in self.cube.columns
+            },
+        }
+
+    @staticmethod
+    def _sum_counts(codes_df, column_names):
+        if not column_names:
+            return pd.DataFrame(
+                {COUNT_COLUMN_NAME: [codes_df[COUNT_COLUMN_NAME].sum()]}
+            )
+        # grouping on the integer codes keeps missing values (-1) as their own group
+        return (
+            codes_df.groupby(column_names, sort=False)[COUNT_COLUMN_NAME]
+            .sum()
+            .reset_index()
+        )
+
+    @property
+    def column_names(self):
+        return list(self.levels.keys())
+
+    @property
+    def row_count(self):
+        return int(self.cube[COUNT_COLUMN_NAME].sum())
+
+    def to_frame(self):
+        """
+        Returns: a data frame with one categorical column of labels per column and a 'count' column, with
+        one row per combination of labels that has people in it. DiversityCounts.from_frame(df,
+        count_column_name='count') turns it back into a DiversityCounts.
+        """
+        df = pd.DataFrame(
+            {
+                column_name: pd.Categorical.from_codes(
+                    self.cube[column_name].to_numpy(),
+                    categories=self.levels[column_name],
+                    ordered=self.ordered[column_name],
+                )
+                for column_name in self.column_names
+            },
+            columns=self.column_names,
+            index=self.cube.index,
+        )
+        df[COUNT_COLUMN_NAME] = self.cube[COUNT_COLUMN_NAME].to_numpy()
+        return df[df[COUNT_COLUMN_NAME] > 0].reset_index(drop=True)
+
+    def merge(self, other):
+        """
+        Adds the counts of another DiversityCounts over the same columns. Labels only present in other are
+        placed by their rank when both counts rank the levels of a column, after the labels they follow in
+        other when both columns are ordered, and appended to the levels otherwise. Chunks missing some
+        levels of an ordered column therefore merge into the same order as the whole data.
+        Args:
+            other: a DiversityCounts
+        Returns: a new DiversityCounts
+        """
+        if set(self.column_names) != set(other.column_names):
+            raise ValueError(
+                f"Cannot merge counts over {self.column_names} with counts over {other.column_names}"
+            )
+
+        levels, ranks = {}, {}
+        own_cube = self.cube.copy()
+        other_cube = other.cube.copy()
+        for column_name in self.column_names:
+            own_levels = self.levels[column_name]
+            other_levels = other.levels[column_name]
+            if column_name in self.ranks and column_name in other.ranks:
+                levels[column_name], ranks[column_name] = _merge_ranked_levels(
+                    own_levels,
+                    self.ranks[column_name],
+                    other_levels,
+                    other.ranks[column_name],
+                )
+            elif self.ordered[column_name] and other.ordered[column_name]:
+                levels[column_name] = _merge_ordered_levels(own_levels, other_levels)
+            else:
+                levels[column_name] = own_levels.append(
+                    other_levels[~other_levels.isin(own_levels)]
+                )
+            for cube, cube_levels in [
+                (own_cube, own_levels),
+                (other_cube, other_levels),
+            ]:
+                # the final entry maps missing values (-1) back to -1
+                code_lookup = np.append(
+                    levels[column_name].get_indexer(cube_levels), -1
+                )
+                cube[column_name] = code_lookup[cube[column_name].to_numpy()]
+
+        cube = self._sum_counts(
+            pd.concat([own_cube, other_cube[own_cube.columns]], ignore_index=True),
+            self.column_names,
+        )
+        categorical = {
+            column_name: self.categorical[column_name] and other.categorical[column_name]
+            for column_name in self.column_names
+        }
+        ordered = {
+            column_name: self.ordered[column_name] and other.ordered[column_name]
+            for column_name in self.column_names
+        }
+        return DiversityCounts(levels, cube, categorical, ordered, ranks)
+
+    def rank_levels(self, column_name, level_ranks):
+        """
+        Ranks the levels of a column, eg: ses levels by their ses_level. The ranks are kept with the counts, so
+        that levels only present in some chunks of the data are merged in rank order.
+        Args:
+            column_name: the column to rank the levels of
+            level_ranks: dictionary of label to rank, labels that are not in it have no rank
+        Returns: a new DiversityCounts
+        """
+        ranks = dict(self.ranks)
+        ranks[column_name] = np.asarray(
+            [level_ranks.get(level, np.nan) for level in self.levels[column_name]],
+            dtype="float64",
+        )
+        return DiversityCounts(
+            self.levels, self.cube, self.categorical, self.ordered, ranks
+        )
+
+    def rename_levels(self, column_name, rename_dict):
+        """
+        Renames labels of one column, eg: True to 'Yes'. Labels that end up identical are counted together.
+        Args:
+            column_name: the column to rename labels of
+            rename_dict: dictionary of old label to new label
+        Returns: a new DiversityCounts
+        """
+        old_levels = self.levels[column_name]
+        renamed_levels = pd.Index(
+            [rename_dict.get(level, level) for level in old_levels]
+        )
+        levels = dict(self.levels)
+        levels[column_name] = renamed_levels.unique()
+        code_lookup = np.append(levels[column_name].get_indexer(renamed_levels), -1)
+        cube = self.cube.copy()
+        cube[column_name] = code_lookup[cube[column_name].to_numpy()]
+        cube = self._sum_counts(cube, self.column_names)
+        ranks = {
+            ranked_column_name: column_ranks
+            for ranked_column_name, column_ranks in self.ranks.items()
+            if ranked_column_name != column_name
+        }
+        return DiversityCounts(levels, cube, self.categorical, self.ordered, ranks)
+
+    def set_missing(self, combinations, column_names):
+        """
+        Replaces the labels of some columns by missing values in some combinations, eg: to suppress small
+        groups of people. Combinations that end up identical are counted together.
+        Args:
+            combinations: boolean array with an entry per row of the cube, True for the combinations to change
+            column_names: the columns to set to missing
+        Returns: a new DiversityCounts
+        """
+        cube = self.cube.copy()
+        for column_name in column_names:
+            cube[column_name] = np.where(combinations, -1, cube[column_name].to_numpy())
+        cube = self._sum_counts(cube, self.column_names)
+        return DiversityCounts(
+            self.levels, cube, self.categorical, self.ordered, self.ranks
+        )
+
+    def column_counts(self, column_name, dropna=True):
+        """
+        Number of people per label of a single column
+        Args:
+            column_name: the column to count
+            dropna (optional): whether to leave out the number of missing values, defaults to True.
+        Returns: a series indexed by the labels of the column, in the order of its levels, with missing
+        values last if dropna is False
+        """
+        levels = self.levels[column_name]
+        codes = self.cube[column_name].to_numpy()
+        # shift by one so that missing values (-1) are counted in the first bin
+        counts = np.bincount(
+            codes + 1,
+            weights=self.cube[COUNT_COLUMN_NAME].to_numpy(),
+            minlength=len(levels) + 1,
+        ).astype("int64")
+        result = pd.Series(counts[1:], index=levels, name=column_name)
+        if not dropna:
+            result = pd.concat(
+                [result, pd.Series([counts[0]], index=[np.nan], name=column_name)]
+            )
+        return result
+
+    def pair_counts(self, major_column_name, minor_column_name, minor_missing_label=None):
+        """
+        Number of people per combination of labels of two columns, like pd.crosstab. People with a
+        missing major label are left out.
+        Args:
+            major_column_name: the column whose labels make the rows of the table
+            minor_column_name: the column whose labels make the columns of the table
+            minor_missing_label (optional): label of a final column counting people with a missing minor
+            label. If none those people are left out.
+        Returns: a data frame of counts with only the rows and columns that have people in them
+        """
+        major_levels = self.levels[major_column_name]
+        minor_levels = self.levels[minor_column_name]
+        major_codes = self.cube[major_column_name].to_numpy()
+        minor_codes = self.cube[minor_column_name].to_numpy()
+        cube_counts = self.cube[COUNT_COLUMN_NAME].to_numpy()
+        if minor_missing_label is None or major_column_name == minor_column_name:
+            minor_labels = list(minor_levels)
+            keep = (major_codes >= 0) & (minor_codes >= 0)
+        else:
+            minor_labels = list(minor_levels) + [minor_missing_label]
+            minor_codes = np.where(minor_codes >= 0, minor_codes, len(minor_levels))
+            keep = major_codes >= 0
+
+        table = np.zeros((len(major_levels), len(minor_labels)), dtype="int64")
+        np.add.at(table, (major_codes[keep], minor_codes[keep]), cube_counts[keep])
+
+        table_df = pd.DataFrame(
+            table,
+            index=pd.Index(major_levels, name=major_column_name),
+            columns=pd.Index(minor_labels, name=minor_column_name),
+        )
+        return table_df.loc[table_df.sum(axis=1) > 0, table_df.sum(axis=0) > 0]
+
+    def missing_counts(self, column_names=None):
+        """
+        Number of missing values per column
+        Args:
+            column_names (optional): the columns to count missing values of, defaults to all columns
+        Returns: a series indexed by column name
+        """
+        if column_names is None:
+            column_names = self.column_names
+        cube_counts = self.cube[COUNT_COLUMN_NAME].to_numpy()
+        return pd.Series(
+            {
+                column_name: int(
+                    cube_counts[self.cube[column_name].to_numpy() < 0].sum()
+                )
+                for column_name in column_names
+            },
+            dtype="int64",
+        )
+
+    def category_table(self, missing_label=None):
+        """
+        Number of people per label of every column, in one long table
+        Args:
+            missing_label (optional): label of a row per column counting its missing values. If none missing
+            values are left out.
+        Returns: a data frame with the columns 'column', 'category' and 'count', with labels as strings so
+        that labels of different columns fit in one column
+        """
+        tables = []
+        for column_name in self.column_names:
+            counts = self.column_counts(column_name, dropna=missing_label is None)
+            labels = self._labels(column_name, missing_label)
+            keep = counts.to_numpy() > 0
+            tables.append(
+                pd.DataFrame(
+                    {
+                        "column": column_name,
+                        "category": labels[keep],
+                        COUNT_COLUMN_NAME: counts.to_numpy()[keep],
+                    }
+                )
+            )
+        return _concat_tables(tables, ["column", "category", COUNT_COLUMN_NAME])
+
+    def pair_table(self, missing_label=None):
+        """
+        Number of people per combination of labels of every pair of columns, in one long table
+        Args:
+            missing_label (optional): label standing in for missing values of either column of a pair. If
+            none combinations with a missing value are left out.
+        Returns: a data frame with the columns 'column_1', 'category_1', 'column_2', 'category_2' and 'count'
+        """
+        table_column_names = [
+            "column_1",
+            "category_1",
+            "column_2",
+            "category_2",
+            COUNT_COLUMN_NAME,
+        ]
+        cube_counts = self.cube[COUNT_COLUMN_NAME].to_numpy()
+        tables = []
+        for first_index, first_column_name in enumerate(self.column_names):
+            for second_column_name in self.column_names[first_index + 1 :]:
+                first_labels = self._labels(first_column_name, missing_label)
+                second_labels = self._labels(second_column_name, missing_label)
+                first_codes = self._missing_last(first_column_name)
+                second_codes = self._missing_last(second_column_name)
+                keep = (first_codes < len(first_labels)) & (
+                    second_codes < len(second_labels)
+                )
+                table = np.zeros((len(first_labels), len(second_labels)), dtype="int64")
+                np.add.at(
+                    table, (first_codes[keep], second_codes[keep]), cube_counts[keep]
+                )
+                first_positions, second_positions = np.nonzero(table)
+                tables.append(
+                    pd.DataFrame(
+                        {
+                            "column_1": first_column_name,
+                            "category_1": first_labels[first_positions],
+                            "column_2": second_column_name,
+                            "category_2": second_labels[second_positions],
+                            COUNT_COLUMN_NAME: table[first_positions, second_positions],
+                        }
+                    )
+                )
+        return _concat_tables(tables, table_column_names)
+
+    def missing_table(self):
+        """
+        Returns: a data frame with one row per column and the columns 'column', 'missing', 'total' and
+        'missing_rate'
+        """
+        missing_counts = self.missing_counts()
+        row_count = self.row_count
+        return pd.DataFrame(
+            {
+                "column": missing_counts.index,
+                "missing": missing_counts.to_numpy(),
+                "total": row_count,
+                "missing_rate": missing_counts.to_numpy() / max(row_count, 1),
+            }
+        )
+
+    def _missing_last(self, column_name):
+        """codes of a column with missing values (-1) moved after the last label, where a missing label goes"""
+        codes = self.cube[column_name].to_numpy()
+        return np.where(codes >= 0, codes, len(self.levels[column_name]))
+
+    def _labels(self, column_name, missing_label):
+        labels = self.levels[column_name].astype(str)
+        if missing_label is not None:
+            labels = labels.append(pd.Index([missing_label]))
+        return np.asarray(labels, dtype=object)
+
+
+def _merge_ranked_levels(own_levels, own_ranks, other_levels, other_ranks):
+    """
+    the levels of two counts sorted by rank, then by label like transform_ses_order, with unranked levels
+    last in the order they come in
+    """
+    new = ~other_levels.isin(own_levels)
+    levels = own_levels.append(other_levels[new])
+    ranks = np.concatenate([own_ranks, np.asarray(other_ranks)[new]])
+    # levels a side does not rank take the rank of the other side
+    other_positions = other_levels.get_indexer(own_levels)
+    known = other_positions >= 0
+    ranks[: len(own_levels)][known] = np.where(
+        np.isnan(own_ranks[known]),
+        np.asarray(other_ranks)[other_positions[known]],
+        own_ranks[known],
+    )
+    ranked = ~np.isnan(ranks)
+    ranked_positions = np.flatnonzero(ranked)
+    order = np.concatenate(
+        [
+            ranked_positions[
+                np.lexsort((levels[ranked].astype(str).to_numpy(), ranks[ranked]))
+            ],
+            np.flatnonzero(~ranked),
+        ]
+    )
+    return levels[order], ranks[order]
+
+
+def _merge_ordered_levels(own_levels, other_levels):
+    """
+    the levels of two ordered counts, with each level only in other placed right after the level it follows
+    in other, or first when it comes first in other
+    """
+    levels = list(own_levels)
+    positions = {level: position for position, level in enumerate(levels)}
+    previous = None
+    for level in other_levels:
+        if level not in positions:
+            insert_at = 0 if previous is None else levels.index(previous) + 1
+            levels.insert(insert_at, level)
+            positions[level] = insert_at
+        previous = level
+    return pd.Index(levels, dtype=own_levels.dtype if len(own_levels) else None)
+
+
+def _concat_tables(tables, column_names):
+    if not tables:
+        return pd.DataFrame(columns=column_names)
+    return pd.concat(tables, ignore_index=True)
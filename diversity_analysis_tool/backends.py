@@ -0,0 +1,271 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class ArrowBackend:
+    """
+    Lets AssessDiversity transform and count a pyarrow Table or RecordBatch without converting it to pandas.
+    Coded columns are dictionary encoded by Arrow compute kernels, so each distinct value is looked up once
+    and the rows are mapped with array lookups on the dictionary indices, as CodeLookup does for pandas.
+    Numeric columns without missing values and the indices of dictionary columns are read as numpy arrays
+    without copying, and transformed columns are dictionary arrays over the same indices.
+
+    Transformed tables have one dictionary column per field, whose dictionary is in category order, which
+    is what pd.Categorical columns are to the pandas path. Another table library is supported by subclassing
+    this class with to_arrow and from_arrow converting to and from Arrow, see PolarsBackend.
+    """
+
+    name = "arrow"
+
+    def accepts(self, data):
+        """whether data is a table of this backend, checked without importing its library"""
+        return type(data).__module__.split(".")[0] == "pyarrow" and hasattr(
+            data, "schema"
+        )
+
+    def to_arrow(self, data):
+        """Returns: data as a pyarrow Table, without copying the columns"""
+        import pyarrow as pa
+
+        if isinstance(data, pa.RecordBatch):
+            return pa.Table.from_batches([data])
+        return data
+
+    def from_arrow(self, table):
+        """Returns: a pyarrow Table as a table of this backend"""
+        return table
+
+    def column_names(self, data):
+        """Returns: the column names of a table of this backend"""
+        return data.schema.names
+
+    def float_values(self, table, column_name):
+        """
+        Returns: a float64 numpy array of the values of a numeric column with missing values as NaN, which is
+        a view of the column when it has a single chunk of float64 values
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        column = table.column(column_name)
+        if not pa.types.is_floating(column.type):
+            column = pc.cast(column, pa.float64())
+        if column.num_chunks == 1:
+            return column.chunk(0).to_numpy(zero_copy_only=False)
+        return column.to_numpy()
+
+    def category_codes(self, table, column_name, integer_codes=False):
+        """
+        Dictionary encodes a column with Arrow, unless it already is
+        Args:
+            table: a pyarrow Table
+            column_name: name of the column
+            integer_codes (optional): whether to match codes as integers (eg: 1.0 or '1' as 1)
+        Returns: a tuple of the int64 numpy array of the position of the value of each row in the distinct
+        values (-1 when missing), the pandas Index of the distinct values, and whether their order is
+        meaningful
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        column = table.column(column_name)
+        ordered = False
+        if pa.types.is_dictionary(column.type):
+            ordered = column.type.ordered
+        else:
+            if integer_codes and (
+                pa.types.is_floating(column.type)
+                or pa.types.is_string(column.type)
+                or pa.types.is_large_string(column.type)
+            ):
+                column = pc.cast(column, pa.int64())
+            column = pc.dictionary_encode(column)
+        # chunks can have dictionaries of their own, eg: the row groups of a Parquet file
+        column = pa.Table.from_arrays([column], ["column"]).unify_dictionaries()
+        chunks = column.column(0).chunks
+        if not chunks:
+            return np.zeros(0, dtype="int64"), pd.Index([]), ordered
+        dictionary = chunks[0].dictionary
+        codes = np.concatenate(
+            [
+                np.asarray(
+                    pc.fill_null(pc.cast(chunk.indices, pa.int64()), -1).to_numpy(
+                        zero_copy_only=False
+                    ),
+                    dtype="int64",
+                )
+                for chunk in chunks
+            ]
+        )
+        uniques = pd.Index(dictionary.to_pandas())
+        if dictionary.null_count:
+            # a null in the dictionary is a missing value like a null index
+            null_positions = np.flatnonzero(
+                dictionary.is_null().to_numpy(zero_copy_only=False)
+            )
+            codes[np.isin(codes, null_positions)] = -1
+        return codes, uniques, ordered
+
+    def is_categorical(self, table, column_name):
+        import pyarrow as pa
+
+        return pa.types.is_dictionary(table.schema.field(column_name).type)
+
+    def with_categorical(self, table, column_name, codes, labels, ordered=False):
+        """
+        Args:
+            table: a pyarrow Table
+            column_name: name of the column to add or replace
+            codes: integer numpy array of the position of the label of each row, -1 when missing
+            labels: the labels, in category order
+            ordered (optional): whether the order of the labels is meaningful
+        Returns: table with the column replaced by a dictionary column of labels
+        """
+        import pyarrow as pa
+
+        indices = pa.array(np.asarray(codes, dtype="int32"), mask=np.asarray(codes) < 0)
+        column = pa.DictionaryArray.from_arrays(
+            indices, pa.array(list(labels)), ordered=ordered
+        )
+        if column_name in table.schema.names:
+            return table.set_column(
+                table.schema.get_field_index(column_name), column_name, column
+            )
+        return table.append_column(column_name, column)
+
+    def with_pandas_column(self, table, column_name, values):
+        """
+        Returns: table with the column replaced by a pandas series, eg: the output of a pandas transform
+        routine. Categoricals become dictionary columns.
+        """
+        import pyarrow as pa
+
+        return table.set_column(
+            table.schema.get_field_index(column_name),
+            column_name,
+            pa.array(values, from_pandas=True),
+        )
+
+    def select(self, table, column_names):
+        return table.select(list(column_names))
+
+    def rename(self, table, rename_dict):
+        return table.rename_columns(
+            [
+                rename_dict.get(column_name, column_name)
+                for column_name in table.schema.names
+            ]
+        )
+
+    def sort(self, table, column_name):
+        """
+        Sorts the rows by a column, dictionary columns in the order of their dictionary like categoricals,
+        with missing values last
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        column = table.select([column_name]).unify_dictionaries().column(0)
+        if pa.types.is_dictionary(column.type):
+            column = pa.chunked_array(
+                [chunk.indices for chunk in column.chunks], type=column.type.index_type
+            )
+        return table.take(pc.sort_indices(column, null_placement="at_end"))
+
+    def to_pandas(self, table, column_names=None):
+        """
+        Converts an Arrow table to pandas, with text columns dictionary encoded first so they become
+        categoricals rather than one Python string per row
+        Args:
+            table: a pyarrow Table
+            column_names (optional): the columns to convert, defaults to every column
+        Returns: a data frame
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        if column_names is not None:
+            table = table.select(list(column_names))
+        for position, field in enumerate(table.schema):
+            if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+                table = table.set_column(
+                    position, field.name, pc.dictionary_encode(table.column(position))
+                )
+        return table.to_pandas()
+
+
+class PolarsBackend(ArrowBackend):
+    """
+    Lets AssessDiversity transform and count a polars DataFrame. Polars keeps its columns in Arrow memory, so
+    frames are handed to ArrowBackend and back without copying numeric columns, and transformed columns
+    become polars Categoricals.
+    """
+
+    name = "polars"
+
+    def accepts(self, data):
+        return type(data).__module__.split(".")[0] == "polars" and hasattr(
+            data, "to_arrow"
+        )
+
+    def column_names(self, data):
+        return list(data.columns)
+
+    def to_arrow(self, data):
+        return data.to_arrow()
+
+    def from_arrow(self, table):
+        import pyarrow as pa
+        import polars as pl
+
+        table = table.unify_dictionaries()
+        frame = pl.from_arrow(table)
+        # polars Categoricals are in the order of a global string cache, Enums keep the order of the labels
+        return frame.with_columns(
+            [
+                pl.col(field.name).cast(
+                    pl.Enum(table.column(field.name).chunk(0).dictionary.to_pylist())
+                )
+                for field in table.schema
+                if pa.types.is_dictionary(field.type)
+                and table.column(field.name).num_chunks
+            ]
+        )
+
+
+# Backends of the tables AssessDiversity accepts besides pandas data frames, in the order they are tried
+BACKENDS = [ArrowBackend(), PolarsBackend()]
+
+
+def backend_for(data):
+    """
+    Args:
+        data: a table of demographic data
+    Returns: the backend of data from BACKENDS, or None for pandas data frames and anything else
+    """
+    for backend in BACKENDS:
+        if backend.accepts(data):
+            return backend
+    return None
+
+
+def register_backend(backend):
+    """
+    Adds a backend for another table library, tried before the built in ones
+    Args:
+        backend: an ArrowBackend subclass instance, see PolarsBackend
+    """
+    BACKENDS.insert(0, backend)
+
+
+def to_pandas(data):
+    """Returns: a table of any backend as a pandas data frame, pandas data frames are returned as they are"""
+    backend = backend_for(data)
+    if backend is None:
+        return data
+    return backend.to_pandas(backend.to_arrow(data))
@@ -0,0 +1,239 @@
+import os
+import glob
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from diversity_analysis_tool.aggregates import DiversityCounts
+from diversity_analysis_tool.diversity import build_graphs, write_aggregate_report
+from diversity_analysis_tool.loading import (
+    ARROW_EXTENSIONS,
+    PARQUET_EXTENSIONS,
+    REPORT_FILE_EXTENSIONS,
+    read_demographic_data,
+    write_table,
+)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+ALL_SITES_DIRECTORY_NAME = "all_sites"
+INPUT_FILE_EXTENSIONS = (".csv",) + PARQUET_EXTENSIONS + ARROW_EXTENSIONS
+
+
+def find_input_files(input_path):
+    """
+    Lists the extracts to assess in batch mode
+    Args:
+        input_path: a directory, a glob pattern (eg: 'extracts/site_*.csv') or the path to a single file.
+        In a directory, every csv, Parquet and Arrow IPC/Feather file is picked up.
+    Returns: a sorted list of file paths
+    """
+    if os.path.isdir(input_path):
+        return sorted(
+            path
+            for path in glob.glob(os.path.join(input_path, "*"))
+            if os.path.splitext(path)[1].lower() in INPUT_FILE_EXTENSIONS
+        )
+    if os.path.isfile(input_path):
+        return [input_path]
+    return sorted(path for path in glob.glob(input_path) if os.path.isfile(path))
+
+
+def site_name(input_file_path):
+    """the name of the directory that the report of a site extract is written to, eg: 'site_a' for 'site_a.csv'"""
+    return os.path.splitext(os.path.basename(input_file_path))[0]
+
+
+def assess_site(
+    assess_diversity,
+    input_file_path,
+    years_per_band,
+    age_column_name,
+    sex_column_name,
+    ethnicity_column_name,
+    race_column_name,
+    ses_column_name,
+    is_deceased_column_name,
+    output_directory_path,
+    chunksize=None,
+    report_format="csv",
+    render_graphs=True,
+    report_type="rows",
+    sort_rows=True,
+):
+    """
+    Writes the diversity report of a single extract. This runs in a worker process in batch mode.
+    Args:
+        assess_diversity: the AssessDiversity to transform the data with
+        input_file_path: path to the csv, Parquet or Arrow IPC/Feather file of the extract
+        chunksize (optional): read the file this many rows at a time
+        report_format (optional): format of the report of transformed rows, see create_diversity_analysis_report
+        render_graphs (optional): whether to draw the graphs, defaults to True
+        report_type (optional): 'rows' or 'aggregate', see create_diversity_analysis_report
+        sort_rows (optional): whether to sort the rows of a 'rows' report, defaults to True
+        other arguments: the same as AssessDiversity.create_diversity_analysis_report
+    Returns: the DiversityCounts of the extract, before disclosure control so that the counts of every site
+    can be protected once they are merged
+    """
+    report_arguments = (
+        years_per_band,
+        age_column_name,
+        sex_column_name,
+        ethnicity_column_name,
+        race_column_name,
+        ses_column_name,
+        is_deceased_column_name,
+        output_directory_path,
+    )
+    column_names = {
+        "age": age_column_name,
+        "sex": sex_column_name,
+        "ethnicity": ethnicity_column_name,
+        "race": race_column_name,
+        "ses": ses_column_name,
+        "is_deceased": is_deceased_column_name,
+    }
+    if chunksize:
+        chunks = read_demographic_data(input_file_path, column_names, chunksize)
+        counts = assess_diversity.create_diversity_analysis_report_from_chunks(
+            chunks,
+            *report_arguments,
+            report_format=report_format,
+            render_graphs=render_graphs,
+            report_type=report_type,
+            sort_rows=sort_rows,
+            protect_counts=False,
+        )
+    else:
+        counts = assess_diversity.create_diversity_analysis_report(
+            read_demographic_data(input_file_path, column_names),
+            *report_arguments,
+            report_format=report_format,
+            render_graphs=render_graphs,
+            report_type=report_type,
+            sort_rows=sort_rows,
+            protect_counts=False,
+        )
+    logger.info(f"Assessed {input_file_path}")
+    return counts
+
+
+def create_batch_report(
+    assess_diversity,
+    input_file_paths,
+    years_per_band,
+    age_column_name,
+    sex_column_name,
+    ethnicity_column_name,
+    race_column_name,
+    ses_column_name,
+    is_deceased_column_name,
+    output_directory_path,
+    workers=None,
+    chunksize=None,
+    report_format="csv",
+    render_graphs=True,
+    report_type="rows",
+    sort_rows=True,
+):
+    """
+    Assesses several extracts (eg: one per hospital site) in a pool of worker processes. Each extract gets
+    its own report in a sub directory named after the file, and an all sites report is drawn from the
+    per site counts merged together, so the rows of the extracts are only read once. With disclosure control
+    the merged counts are protected as a whole, rather than adding up counts each site protected its own way.
+    Args:
+        assess_diversity: the AssessDiversity to transform the data with
+        input_file_paths: paths to the files of the extracts, see find_input_files
+        workers (optional): number of worker processes, defaults to the number of CPUs
+        chunksize (optional): read each file this many rows at a time
+        report_format (optional): format of the reports of transformed rows and of the all sites count
+        table, see create_diversity_analysis_report
+        render_graphs (optional): whether to draw the graphs of each site and of all sites, defaults to True
+        report_type (optional): 'rows' or 'aggregate', see create_diversity_analysis_report. The all sites
+        report of an 'aggregate' batch also gets the aggregate tables of the merged counts.
+        sort_rows (optional): whether to sort the rows of 'rows' reports, defaults to True
+        other arguments: the same as AssessDiversity.create_diversity_analysis_report
+    Returns: a dictionary of site name to DiversityCounts, including the merged counts under 'all_sites',
+    which are protected with disclosure control
+    """
+    site_names = [site_name(input_file_path) for input_file_path in input_file_paths]
+    duplicated_site_names = sorted(
+        {name for name in site_names if site_names.count(name) > 1}
+    )
+    if duplicated_site_names:
+        raise ValueError(
+            f"Extracts must have different file names, found {duplicated_site_names} more than once"
+        )
+    if ALL_SITES_DIRECTORY_NAME in site_names:
+        raise ValueError(f"'{ALL_SITES_DIRECTORY_NAME}' cannot be used as a site name")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            name: executor.submit(
+                assess_site,
+                assess_diversity,
+                input_file_path,
+                years_per_band,
+                age_column_name,
+                sex_column_name,
+                ethnicity_column_name,
+                race_column_name,
+                ses_column_name,
+                is_deceased_column_name,
+                os.path.join(output_directory_path, name),
+                chunksize,
+                report_format,
+                render_graphs,
+                report_type,
+                sort_rows,
+            )
+            for name, input_file_path in zip(site_names, input_file_paths)
+        }
+        site_counts = {name: future.result() for name, future in futures.items()}
+
+    # the sites return their counts before disclosure control, as sites coarsened in different ways would
+    # add up to overlapping categories
+    all_sites_counts = DiversityCounts.combine(
+        counts for counts in site_counts.values() if counts is not None
+    )
+    if all_sites_counts is None:
+        logger.warning("No data to assess")
+        return site_counts
+
+    all_sites_directory_path = os.path.join(
+        output_directory_path, ALL_SITES_DIRECTORY_NAME
+    )
+    if not os.path.exists(all_sites_directory_path):
+        os.makedirs(all_sites_directory_path)
+    if assess_diversity.disclosure_control is not None:
+        # the same protection as the site reports were written with, which does not depend on the rows
+        site_counts = {
+            name: None
+            if counts is None
+            else assess_diversity.disclosure_control.protect(
+                counts, ses_column_name
+            ).counts
+            for name, counts in site_counts.items()
+        }
+        all_sites_counts = assess_diversity.apply_disclosure_control(
+            all_sites_counts, ses_column_name, all_sites_directory_path, report_format
+        ).counts
+    write_table(
+        all_sites_counts.to_frame(),
+        os.path.join(
+            all_sites_directory_path,
+            "diversity_counts" + REPORT_FILE_EXTENSIONS[report_format],
+        ),
+        sep="|",
+    )
+    if report_type == "aggregate":
+        write_aggregate_report(all_sites_counts, all_sites_directory_path, report_format)
+    if render_graphs:
+        build_graphs(
+            all_sites_counts,
+            all_sites_directory_path,
+            profiler=assess_diversity.profiler,
+        )
+
+    site_counts[ALL_SITES_DIRECTORY_NAME] = all_sites_counts
+    return site_counts
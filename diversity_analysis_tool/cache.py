@@ -0,0 +1,143 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import pandas as pd
+
+from diversity_analysis_tool.aggregates import DiversityCounts
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Changing how reports are made changes this, so results cached by older versions are never reused
+CACHE_VERSION = 1
+DEFAULT_CACHE_SIZE_BYTES = 2 ** 30
+COUNTS_FILE_NAME = "diversity_counts.json"
+
+
+class ReportCache:
+    """
+    Stores the tables and graphs of reports in a directory, keyed on a hash of the input data and of every
+    parameter the report depends on, so that a report of the same data with the same parameters is copied
+    from the cache instead of being made again.
+
+    Each entry is a sub directory named after its key. The least recently used entries are removed once
+    the entries take up more than max_bytes.
+    """
+
+    def __init__(self, cache_directory_path, max_bytes=DEFAULT_CACHE_SIZE_BYTES):
+        """
+        Args:
+            cache_directory_path: directory to keep the cached reports in, created if it does not exist
+            max_bytes (optional): size the cached reports are kept under, defaults to 1GiB
+        """
+        self.cache_directory_path = cache_directory_path
+        self.max_bytes = max_bytes
+
+    def key(self, df, parameters):
+        """
+        Args:
+            df: the input data frame, only the columns the report uses should be given
+            parameters: dictionary of everything else the report depends on, it must be JSON serialisable
+        Returns: a hex digest identifying the report
+        """
+        key_hash = hashlib.sha256()
+        key_hash.update(
+            json.dumps(
+                {"version": CACHE_VERSION, "parameters": parameters}, sort_keys=True
+            ).encode("utf-8")
+        )
+        for column_name in df.columns:
+            key_hash.update(f"{column_name}:{df[column_name].dtype}".encode("utf-8"))
+            # hashes the values row by row, so categoricals hash the same as their labels
+            key_hash.update(
+                pd.util.hash_pandas_object(df[column_name], index=False).to_numpy()
+            )
+        return key_hash.hexdigest()
+
+    def get(self, key, output_directory_path):
+        """
+        Copies the files of a cached report to output_directory_path
+        Returns: the DiversityCounts of the report, or None if it is not cached
+        """
+        entry_path = self._entry_path(key)
+        counts_file_path = os.path.join(entry_path, COUNTS_FILE_NAME)
+        if not os.path.exists(counts_file_path):
+            return None
+        copy_report_files(entry_path, output_directory_path)
+        with open(counts_file_path) as counts_file:
+            counts = DiversityCounts.from_dict(json.load(counts_file))
+        # the modification time of an entry is when it was last used
+        os.utime(entry_path)
+        logger.info(f"Reusing cached report {key}")
+        return counts
+
+    def put(self, key, report_directory_path, counts):
+        """
+        Moves the files of a report into the cache, then evicts the least recently used entries if the
+        cache grew over max_bytes
+        Args:
+            key: the key of the report, see ReportCache.key
+            report_directory_path: a directory holding only the files of the report, it is moved into the
+            cache so it should be on the same file system, eg: made with ReportCache.staging_directory
+            counts: the DiversityCounts of the report
+        """
+        counts_file_path = os.path.join(report_directory_path, COUNTS_FILE_NAME)
+        with open(counts_file_path, "w") as counts_file:
+            json.dump(counts.to_dict(), counts_file)
+        try:
+            os.replace(report_directory_path, self._entry_path(key))
+        except OSError:
+            # the same report was cached by another process in the meantime
+            shutil.rmtree(report_directory_path, ignore_errors=True)
+        self.evict()
+
+    def staging_directory(self):
+        """Returns: the path of a new empty directory in the cache to make a report in before calling put"""
+        if not os.path.exists(self.cache_directory_path):
+            os.makedirs(self.cache_directory_path)
+        return tempfile.mkdtemp(prefix=".staging-", dir=self.cache_directory_path)
+
+    def evict(self):
+        """removes the least recently used entries until the cache is no larger than max_bytes"""
+        entries = []
+        for entry_name in os.listdir(self.cache_directory_path):
+            entry_path = os.path.join(self.cache_directory_path, entry_name)
+            if entry_name.startswith(".") or not os.path.isdir(entry_path):
+                continue
+            entries.append(
+                (os.path.getmtime(entry_path), _directory_size(entry_path), entry_path)
+            )
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_bytes -= size
+            logger.debug(f"Evicted {entry_path} from the report cache")
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_directory_path, key)
+
+
+def _directory_size(directory_path):
+    return sum(
+        os.path.getsize(os.path.join(directory_path, file_name))
+        for file_name in os.listdir(directory_path)
+    )
+
+
+def copy_report_files(report_directory_path, output_directory_path):
+    """copies the files of a report, leaving out the saved counts, to output_directory_path"""
+    if not os.path.exists(output_directory_path):
+        os.makedirs(output_directory_path)
+    for file_name in os.listdir(report_directory_path):
+        if file_name != COUNTS_FILE_NAME:
+            # copied rather than hard linked, as reports written later would overwrite the cached file
+            shutil.copyfile(
+                os.path.join(report_directory_path, file_name),
+                os.path.join(output_directory_path, file_name),
+            )
@@ -1,57 +1,88 @@
-import pandas as pd
-import numpy as np
+import logging
+
+from diversity_analysis_tool.loading import (
+    ChunkedTableWriter,
+    read_table,
+    write_table,
+)
+from diversity_analysis_tool.schemes import BUILT_IN_SCHEMES, integer_codes
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# The field of the ipums coding scheme each coded IPUMS column is mapped with
+IPUMS_SCHEME_FIELDS = {"SEX": "sex", "RACE": "race", "EDUC": "ses"}
+
+# ses: either inctot or educ could represent socioeconomic status
+IPUMS_COLUMN_NAMES = ["YEAR", "SEX", "AGE", "RACE", "EDUC"]
+
+# Number of rows of the raw extract cleaned at a time. Full ACS samples run to tens of millions of rows.
+DEFAULT_CHUNKSIZE = 1_000_000
 
 
 # Converted raw IPUMS data set in .csv to cleaned dataframe
 # Cleaned dataframe is an example input to diversity_analysis_tool
 def rename_by_code(df):
-    # Sex
-    df.loc[(df.SEX == 1), "SEX"] = "Male"
-    df.loc[(df.SEX == 2), "SEX"] = "Female"
-
-    # Race
-    df.loc[(df.RACE == 1), "RACE"] = "White"
-    df.loc[(df.RACE == 2), "RACE"] = "Black/African American/Negro"
-    df.loc[(df.RACE == 3), "RACE"] = "American Indian or Alaska Native"
-    df.loc[(df.RACE == 4), "RACE"] = "Chinese"
-    df.loc[(df.RACE == 5), "RACE"] = "Japanese"
-    df.loc[(df.RACE == 6), "RACE"] = "Other Asian or Pacific Islander"
-    df.loc[(df.RACE == 7), "RACE"] = "Other race, nec"
-    df.loc[(df.RACE == 8), "RACE"] = "Two major races"
-    df.loc[(df.RACE == 9), "RACE"] = "Three or more major races"
-
+    """
+    Replaces the IPUMS codes of the columns in IPUMS_SCHEME_FIELDS by their labels with the code tables of
+    the ipums coding scheme. Each column becomes a categorical of labels with a single lookup, codes with no
+    label keep their code as label and empty values stay empty.
+    Args:
+        df: data frame of a raw IPUMS extract
+    Returns: the data frame with labelled columns and the educational attainment codes in SES_LEVEL
+    """
     # Keeping the level for ordering in plots
-    df["SES_LEVEL"] = df.EDUC
-
-    # Education
-    df.loc[(df.EDUC == 0), "EDUC"] = "N/A or no schooling"
-    df.loc[(df.EDUC == 1), "EDUC"] = "Nursery school to grade 4"
-    df.loc[(df.EDUC == 2), "EDUC"] = "Grade 5, 6, 7, or 8"
-    df.loc[(df.EDUC == 3), "EDUC"] = "Grade 9"
-    df.loc[(df.EDUC == 4), "EDUC"] = "Grade 10"
-    df.loc[(df.EDUC == 5), "EDUC"] = "Grade 11"
-    df.loc[(df.EDUC == 6), "EDUC"] = "Grade 12"
-    df.loc[(df.EDUC == 7), "EDUC"] = "1 year of college"
-    df.loc[(df.EDUC == 8), "EDUC"] = "2 years of college"
-    df.loc[(df.EDUC == 9), "EDUC"] = "3 years of college"
-    df.loc[(df.EDUC == 10), "EDUC"] = "4 years of college"
-    df.loc[(df.EDUC == 11), "EDUC"] = "5+ years of college"
+    if "EDUC" in df:
+        df["SES_LEVEL"] = integer_codes(df["EDUC"])
 
+    lookups = BUILT_IN_SCHEMES["ipums"].lookups
+    for column_name, field in IPUMS_SCHEME_FIELDS.items():
+        if column_name in df:
+            df[column_name] = lookups[field].map(df[column_name])
     return df
 
 
-def clean_ipums(filename, outputfile, save_to_file=True):
-    df = pd.read_csv(filename)
+def clean_ipums(filename, outputfile, save_to_file=True, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Cleans a raw IPUMS extract into the input of the diversity report, one chunk of rows at a time so that
+    memory use does not grow with the size of the extract. Only the IPUMS_COLUMN_NAMES columns are read.
+    Args:
+        filename: path to the csv, Parquet or Arrow IPC/Feather file of the extract
+        outputfile: path of the cleaned csv or Parquet file. Arrow IPC/Feather files cannot be written one
+        chunk at a time, so they are written at once with chunksize None.
+        save_to_file (optional): whether to write the cleaned rows, defaults to True
+        chunksize (optional): number of rows cleaned at a time, None cleans the whole extract at once
+    Returns: the number of rows cleaned
+    """
+    chunks = read_table(filename, IPUMS_COLUMN_NAMES, chunksize=chunksize)
+    if not chunksize:
+        chunks = [chunks]
+
+    row_count = 0
+    report_writer = (
+        ChunkedTableWriter(outputfile) if save_to_file and chunksize else None
+    )
+    try:
+        for chunk_df in chunks:
+            chunk_df = _clean_chunk(chunk_df)
+            row_count += len(chunk_df)
+            if report_writer is not None:
+                report_writer.write(chunk_df)
+            elif save_to_file:
+                write_table(chunk_df, outputfile)
+            logger.debug(f"Cleaned {row_count} rows of {filename}")
+    finally:
+        if report_writer is not None:
+            report_writer.close()
+    return row_count
+
 
-    # ses: either inctot or educ could represent socioeconomic status
-    subset_cols = ["YEAR", "SEX", "AGE", "RACE", "EDUC"]
-    df = df[subset_cols]
-    df = rename_by_code(df)
+def _clean_chunk(df):
+    df = df[[column_name for column_name in IPUMS_COLUMN_NAMES if column_name in df]]
+    df = rename_by_code(df.copy(deep=False))
     # lower case columm names
     df.columns = map(str.lower, df.columns)
-
-    if save_to_file:
-        df.to_csv(outputfile, index=False)
+    return df
 
 
 if __name__ == "__main__":
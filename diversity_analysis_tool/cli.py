@@ -1,8 +1,59 @@
 import argparse
 import logging
 import os
-import pandas as pd
-from diversity_analysis_tool.diversity import AssessDiversity, transform_ses_order
+from diversity_analysis_tool.batch import (
+    ALL_SITES_DIRECTORY_NAME,
+    create_batch_report,
+    find_input_files,
+)
+from diversity_analysis_tool.cache import DEFAULT_CACHE_SIZE_BYTES, ReportCache
+from diversity_analysis_tool.disclosure import (
+    DEFAULT_QUASI_IDENTIFIERS,
+    DISCLOSURE_METHODS,
+    DISCLOSURE_REPORT_FILE_NAME,
+    DisclosureControl,
+)
+from diversity_analysis_tool.distributed import (
+    DEFAULT_PARTITION_BYTES,
+    create_distributed_report,
+)
+from diversity_analysis_tool.diversity import (
+    REPORT_TYPES,
+    AssessDiversity,
+    transform_ses_order,
+)
+from diversity_analysis_tool.html_report import (
+    HTML_REPORT_FILE_NAME,
+    write_html_report,
+)
+from diversity_analysis_tool.indices import (
+    DEFAULT_BOOTSTRAP_SAMPLES,
+    INDEX_REPORT_FILE_NAME,
+    write_index_report,
+)
+from diversity_analysis_tool.incremental import (
+    STATE_FILE_NAME,
+    create_incremental_report,
+)
+from diversity_analysis_tool.loading import (
+    DEFAULT_COLUMN_NAMES,
+    REPORT_FILE_EXTENSIONS,
+    load_column_names,
+    read_demographic_data,
+)
+from diversity_analysis_tool.profiling import PROFILE_FILE_NAME, StageProfiler
+from diversity_analysis_tool.representativeness import (
+    REFERENCE_COUNTS_FILE_NAME,
+    ReferencePopulation,
+    count_reference,
+    write_representativeness_report,
+)
+from diversity_analysis_tool.schemes import BUILT_IN_SCHEMES, load_scheme
+from diversity_analysis_tool.subgroups import (
+    DEFAULT_MIN_SUPPORT,
+    SUBGROUP_REPORT_FILE_NAME,
+    write_subgroup_report,
+)
 
 logger = logging.getLogger("diversity_analysis_tool.main")
 logger.setLevel(logging.INFO)
@@ -16,7 +67,10 @@ def main():
     parser.add_argument(
         "input_data",
         type=str,
-        help="Path to the csv file containing the data you want to assess.",
+        help=(
+            "Path to the csv, Parquet or Arrow IPC/Feather file containing the data you want to assess, "
+            "or a directory or glob pattern of such files (one per site) to assess in batch mode."
+        ),
     )
     parser.add_argument(
         "output_dir", type=str, help="Path to a directory where results will stored."
@@ -24,32 +78,432 @@ def main():
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Increase logging verbosity."
     )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="Read the input file this many rows at a time to keep memory use flat on large files.",
+    )
+    parser.add_argument(
+        "--report-format",
+        choices=list(REPORT_FILE_EXTENSIONS),
+        default="csv",
+        help=(
+            "Format of the report tables. parquet (zstd compressed) and feather keep categorical "
+            "dtypes, feather cannot be used with --chunksize for a report of rows."
+        ),
+    )
+    parser.add_argument(
+        "--report-type",
+        choices=list(REPORT_TYPES),
+        default="rows",
+        help=(
+            "rows writes every transformed row, aggregate only writes the number of people per category, "
+            "per pair of categories and the missing values per column."
+        ),
+    )
+    parser.add_argument(
+        "--no-sort",
+        action="store_true",
+        help="Write the transformed rows in the order they were read instead of sorting them.",
+    )
+    parser.add_argument(
+        "--graph-processes",
+        type=int,
+        default=None,
+        help="Number of processes to render the graphs in at the same time.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help=(
+            "Number of worker processes assessing files at the same time in batch mode, or bootstrapping "
+            "the columns of --indices."
+        ),
+    )
+    parser.add_argument(
+        "--columns-config",
+        type=str,
+        default=None,
+        help=(
+            "Path to a JSON file mapping the fields age, sex, ethnicity, race, ses and is_deceased to "
+            "the names of the columns they are read from."
+        ),
+    )
+    parser.add_argument(
+        "--scheme",
+        type=str,
+        default=None,
+        help=(
+            f"Coding scheme to map the codes of sex, ethnicity, race and ses to labels with, one of "
+            f"{', '.join(BUILT_IN_SCHEMES)} or the path to a JSON scheme file. Without a scheme the "
+            "values are reported as they are."
+        ),
+    )
+    parser.add_argument(
+        "--no-graphs",
+        action="store_true",
+        help="Only write the report of transformed rows, without drawing any graphs.",
+    )
+    parser.add_argument(
+        "--html-report",
+        action="store_true",
+        help=(
+            f"Write {HTML_REPORT_FILE_NAME}, a single page drawing the charts in the browser from the "
+            "counts, where fields can be paired and age bands widened without running the report again. "
+            "Combine with --no-graphs to skip the PNG graphs."
+        ),
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Only assess the rows and files added since the last run into the output directory, merging "
+            f"their counts with those saved in {STATE_FILE_NAME}. Always writes an aggregate report."
+        ),
+    )
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        help=(
+            "Split the input files into partitions which workers band, transform and count, then merge "
+            "their counts into an aggregate report. Workers are --workers local processes, or the workers "
+            "of the dask.distributed scheduler given with --scheduler."
+        ),
+    )
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        default=None,
+        help=(
+            "Address of a dask.distributed scheduler (eg: tcp://10.0.0.1:8786) to run the workers of "
+            "--distributed on. Every worker must be able to read the input files at the same paths."
+        ),
+    )
+    parser.add_argument(
+        "--partition-size",
+        type=int,
+        default=DEFAULT_PARTITION_BYTES // 2 ** 20,
+        help="Size in MB of the partitions the input files are split into with --distributed.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory to cache reports in. A report of the same data with the same options is copied "
+            "from the cache instead of being made again. Not used with --chunksize or --incremental."
+        ),
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE_BYTES // 2 ** 20,
+        help="Size in MB above which the least recently used cached reports are removed.",
+    )
+    parser.add_argument(
+        "--subgroups",
+        type=int,
+        default=None,
+        metavar="MAX_ORDER",
+        help=(
+            f"Write the most under-represented subgroups of up to MAX_ORDER categories (eg: 3 for age band, "
+            f"ethnicity and sex) compared with the marginals of the cohort to {SUBGROUP_REPORT_FILE_NAME}."
+        ),
+    )
+    parser.add_argument(
+        "--min-support",
+        type=float,
+        default=DEFAULT_MIN_SUPPORT,
+        help="Share of the cohort a subgroup must be expected to hold to be assessed with --subgroups.",
+    )
+    parser.add_argument(
+        "--indices",
+        action="store_true",
+        help=(
+            "Write the Shannon, Simpson, Gini-Simpson and effective number of groups indices of each field, "
+            f"overall and per age band, with bootstrap confidence intervals to {INDEX_REPORT_FILE_NAME}."
+        ),
+    )
+    parser.add_argument(
+        "--bootstrap-samples",
+        type=int,
+        default=DEFAULT_BOOTSTRAP_SAMPLES,
+        help="Number of bootstrap samples of the confidence intervals of --indices, 0 leaves them out.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the bootstrap samples of --indices.",
+    )
+    parser.add_argument(
+        "--reference",
+        type=str,
+        default=None,
+        help=(
+            "Path to the data of a reference population (eg: a census extract) to compare the cohort with, "
+            f"or to the {REFERENCE_COUNTS_FILE_NAME} saved by an earlier comparison. In batch mode every "
+            "site is compared."
+        ),
+    )
+    parser.add_argument(
+        "--reference-columns-config",
+        type=str,
+        default=None,
+        help="Path to a JSON file mapping the fields to the columns of the reference, like --columns-config.",
+    )
+    parser.add_argument(
+        "--k-anonymity",
+        type=int,
+        default=None,
+        metavar="K",
+        help=(
+            "Protect groups of fewer than K people sharing the same quasi-identifiers before the report and "
+            f"graphs are written, and list what was changed in {DISCLOSURE_REPORT_FILE_NAME}."
+        ),
+    )
+    parser.add_argument(
+        "--quasi-identifiers",
+        type=str,
+        default=",".join(DEFAULT_QUASI_IDENTIFIERS),
+        help="Comma separated transformed fields making up the groups of --k-anonymity.",
+    )
+    parser.add_argument(
+        "--disclosure-method",
+        choices=list(DISCLOSURE_METHODS),
+        default="suppress",
+        help=(
+            "suppress blanks the quasi-identifiers of people in small groups, coarsen first merges "
+            "categories (eg: adjacent age bands) until few people are left to suppress."
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=(
+            f"Record the time, rows and peak memory of each stage of the report in {PROFILE_FILE_NAME} "
+            "in the output directory."
+        ),
+    )
+    for field, default_column_name in DEFAULT_COLUMN_NAMES.items():
+        parser.add_argument(
+            f"--{field.replace('_', '-')}-column",
+            type=str,
+            default=None,
+            help=f"Name of the column describing {field} (default: {default_column_name}).",
+        )
     args = parser.parse_args()
     if args.verbose:
         logger.setLevel(logging.DEBUG)
-    if not os.path.isfile(args.input_data):
-        logger.error(f"{args.input_data} is not a valid path to a file")
+    batch_mode = not os.path.isfile(args.input_data)
+    input_file_paths = find_input_files(args.input_data)
+    if not input_file_paths:
+        logger.error(f"{args.input_data} is not a valid path to a file, directory or pattern")
         exit(1)
     if not os.path.isdir(args.output_dir):
         logger.error(f"{args.output_dir} does not exist, creating directory")
 
-    data_df = pd.read_csv(args.input_data)
-
-    logger.debug(
-        "Converted data to pandas data frame. Creating AssessDiversity instance"
-    )
+    profiler = StageProfiler() if args.profile else None
+    cache = None
+    if args.cache_dir:
+        cache = ReportCache(args.cache_dir, max_bytes=args.cache_size * 2 ** 20)
+    transforms = {"ethnicity": None, "race": None, "sex": None, "ses": None}
+    if args.scheme:
+        try:
+            scheme = load_scheme(args.scheme)
+        except ValueError as error:
+            logger.error(str(error))
+            exit(1)
+        transforms = {field: scheme.transform(field) for field in transforms}
     # if there is a column describing the ses levels in the data frame, order the levels accordingly
-    assess_diversity = AssessDiversity(None, None, None, transform_ses_order)
-
-    assess_diversity.create_diversity_analysis_report(
-        data_df,
+    if transforms["ses"] is None:
+        transforms["ses"] = transform_ses_order
+    disclosure_control = None
+    if args.k_anonymity:
+        try:
+            disclosure_control = DisclosureControl(
+                args.k_anonymity,
+                [name.strip() for name in args.quasi_identifiers.split(",")],
+                args.disclosure_method,
+            )
+        except ValueError as error:
+            logger.error(str(error))
+            exit(1)
+    assess_diversity = AssessDiversity(
+        transforms["ethnicity"],
+        transforms["race"],
+        transforms["sex"],
+        transforms["ses"],
+        profiler=profiler,
+        cache=cache,
+        disclosure_control=disclosure_control,
+    )
+    column_names = load_column_names(
+        args.columns_config,
+        **{
+            field: getattr(args, f"{field}_column")
+            for field in DEFAULT_COLUMN_NAMES.keys()
+        },
+    )
+    report_arguments = (
         5,
-        "age",
-        "sex",
-        "ethnicity",
-        "race",
-        "educ",
-        "is_deceased",
+        column_names["age"],
+        column_names["sex"],
+        column_names["ethnicity"],
+        column_names["race"],
+        column_names["ses"],
+        column_names["is_deceased"],
         args.output_dir,
     )
+
+    analysis_directory_path = args.output_dir
+    cohort_counts = None
+    if args.incremental:
+        logger.debug(f"Assessing rows added to {len(input_file_paths)} files")
+        counts = create_incremental_report(
+            assess_diversity,
+            input_file_paths,
+            *report_arguments,
+            chunksize=args.chunksize,
+            graph_processes=args.graph_processes,
+            report_format=args.report_format,
+            render_graphs=not args.no_graphs,
+        )
+    elif args.distributed:
+        logger.debug(f"Assessing {len(input_file_paths)} files in distributed mode")
+        executor = None
+        client = None
+        if args.scheduler:
+            # dask.distributed is only needed to run on a cluster
+            from distributed import Client
+
+            client = Client(args.scheduler)
+            executor = client.get_executor()
+        try:
+            counts = create_distributed_report(
+                assess_diversity,
+                input_file_paths,
+                *report_arguments,
+                executor=executor,
+                workers=args.workers,
+                partition_bytes=args.partition_size * 2 ** 20,
+                chunksize=args.chunksize,
+                graph_processes=args.graph_processes,
+                report_format=args.report_format,
+                render_graphs=not args.no_graphs,
+            )
+        finally:
+            if client is not None:
+                client.close()
+    elif batch_mode:
+        logger.debug(f"Assessing {len(input_file_paths)} files in batch mode")
+        site_counts = create_batch_report(
+            assess_diversity,
+            input_file_paths,
+            *report_arguments,
+            workers=args.workers,
+            chunksize=args.chunksize,
+            report_format=args.report_format,
+            render_graphs=not args.no_graphs,
+            report_type=args.report_type,
+            sort_rows=not args.no_sort,
+        )
+        counts = site_counts.get(ALL_SITES_DIRECTORY_NAME)
+        # every site is compared with the reference at once
+        cohort_counts = {
+            name: counts_of_site
+            for name, counts_of_site in site_counts.items()
+            if counts_of_site is not None
+        }
+        analysis_directory_path = os.path.join(
+            args.output_dir, ALL_SITES_DIRECTORY_NAME
+        )
+    elif args.chunksize:
+        logger.debug(f"Reading data in chunks of {args.chunksize} rows")
+        chunks = read_demographic_data(
+            args.input_data, column_names, chunksize=args.chunksize
+        )
+        counts = assess_diversity.create_diversity_analysis_report_from_chunks(
+            chunks,
+            *report_arguments,
+            graph_processes=args.graph_processes,
+            report_format=args.report_format,
+            render_graphs=not args.no_graphs,
+            report_type=args.report_type,
+            sort_rows=not args.no_sort,
+        )
+    else:
+        data_df = read_demographic_data(args.input_data, column_names)
+
+        logger.debug(
+            "Converted data to pandas data frame. Creating AssessDiversity instance"
+        )
+        counts = assess_diversity.create_diversity_analysis_report(
+            data_df,
+            *report_arguments,
+            graph_processes=args.graph_processes,
+            report_format=args.report_format,
+            render_graphs=not args.no_graphs,
+            report_type=args.report_type,
+            sort_rows=not args.no_sort,
+        )
+    if args.html_report and counts is not None:
+        write_html_report(
+            counts,
+            analysis_directory_path,
+            title=f"Diversity of {os.path.basename(os.path.normpath(args.input_data))}",
+        )
+    if args.subgroups and counts is not None:
+        write_subgroup_report(
+            counts,
+            analysis_directory_path,
+            args.report_format,
+            max_order=args.subgroups,
+            min_support=args.min_support,
+        )
+    if args.reference and counts is not None:
+        if args.reference.endswith(".json"):
+            reference = ReferencePopulation.load(args.reference)
+        else:
+            reference_column_names = None
+            if args.reference_columns_config:
+                reference_column_names = load_column_names(
+                    args.reference_columns_config
+                )
+            reference = ReferencePopulation(
+                count_reference(
+                    assess_diversity,
+                    args.reference,
+                    5,
+                    column_names,
+                    reference_column_names,
+                    chunksize=args.chunksize,
+                )
+            )
+            # the reference is saved so that later comparisons do not read it again
+            reference.save(
+                os.path.join(analysis_directory_path, REFERENCE_COUNTS_FILE_NAME)
+            )
+        write_representativeness_report(
+            reference,
+            cohort_counts or counts,
+            analysis_directory_path,
+            args.report_format,
+        )
+    if args.indices and counts is not None:
+        write_index_report(
+            counts,
+            analysis_directory_path,
+            args.report_format,
+            bootstrap_samples=args.bootstrap_samples,
+            seed=args.seed,
+            processes=args.workers,
+        )
+    if profiler is not None:
+        for stage in profiler.summary():
+            logger.info(
+                f"{stage['stage']}: {stage['seconds']:.3f}s over {stage['calls']} calls"
+            )
     logger.info("Assessment complete. See {} for results".format(args.output_dir))
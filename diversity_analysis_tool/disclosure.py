@@ -0,0 +1,512 @@
+import os
+import re
+import logging
+
+import numpy as np
+import pandas as pd
+
+from diversity_analysis_tool.aggregates import COUNT_COLUMN_NAME
+from diversity_analysis_tool.loading import (
+    REPORT_FILE_EXTENSIONS,
+    ChunkedTableWriter,
+    file_format,
+    read_table,
+    write_table,
+)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DISCLOSURE_REPORT_FILE_NAME = "diversity_disclosure_changes"
+DISCLOSURE_METHODS = ("suppress", "coarsen")
+# Fields which, combined, could single out a person in another data set. 'ses' stands for the column the
+# socio-economic status is read from, which keeps its own name once transformed.
+DEFAULT_QUASI_IDENTIFIERS = ("age_band", "sex", "ethnicity", "race", "ses")
+DEFAULT_K = 5
+# Share of the cohort which may be suppressed rather than coarsened further with the 'coarsen' method
+DEFAULT_MAX_SUPPRESSED = 0.01
+# Label of the category the rarest categories of an unordered column are coarsened into
+OTHER_LABEL = "Other"
+
+_AGE_BAND_PATTERN = re.compile(r"^(\d+)(?: - (\d+)|plus)$")
+
+
+class DisclosureControl:
+    """
+    Checks that every equivalence class, the people sharing the same values of all the quasi-identifiers
+    (eg: age band, sex, ethnicity, race and ses), holds at least k people before anything is written, and
+    protects those that do not:
+
+    - suppress: the quasi-identifiers of people in classes smaller than k are replaced by missing values
+    - coarsen: categories are merged first, adjacent ones for ordered columns (eg: '85 - 90' and '90plus'
+      become '85plus') and the rarest into 'Other' for the others. Each step merges the pair of categories
+      of whichever column leaves the fewest people in small classes, until at most max_suppressed of the
+      cohort is left in them or no merge helps any more. The people left in small classes are suppressed.
+
+    Missing values count as a value of their own, except that people with every quasi-identifier missing
+    cannot be told apart by them and are never suppressed. Class sizes are summed from DiversityCounts,
+    which are counted chunk by chunk, so the check takes the same memory whatever the size of the cohort.
+    """
+
+    def __init__(
+        self,
+        k=DEFAULT_K,
+        quasi_identifiers=DEFAULT_QUASI_IDENTIFIERS,
+        method="suppress",
+        max_suppressed=DEFAULT_MAX_SUPPRESSED,
+    ):
+        """
+        Args:
+            k (optional): smallest number of people an equivalence class may hold, defaults to 5
+            quasi_identifiers (optional): the transformed columns making up the equivalence classes, 'ses'
+            standing for the socio-economic status column whatever its name
+            method (optional): 'suppress' or 'coarsen', defaults to 'suppress'
+            max_suppressed (optional): share of the cohort the 'coarsen' method may leave to suppression
+        """
+        if method not in DISCLOSURE_METHODS:
+            raise ValueError(
+                f"Unknown disclosure control method {method}, expected one of {list(DISCLOSURE_METHODS)}"
+            )
+        if k < 1:
+            raise ValueError(f"k must be at least 1, got {k}")
+        self.k = k
+        self.quasi_identifiers = tuple(quasi_identifiers)
+        self.method = method
+        self.max_suppressed = max_suppressed
+
+    def settings(self):
+        """
+        Returns: a dictionary of the settings, which the protected results depend on
+        """
+        return {
+            "k": self.k,
+            "quasi_identifiers": list(self.quasi_identifiers),
+            "method": self.method,
+            "max_suppressed": self.max_suppressed,
+        }
+
+    def column_names(self, counts, ses_column_name=None):
+        """
+        Returns: the quasi-identifiers which are columns of counts, with 'ses' replaced by ses_column_name
+        """
+        column_names = [
+            ses_column_name if column_name == "ses" and ses_column_name else column_name
+            for column_name in self.quasi_identifiers
+        ]
+        return [
+            column_name
+            for column_name in dict.fromkeys(column_names)
+            if column_name in counts.levels
+        ]
+
+    def protect(self, counts, ses_column_name=None, row_labels=None):
+        """
+        Args:
+            counts: the DiversityCounts of the transformed data
+            ses_column_name (optional): name of the socio-economic status column
+            row_labels (optional): dictionary of column name to a dictionary of row value to the label it is
+            counted as, for columns relabelled after counting (eg: is_deceased True as 'Yes')
+        Returns: a DisclosurePlan holding the protected counts and what was changed
+        """
+        column_names = self.column_names(counts, ses_column_name)
+        original_levels = {
+            column_name: counts.levels[column_name] for column_name in column_names
+        }
+        # the categories of each column as groups of the original categories, merged as the column is coarsened
+        groups = {
+            column_name: [[position] for position in range(len(levels))]
+            for column_name, levels in original_levels.items()
+        }
+        labels = {
+            column_name: list(levels) for column_name, levels in original_levels.items()
+        }
+        cube_codes = {
+            column_name: counts.cube[column_name].to_numpy()
+            for column_name in column_names
+        }
+        weights = counts.cube[COUNT_COLUMN_NAME].to_numpy()
+
+        small_people = _small_class_people(
+            cube_codes, _group_lookups(groups), weights, self.k
+        )
+        max_small_people = self.max_suppressed * counts.row_count
+        while self.method == "coarsen" and small_people > max_small_people:
+            best = None
+            for column_name in column_names:
+                candidate = _coarsening(
+                    column_name,
+                    groups[column_name],
+                    labels[column_name],
+                    original_levels[column_name],
+                    cube_codes[column_name],
+                    weights,
+                    counts.ordered[column_name],
+                )
+                if candidate is None:
+                    continue
+                candidate_groups, candidate_labels, relabelled_people = candidate
+                candidate_small_people = _small_class_people(
+                    cube_codes,
+                    _group_lookups(dict(groups, **{column_name: candidate_groups})),
+                    weights,
+                    self.k,
+                )
+                # the merge protecting the most people per person whose category changes
+                gain = (small_people - candidate_small_people) / relabelled_people
+                if gain > 0 and (best is None or gain > best[0]):
+                    best = (gain, candidate_small_people, column_name, candidate)
+            if best is None:
+                break
+            _, small_people, column_name, candidate = best
+            groups[column_name], labels[column_name], _ = candidate
+            logger.debug(
+                f"Coarsened {column_name}, {small_people} people left in classes below {self.k}"
+            )
+
+        protected_counts = counts
+        change_tables = []
+        code_lookups = {}
+        for column_name in column_names:
+            levels = original_levels[column_name]
+            new_labels = {
+                levels[position]: label
+                for group, label in zip(groups[column_name], labels[column_name])
+                for position in group
+            }
+            renamed = {
+                label: new_label
+                for label, new_label in new_labels.items()
+                if new_label != label
+            }
+            if renamed:
+                protected_counts = protected_counts.rename_levels(column_name, renamed)
+                change_tables.append(
+                    pd.DataFrame(
+                        {
+                            "action": "coarsened",
+                            "column": column_name,
+                            "category": [str(label) for label in renamed],
+                            "new_category": [str(label) for label in renamed.values()],
+                            "classes": None,
+                            "people": None,
+                        }
+                    )
+                )
+            # the final entry maps missing values (-1) back to -1
+            code_lookups[column_name] = np.append(
+                protected_counts.levels[column_name].get_indexer(
+                    [new_labels[label] for label in levels]
+                ),
+                -1,
+            )
+
+        level_counts = [
+            len(protected_counts.levels[column_name]) for column_name in column_names
+        ]
+        keys = _class_keys(
+            [
+                protected_counts.cube[column_name].to_numpy()
+                for column_name in column_names
+            ],
+            level_counts,
+        )
+        sizes = _class_sizes(keys, protected_counts.cube[COUNT_COLUMN_NAME].to_numpy())
+        suppressed = (sizes < self.k) & (keys != 0)
+        suppressed_keys = np.unique(keys[suppressed])
+        if suppressed.any():
+            suppressed_people = int(
+                protected_counts.cube[COUNT_COLUMN_NAME].to_numpy()[suppressed].sum()
+            )
+            # the suppressed classes themselves are not listed, as that would disclose them
+            change_tables.append(
+                pd.DataFrame(
+                    {
+                        "action": ["suppressed"],
+                        "column": [", ".join(column_names)],
+                        "category": [None],
+                        "new_category": [None],
+                        "classes": [len(suppressed_keys)],
+                        "people": [suppressed_people],
+                    }
+                )
+            )
+            logger.info(
+                f"Suppressed {suppressed_people} people in {len(suppressed_keys)} classes smaller than {self.k}"
+            )
+            protected_counts = protected_counts.set_missing(suppressed, column_names)
+
+        changes_df = (
+            pd.concat(change_tables, ignore_index=True)
+            if change_tables
+            else pd.DataFrame(
+                columns=[
+                    "action",
+                    "column",
+                    "category",
+                    "new_category",
+                    "classes",
+                    "people",
+                ]
+            )
+        )
+        return DisclosurePlan(
+            protected_counts,
+            column_names,
+            original_levels,
+            code_lookups,
+            level_counts,
+            suppressed_keys,
+            changes_df,
+            row_labels,
+        )
+
+
+class DisclosurePlan:
+    """
+    The changes DisclosureControl.protect made to the counts of a cohort, which protect_rows makes to the
+    transformed rows the counts were made from, one chunk at a time if need be.
+    """
+
+    def __init__(
+        self,
+        counts,
+        column_names,
+        original_levels,
+        code_lookups,
+        level_counts,
+        suppressed_keys,
+        changes,
+        row_labels=None,
+    ):
+        """
+        Args:
+            counts: the protected DiversityCounts
+            column_names: the quasi-identifier columns
+            original_levels: dictionary of column name to the labels of the counts before protection
+            code_lookups: dictionary of column name to an array of the protected code of each original code
+            level_counts: number of protected labels of each column, in the order of column_names
+            suppressed_keys: sorted keys of the equivalence classes which are suppressed, see _class_keys
+            changes: data frame of the changes, with the columns 'action' ('coarsened' or 'suppressed'),
+            'column', 'category', 'new_category', 'classes' and 'people'
+            row_labels (optional): dictionary of column name to a dictionary of row value to the label it is
+            counted as, see DisclosureControl.protect
+        """
+        self.counts = counts
+        self.column_names = column_names
+        self.original_levels = original_levels
+        self.code_lookups = code_lookups
+        self.level_counts = level_counts
+        self.suppressed_keys = suppressed_keys
+        self.changes = changes
+        self.row_labels = row_labels or {}
+
+    def protect_rows(self, df):
+        """
+        Args:
+            df: transformed rows counted in the counts the plan was made from, or a chunk of them
+        Returns: a new data frame with the quasi-identifiers coarsened and suppressed as in the protected
+        counts, as categoricals of their labels
+        """
+        if not self.column_names:
+            return df
+        codes = [
+            self.code_lookups[column_name][
+                _label_codes(
+                    df[column_name],
+                    self.original_levels[column_name],
+                    self.row_labels.get(column_name),
+                )
+            ]
+            for column_name in self.column_names
+        ]
+        if len(self.suppressed_keys):
+            suppressed = np.isin(
+                _class_keys(codes, self.level_counts), self.suppressed_keys
+            )
+            codes = [np.where(suppressed, -1, column_codes) for column_codes in codes]
+        df = df.copy(deep=False)
+        for column_name, column_codes in zip(self.column_names, codes):
+            df[column_name] = pd.Categorical.from_codes(
+                column_codes,
+                categories=self.counts.levels[column_name],
+                ordered=self.counts.ordered[column_name],
+            )
+        return df
+
+    def protect_file(self, source_file_path, target_file_path, chunksize, sep="|"):
+        """
+        Writes the protected rows of a csv or Parquet file of transformed rows to another file, chunksize
+        rows at a time
+        Args:
+            source_file_path: path to the file of transformed rows
+            target_file_path: path of the protected file, in the same format
+            chunksize: number of rows protected at a time
+            sep (optional): the delimiter of csv files
+        """
+        if file_format(source_file_path) == "csv":
+            # labels are matched as text, so numeric labels must not be read as floats
+            chunks = pd.read_csv(
+                source_file_path, sep=sep, dtype=str, chunksize=chunksize
+            )
+        else:
+            chunks = read_table(source_file_path, chunksize=chunksize)
+        with ChunkedTableWriter(target_file_path, sep=sep) as report_writer:
+            for chunk_df in chunks:
+                report_writer.write(self.protect_rows(chunk_df))
+
+
+def equivalence_classes(counts, column_names):
+    """
+    Args:
+        counts: the DiversityCounts of the transformed data
+        column_names: the quasi-identifier columns
+    Returns: a data frame with one row per equivalence class, the smallest first, with the label of each
+    column (missing values as NaN) and the number of people in the 'count' column
+    """
+    return (
+        counts.to_frame()
+        .groupby(list(column_names), sort=False, observed=True, dropna=False)[
+            COUNT_COLUMN_NAME
+        ]
+        .sum()
+        .reset_index()
+        .sort_values(COUNT_COLUMN_NAME, kind="mergesort")
+        .reset_index(drop=True)
+    )
+
+
+def write_disclosure_report(plan, output_directory_path, report_format="csv"):
+    """
+    Writes the changes made by disclosure control to diversity_disclosure_changes in the output directory
+    Args:
+        plan: the DisclosurePlan of the report
+        output_directory_path: directory where the table will be stored
+        report_format (optional): 'csv' (pipe delimited), 'parquet' or 'feather'
+    """
+    write_table(
+        plan.changes,
+        os.path.join(
+            output_directory_path,
+            DISCLOSURE_REPORT_FILE_NAME + REPORT_FILE_EXTENSIONS[report_format],
+        ),
+        sep="|",
+    )
+
+
+def _class_keys(codes, level_counts):
+    """a single integer per combination of codes (-1 for missing), 0 when every code is missing"""
+    if not len(codes):
+        return np.zeros(0, dtype="int64")
+    return np.ravel_multi_index(
+        tuple(np.asarray(column_codes) + 1 for column_codes in codes),
+        tuple(level_count + 1 for level_count in level_counts),
+    )
+
+
+def _class_sizes(keys, weights):
+    """number of people in the class of each key, counted in a hash table of the keys"""
+    positions, unique_keys = pd.factorize(keys)
+    return np.bincount(positions, weights=weights, minlength=len(unique_keys))[
+        positions
+    ]
+
+
+def _group_lookups(groups):
+    lookups = {}
+    for column_name, column_groups in groups.items():
+        lookup = np.empty(sum(len(group) for group in column_groups) + 1, dtype="int64")
+        for group_position, group in enumerate(column_groups):
+            lookup[group] = group_position
+        lookup[-1] = -1
+        lookups[column_name] = lookup
+    return lookups
+
+
+def _small_class_people(cube_codes, lookups, weights, k):
+    """number of people in classes of fewer than k people, other than the class of people with no values"""
+    codes = [lookups[column_name][cube_codes[column_name]] for column_name in lookups]
+    keys = _class_keys(codes, [len(lookup) - 1 for lookup in lookups.values()])
+    if not len(keys):
+        return 0
+    sizes = _class_sizes(keys, weights)
+    return int(weights[(sizes < k) & (keys != 0)].sum())
+
+
+def _coarsening(
+    column_name, groups, labels, original_levels, cube_codes, weights, ordered
+):
+    """
+    the groups and labels of a column after merging its rarest category with the rarer of its neighbours
+    (ordered columns) or into 'Other', with the number of people whose category changes. None if the merge
+    would leave fewer than two categories with people.
+    """
+    lookup = _group_lookups({column_name: groups})[column_name]
+    codes = lookup[cube_codes]
+    people = np.bincount(
+        codes[codes >= 0], weights=weights[codes >= 0], minlength=len(groups)
+    )
+    present = np.nonzero(people)[0]
+    if len(present) < 3:
+        return None
+    if ordered:
+        rarest = int(np.argmin(people[present]))
+        neighbours = [
+            position
+            for position in (rarest - 1, rarest + 1)
+            if 0 <= position < len(present)
+        ]
+        neighbour = min(neighbours, key=lambda position: people[present[position]])
+        first, last = sorted([present[rarest], present[neighbour]])
+        merged = [position for group in groups[first : last + 1] for position in group]
+        label = _merged_label(original_levels[merged[0]], original_levels[merged[-1]])
+        return (
+            groups[:first] + [merged] + groups[last + 1 :],
+            labels[:first] + [label] + labels[last + 1 :],
+            people[first : last + 1].sum(),
+        )
+
+    others = [position for position in present if labels[position] == OTHER_LABEL]
+    candidates = sorted(
+        (position for position in present if labels[position] != OTHER_LABEL),
+        key=lambda position: people[position],
+    )
+    if others:
+        other = others[0]
+        rarest = candidates[0]
+        relabelled_people = people[rarest]
+    else:
+        # without an 'Other' category yet, the two rarest categories make it
+        other, rarest = sorted(candidates[:2])
+        relabelled_people = people[other] + people[rarest]
+    groups = list(groups)
+    labels = list(labels)
+    groups[other] = groups[other] + groups[rarest]
+    labels[other] = OTHER_LABEL
+    del groups[rarest]
+    del labels[rarest]
+    return groups, labels, relabelled_people
+
+
+def _merged_label(first_label, last_label):
+    """label of a range of ordered categories, age bands like '85 - 90' to '90plus' become '85plus'"""
+    first_match = _AGE_BAND_PATTERN.match(str(first_label))
+    last_match = _AGE_BAND_PATTERN.match(str(last_label))
+    if first_match and last_match:
+        if last_match.group(2) is None:
+            return f"{first_match.group(1)}plus"
+        return f"{first_match.group(1)} - {last_match.group(2)}"
+    return f"{first_label} to {last_label}"
+
+
+def _label_codes(column, levels, row_labels=None):
+    """
+    positions of the values of a column in levels, matched as text after mapping them through row_labels,
+    -1 for missing values
+    """
+    if not pd.api.types.is_categorical_dtype(column):
+        column = column.astype("category")
+    categories = column.cat.categories
+    if row_labels:
+        categories = pd.Index([row_labels.get(value, value) for value in categories])
+    positions = pd.Index(levels.astype(str)).get_indexer(categories.astype(str))
+    return np.append(positions, -1)[column.cat.codes.to_numpy()]
@@ -0,0 +1,264 @@
+import os
+import copy
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from diversity_analysis_tool.diversity import (
+    IS_DECEASED_LABELS,
+    build_graphs,
+    write_aggregate_report,
+)
+from diversity_analysis_tool.loading import file_format, read_demographic_data
+from diversity_analysis_tool.profiling import NULL_PROFILER, PROFILE_FILE_NAME
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Amount of data each worker reads at a time, large enough that reading dominates scheduling
+DEFAULT_PARTITION_BYTES = 256 * 2 ** 20
+
+
+def plan_partitions(input_file_paths, partition_bytes=DEFAULT_PARTITION_BYTES):
+    """
+    Splits the files of a cohort into partitions of about partition_bytes each, which workers can read
+    independently of each other. csv files are split at line starts, Parquet files at row groups and Arrow
+    IPC/Feather files into ranges of rows. Rows of csv files that are split must not hold line breaks within
+    quoted values.
+    Args:
+        input_file_paths: paths to the csv, Parquet or Arrow IPC/Feather files of the cohort
+        partition_bytes (optional): size of a partition in bytes, None makes one partition per file
+    Returns: a list of partitions, dictionaries with the 'file_path' to read and the 'position' in it,
+    keyword arguments of read_demographic_data
+    """
+    partitions = []
+    for file_path in input_file_paths:
+        if partition_bytes is None:
+            positions = [{}]
+        elif file_format(file_path) == "csv":
+            positions = _csv_positions(file_path, partition_bytes)
+        elif file_format(file_path) == "parquet":
+            positions = _parquet_positions(file_path, partition_bytes)
+        else:
+            positions = _arrow_positions(file_path, partition_bytes)
+        partitions.extend(
+            {"file_path": file_path, "position": position} for position in positions
+        )
+    return partitions
+
+
+def count_partition(
+    assess_diversity, partition, years_per_band, column_names, chunksize=None
+):
+    """
+    Bands, transforms and counts the rows of one partition. This runs on a worker.
+    Args:
+        assess_diversity: the AssessDiversity to transform the data with
+        partition: a partition made by plan_partitions
+        years_per_band: the number of years in each age band
+        column_names: dictionary of field to column name, see load_column_names
+        chunksize (optional): read the partition this many rows at a time
+    Returns: the DiversityCounts of the partition (None if it has no rows), its number of rows and the
+    seconds it took
+    """
+    start = time.perf_counter()
+    data = read_demographic_data(
+        partition["file_path"], column_names, chunksize, **partition["position"]
+    )
+    chunks = data if chunksize else [data]
+
+    counts = None
+    row_count = 0
+    for chunk_df in chunks:
+        if chunk_df.empty:
+            continue
+        row_count += len(chunk_df)
+        chunk_counts = assess_diversity.count_categories(
+            chunk_df,
+            years_per_band,
+            column_names["age"],
+            column_names["sex"],
+            column_names["ethnicity"],
+            column_names["race"],
+            column_names["ses"],
+            column_names["is_deceased"],
+        )
+        counts = chunk_counts if counts is None else counts.merge(chunk_counts)
+    return counts, row_count, time.perf_counter() - start
+
+
+def create_distributed_report(
+    assess_diversity,
+    input_file_paths,
+    years_per_band,
+    age_column_name,
+    sex_column_name,
+    ethnicity_column_name,
+    race_column_name,
+    ses_column_name,
+    is_deceased_column_name,
+    output_directory_path,
+    executor=None,
+    workers=None,
+    partition_bytes=DEFAULT_PARTITION_BYTES,
+    chunksize=None,
+    graph_processes=None,
+    report_format="csv",
+    render_graphs=True,
+):
+    """
+    Assesses a cohort sharded across many files, too large for one machine. The files are split into
+    partitions, each worker bands, transforms and counts the partitions it is given, and the coordinator
+    (this process) merges the partial counts in partition order before writing the aggregate report and
+    drawing the graphs. Only counts travel back from the workers, never rows.
+
+    Any concurrent.futures style executor can run the workers, eg: the executor of a dask.distributed
+    Client (client.get_executor()) or an mpi4py MPIPoolExecutor, as long as every worker can read the files
+    at the same paths and import this package. AssessDiversity and its transform routines are pickled to
+    the workers, so the routines must be importable functions or SchemeTransforms, not lambdas.
+    Args:
+        assess_diversity: the AssessDiversity to transform the data with
+        input_file_paths: paths to the csv, Parquet or Arrow IPC/Feather files making up the cohort
+        executor (optional): the executor to run the workers on. By default a local cluster of worker
+        processes is started and shut down again.
+        workers (optional): number of worker processes of the local cluster, defaults to the number of CPUs
+        partition_bytes (optional): size of the partitions the files are split into, see plan_partitions
+        chunksize (optional): workers read their partition this many rows at a time
+        graph_processes (optional): number of processes to render the graphs in at the same time
+        report_format (optional): format of the aggregate tables, see create_diversity_analysis_report
+        render_graphs (optional): whether to draw the graphs, defaults to True
+        other arguments: the same as AssessDiversity.create_diversity_analysis_report
+    Returns: the DiversityCounts of the cohort, protected by the disclosure control of assess_diversity if
+    any, or None if there is no data
+    """
+    column_names = {
+        "age": age_column_name,
+        "sex": sex_column_name,
+        "ethnicity": ethnicity_column_name,
+        "race": race_column_name,
+        "ses": ses_column_name,
+        "is_deceased": is_deceased_column_name,
+    }
+    profiler = assess_diversity.profiler
+    # workers neither profile nor cache, their timings are sent back with the counts instead
+    worker_assess_diversity = copy.copy(assess_diversity)
+    worker_assess_diversity.profiler = NULL_PROFILER
+    worker_assess_diversity.cache = None
+
+    with profiler.stage("report") as report_record:
+        with profiler.stage("plan_partitions"):
+            partitions = plan_partitions(input_file_paths, partition_bytes)
+        logger.info(
+            f"Assessing {len(input_file_paths)} files in {len(partitions)} partitions"
+        )
+
+        with profiler.stage("count_categories") as count_record:
+            local_executor = None
+            if executor is None:
+                local_executor = executor = ProcessPoolExecutor(max_workers=workers)
+            try:
+                futures = [
+                    executor.submit(
+                        count_partition,
+                        worker_assess_diversity,
+                        partition,
+                        years_per_band,
+                        column_names,
+                        chunksize,
+                    )
+                    for partition in partitions
+                ]
+                counts = None
+                row_count = 0
+                for partition, future in zip(partitions, futures):
+                    partition_counts, partition_row_count, seconds = future.result()
+                    profiler.add_record(
+                        "count_partition", seconds, rows=partition_row_count
+                    )
+                    row_count += partition_row_count
+                    if partition_counts is not None:
+                        counts = (
+                            partition_counts
+                            if counts is None
+                            else counts.merge(partition_counts)
+                        )
+                    logger.debug(
+                        f"Merged {partition_row_count} rows of {partition['file_path']}"
+                    )
+            finally:
+                if local_executor is not None:
+                    local_executor.shutdown()
+            count_record["rows"] = row_count
+        report_record["rows"] = row_count
+
+        if counts is None:
+            logger.warning("No data to assess")
+            return None
+        if "is_deceased" in counts.levels:
+            counts = counts.rename_levels("is_deceased", IS_DECEASED_LABELS)
+
+        if not os.path.exists(output_directory_path):
+            os.makedirs(output_directory_path)
+        disclosure_plan = assess_diversity.apply_disclosure_control(
+            counts, ses_column_name, output_directory_path, report_format
+        )
+        if disclosure_plan is not None:
+            counts = disclosure_plan.counts
+        with profiler.stage("write_report"):
+            write_aggregate_report(counts, output_directory_path, report_format)
+        if render_graphs:
+            with profiler.stage("build_graph"):
+                build_graphs(counts, output_directory_path, graph_processes, profiler)
+    profiler.write_json(os.path.join(output_directory_path, PROFILE_FILE_NAME))
+    return counts
+
+
+def _csv_positions(file_path, partition_bytes):
+    file_size = os.path.getsize(file_path)
+    positions = []
+    with open(file_path, "rb") as csv_file:
+        csv_file.readline()
+        start = csv_file.tell()
+        while start < file_size:
+            end = file_size
+            if start + partition_bytes < file_size:
+                # the partition ends after the line its last byte falls on
+                csv_file.seek(start + partition_bytes)
+                csv_file.readline()
+                end = csv_file.tell()
+            positions.append({"skip_bytes": start, "end_bytes": end})
+            start = end
+    return positions
+
+
+def _parquet_positions(file_path, partition_bytes):
+    import pyarrow.parquet as pq
+
+    metadata = pq.ParquetFile(file_path).metadata
+    positions = []
+    first_row = 0
+    row_count = 0
+    byte_count = 0
+    for row_group in range(metadata.num_row_groups):
+        row_count += metadata.row_group(row_group).num_rows
+        byte_count += metadata.row_group(row_group).total_byte_size
+        if byte_count >= partition_bytes:
+            positions.append({"skip_rows": first_row, "max_rows": row_count})
+            first_row += row_count
+            row_count = 0
+            byte_count = 0
+    if row_count:
+        positions.append({"skip_rows": first_row, "max_rows": row_count})
+    return positions
+
+
+def _arrow_positions(file_path, partition_bytes):
+    import pyarrow as pa
+
+    row_count = pa.ipc.open_file(pa.memory_map(file_path)).read_all().num_rows
+    partition_count = max(1, -(-os.path.getsize(file_path) // partition_bytes))
+    rows_per_partition = -(-row_count // partition_count)
+    return [
+        {"skip_rows": first_row, "max_rows": rows_per_partition}
+        for first_row in range(0, row_count, rows_per_partition or 1)
+    ]
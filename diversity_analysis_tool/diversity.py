@@ -1,18 +1,57 @@
 import os
+import shutil
+import hashlib
 import logging
+import functools
+import contextlib
 
 import pandas as pd
 import numpy as np
 
-from diversity_analysis_tool.graph_construction import GraphUtility
-from diversity_analysis_tool.nhs_codes import (
-    NHS_ETHNICITY_CODE_DICT,
-    NHS_RACE_CODE_DICT,
+from diversity_analysis_tool.aggregates import DiversityCounts
+from diversity_analysis_tool.backends import backend_for, to_pandas
+from diversity_analysis_tool.cache import copy_report_files
+from diversity_analysis_tool.disclosure import write_disclosure_report
+from diversity_analysis_tool.loading import (
+    REPORT_FILE_EXTENSIONS,
+    ChunkedTableWriter,
+    write_table,
+)
+from diversity_analysis_tool.profiling import NULL_PROFILER, PROFILE_FILE_NAME
+from diversity_analysis_tool.schemes import (
+    BUILT_IN_SCHEMES,
+    CodeLookup,
+    SchemeTransform,
+    integer_codes,
 )
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Labels used for the is_deceased field in visual presentations
+IS_DECEASED_LABELS = {True: "Yes", False: "No", "True": "Yes", "False": "No"}
+
+# A report either holds every transformed row or only the counts per category, per pair of categories and
+# the missing values per column
+REPORT_TYPES = ("rows", "aggregate")
+AGGREGATE_REPORT_FILE_NAMES = {
+    "category_table": "diversity_category_counts",
+    "pair_table": "diversity_pair_counts",
+    "missing_table": "diversity_missing_counts",
+}
+MISSING_LABEL = "not provided"
+# Rows of a report made in chunks are staged here until small groups of people are protected
+UNPROTECTED_REPORT_FILE_NAME = "diversity_analysis_report_unprotected"
+
+
+def __getattr__(name):
+    # GraphUtility is still importable from here, but matplotlib and seaborn are only loaded when it is used
+    if name == "GraphUtility":
+        from diversity_analysis_tool.graph_construction import GraphUtility
+
+        return GraphUtility
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 class AssessDiversity:
     """
@@ -22,6 +61,10 @@ class AssessDiversity:
 
     It assumes the input data frame has the following optional columns:
     age, sex, ethnicity, race, ses, is_deceased.
+
+    Besides pandas data frames, pyarrow Tables and polars DataFrames are transformed and counted natively
+    without being converted to pandas, see backends.py. They are only converted, one categorical per field,
+    to write a report of transformed rows.
     """
 
     def __init__(
@@ -30,7 +73,23 @@ class AssessDiversity:
         preferred_race_transformation,
         preferred_sex_transformation,
         preferred_ses_transformation,
+        profiler=None,
+        cache=None,
+        disclosure_control=None,
     ):
+        """
+        Args:
+            preferred_ethnicity_transformation: routine transforming the ethnicity column, eg: transform_nhs_ethnicity
+            preferred_race_transformation: routine transforming the race column, eg: transform_nhs_race
+            preferred_sex_transformation: routine transforming the sex column, eg: transform_nhs_sex
+            preferred_ses_transformation: routine transforming the ses column, eg: transform_ses_order
+            profiler (optional): a StageProfiler recording the time and memory of each stage of a report. The
+            records are written to diversity_report_profile.json next to the report.
+            cache (optional): a ReportCache that create_diversity_analysis_report reuses reports of the same
+            data and parameters from
+            disclosure_control (optional): a DisclosureControl protecting small groups of people in the
+            report and graphs. What it changes is written to diversity_disclosure_changes next to the report.
+        """
 
         # By default, this class assumes it is processing data coming from an NHS hospital.  It could be adapted
         # to support data sets from other countries (eg: USA) by developing other methods that recognised different
@@ -45,6 +104,10 @@ class AssessDiversity:
         self.age_lower_limit = 0
         self.age_upper_limit = 90
 
+        self.profiler = profiler if profiler is not None else NULL_PROFILER
+        self.cache = cache
+        self.disclosure_control = disclosure_control
+
     def transform(
         self,
         original_df,
@@ -55,6 +118,7 @@ class AssessDiversity:
         race_column_name,
         ses_column_name,
         is_deceased_column_name,
+        sort_rows=True,
     ):
         """
         Transform demographic dataframe
@@ -68,42 +132,218 @@ class AssessDiversity:
             race_column_name: column name in the input demographic data frame that describes race. (eg: 'race')
             ses_column_name: column name in the input demographic data frame that describes ses. (eg: 'ses')
             is_deceased_column_name: column name in the input demographic data frame that describes is deceased. (eg: 'is_deceased')
+            sort_rows (optional): whether to sort the rows by the first transformed column, defaults to True
+        Returns: a new data frame with the transformed columns. original_df is never modified: only the columns
+        used by the transformations are selected from it, once, before any transformation runs, and the
+        transformations then replace whole columns of that selection rather than copying it again. A pyarrow
+        Table or polars DataFrame gives a table of the same library with one dictionary (categorical)
+        column per field.
         """
-        df = original_df.copy()
-        df = create_age_bands(
-            df,
-            age_column_name,
-            self.age_lower_limit,
-            self.age_upper_limit,
-            years_per_age_band,
+        backend = backend_for(original_df)
+        if backend is not None:
+            return backend.from_arrow(
+                self._transform_table(
+                    backend,
+                    original_df,
+                    years_per_age_band,
+                    age_column_name,
+                    sex_column_name,
+                    ethnicity_column_name,
+                    race_column_name,
+                    ses_column_name,
+                    is_deceased_column_name,
+                    sort_rows,
+                )
+            )
+
+        used_column_names = _used_column_names(
+            original_df.columns,
+            [
+                age_column_name,
+                sex_column_name,
+                ethnicity_column_name,
+                race_column_name,
+                ses_column_name,
+                is_deceased_column_name,
+            ],
         )
-        if self.transform_sex_routine:
-            df = self.transform_sex_routine(df, sex_column_name)
-        if self.transform_ethnicity_routine:
-            df = self.transform_ethnicity_routine(df, ethnicity_column_name)
-        if self.transform_race_routine:
-            df = self.transform_race_routine(df, race_column_name)
-        if self.transform_ses_routine:
-            df = self.transform_ses_routine(df, ses_column_name)
-
-        # Masks the first list with the second list.
-        # keeping ses_column_name as socio-economic status can be measured in different ways
-
-        colname_dict = {
-            "age_band": age_column_name,
-            "sex": sex_column_name,
-            "ethnicity": ethnicity_column_name,
-            "race": race_column_name,
-            "is_deceased": is_deceased_column_name,
-            ses_column_name: ses_column_name,
-        }
-        all_columns_list = [
-            k for k, v in colname_dict.items() if v in df.columns.values
+        df = original_df[used_column_names]
+        row_count = len(df)
+        with self.profiler.stage("create_age_bands", rows=row_count):
+            df = create_age_bands(
+                df,
+                age_column_name,
+                self.age_lower_limit,
+                self.age_upper_limit,
+                years_per_age_band,
+            )
+        transform_routines = [
+            ("transform_sex", self.transform_sex_routine, sex_column_name),
+            (
+                "transform_ethnicity",
+                self.transform_ethnicity_routine,
+                ethnicity_column_name,
+            ),
+            ("transform_race", self.transform_race_routine, race_column_name),
+            ("transform_ses", self.transform_ses_routine, ses_column_name),
         ]
+        for stage_name, transform_routine, column_name in transform_routines:
+            if transform_routine:
+                with self.profiler.stage(stage_name, rows=row_count):
+                    df = transform_routine(df, column_name)
+
+        all_columns_list, rename_dict = _output_column_names(
+            df.columns.values,
+            age_column_name,
+            sex_column_name,
+            ethnicity_column_name,
+            race_column_name,
+            ses_column_name,
+            is_deceased_column_name,
+        )
+        df = df.rename(columns=rename_dict)
         df = df[all_columns_list]
-        df = df.sort_values(by=all_columns_list[0])
+        if sort_rows:
+            with self.profiler.stage("sort", rows=row_count):
+                df = df.sort_values(by=all_columns_list[0])
         return df
 
+    def _transform_rows(self, original_df, *transform_arguments, sort_rows=True):
+        """
+        transform, except that tables of other backends than pandas are left as Arrow tables, which keep
+        whether their categories are ordered, to be counted and written
+        """
+        backend = backend_for(original_df)
+        if backend is None:
+            return self.transform(
+                original_df, *transform_arguments, sort_rows=sort_rows
+            )
+        return self._transform_table(
+            backend, original_df, *transform_arguments, sort_rows
+        )
+
+    def _transform_table(
+        self,
+        backend,
+        original_table,
+        years_per_age_band,
+        age_column_name,
+        sex_column_name,
+        ethnicity_column_name,
+        race_column_name,
+        ses_column_name,
+        is_deceased_column_name,
+        sort_rows,
+    ):
+        """
+        transform of a table of another backend than pandas, as an Arrow table. Age bands and routines
+        mapping codes with a CodeLookup (the NHS routines and coding schemes) run on Arrow. Other routines are
+        given a pandas data frame of only the columns they may use, with text columns as categoricals.
+        """
+        table = backend.to_arrow(original_table)
+        table = backend.select(
+            table,
+            _used_column_names(
+                table.schema.names,
+                [
+                    age_column_name,
+                    sex_column_name,
+                    ethnicity_column_name,
+                    race_column_name,
+                    ses_column_name,
+                    is_deceased_column_name,
+                ],
+            ),
+        )
+        row_count = table.num_rows
+        with self.profiler.stage("create_age_bands", rows=row_count):
+            band_codes, band_labels = _present_categories(
+                *age_band_codes(
+                    backend.float_values(table, age_column_name),
+                    self.age_lower_limit,
+                    self.age_upper_limit,
+                    years_per_age_band,
+                )
+            )
+            table = backend.with_categorical(
+                table, "age_band", band_codes, band_labels, ordered=True
+            )
+        transform_routines = [
+            ("transform_sex", self.transform_sex_routine, sex_column_name),
+            (
+                "transform_ethnicity",
+                self.transform_ethnicity_routine,
+                ethnicity_column_name,
+            ),
+            ("transform_race", self.transform_race_routine, race_column_name),
+            ("transform_ses", self.transform_ses_routine, ses_column_name),
+        ]
+        for stage_name, transform_routine, column_name in transform_routines:
+            if not transform_routine:
+                continue
+            if column_name not in table.schema.names:
+                logger.info(f"No {column_name} field is present")
+                continue
+            with self.profiler.stage(stage_name, rows=row_count):
+                lookup = _routine_lookup(transform_routine)
+                if lookup is not None:
+                    value_codes, uniques, _ = backend.category_codes(
+                        table, column_name, lookup.integer_codes
+                    )
+                    label_codes, labels = lookup.map_codes(value_codes, uniques)
+                    table = backend.with_categorical(
+                        table, column_name, label_codes, labels, lookup.ordered
+                    )
+                else:
+                    df = backend.to_pandas(
+                        table, _used_column_names(table.schema.names, [column_name])
+                    )
+                    table = backend.with_pandas_column(
+                        table,
+                        column_name,
+                        transform_routine(df, column_name)[column_name],
+                    )
+
+        all_columns_list, rename_dict = _output_column_names(
+            table.schema.names,
+            age_column_name,
+            sex_column_name,
+            ethnicity_column_name,
+            race_column_name,
+            ses_column_name,
+            is_deceased_column_name,
+        )
+        table = backend.select(backend.rename(table, rename_dict), all_columns_list)
+        if sort_rows:
+            with self.profiler.stage("sort", rows=row_count):
+                table = backend.sort(table, all_columns_list[0])
+        return table
+
+    def report_parameters(self, years_per_band, column_names):
+        """
+        The settings, besides the data, that the results of a report depend on, eg: to tell whether saved
+        counts can be reused
+        Args:
+            years_per_band: number of years per age band
+            column_names: dictionary of field to column name, see load_column_names
+        Returns: a dictionary that can be saved as JSON
+        """
+        return {
+            "years_per_band": years_per_band,
+            "age_lower_limit": self.age_lower_limit,
+            "age_upper_limit": self.age_upper_limit,
+            "column_names": column_names,
+            "transform_routines": [
+                _routine_identity(routine)
+                for routine in (
+                    self.transform_sex_routine,
+                    self.transform_ethnicity_routine,
+                    self.transform_race_routine,
+                    self.transform_ses_routine,
+                )
+            ],
+        }
+
     def create_diversity_analysis_report(
         self,
         original_df,
@@ -115,6 +355,12 @@ class AssessDiversity:
         ses_column_name,
         is_deceased_column_name,
         output_directory_path,
+        graph_processes=None,
+        report_format="csv",
+        render_graphs=True,
+        report_type="rows",
+        sort_rows=True,
+        protect_counts=True,
     ):
         """
         The main routine to call from your own analysis for diversity.
@@ -128,10 +374,24 @@ class AssessDiversity:
             ses_column_name: column name that describes ses
             is_deceased_column_name: column name that describes if a person is deceased or not
             output_directory_path: directory where all the CSV and results will be stored.
+            graph_processes (optional): number of processes to render the graphs in at the same time
+            report_format (optional): format of the report of transformed rows: 'csv' (pipe delimited),
+            'parquet' (zstd compressed) or 'feather'. Parquet and Feather keep the categorical dtypes.
+            render_graphs (optional): whether to draw the graphs, defaults to True. When False only the
+            report is written and matplotlib and seaborn are never imported.
+            report_type (optional): 'rows' to write every transformed row to diversity_analysis_report, or
+            'aggregate' to only write the number of people per category (diversity_category_counts), per
+            pair of categories of two columns (diversity_pair_counts) and the missing values per column
+            (diversity_missing_counts). Aggregate reports stay small whatever the size of the cohort.
+            sort_rows (optional): whether to sort the rows of a 'rows' report, defaults to True
+            protect_counts (optional): with disclosure control, whether to return the protected counts, which
+            is the default, or the counts before protection, eg: to protect the counts of several reports
+            once they are merged. The report itself is protected either way.
+        Returns: the DiversityCounts the graphs were drawn from, which can be merged with the counts of
+        other reports
         """
-        df = original_df.copy()
-        cleaned_results_df = self.transform(
-            df,
+        _check_report_type(report_type)
+        report_arguments = (
             years_per_band,
             age_column_name,
             sex_column_name,
@@ -140,35 +400,575 @@ class AssessDiversity:
             ses_column_name,
             is_deceased_column_name,
         )
+        report_options = dict(
+            graph_processes=graph_processes,
+            report_format=report_format,
+            render_graphs=render_graphs,
+            report_type=report_type,
+            sort_rows=sort_rows,
+            protect_counts=protect_counts,
+        )
+        # only protected counts are saved in the cache
+        if self.cache is None or (
+            not protect_counts and self.disclosure_control is not None
+        ):
+            return self._create_report(
+                original_df, *report_arguments, output_directory_path, **report_options
+            )
+
+        column_names = dict(
+            zip(
+                ["age", "sex", "ethnicity", "race", "ses", "is_deceased"],
+                report_arguments[1:],
+            )
+        )
+        parameters = dict(
+            self.report_parameters(years_per_band, column_names),
+            report_format=report_format,
+            render_graphs=render_graphs,
+            report_type=report_type,
+            sort_rows=sort_rows,
+            disclosure_control=self.disclosure_control.settings()
+            if self.disclosure_control is not None
+            else None,
+        )
+        used_column_names = _used_column_names(
+            _column_names(original_df), report_arguments[1:]
+        )
+        backend = backend_for(original_df)
+        key = self.cache.key(
+            original_df[used_column_names]
+            if backend is None
+            else backend.to_pandas(backend.to_arrow(original_df), used_column_names),
+            parameters,
+        )
+        counts = self.cache.get(key, output_directory_path)
+        if counts is not None:
+            return counts
+
+        # the report is made in the cache, then copied out, so only its own files are cached
+        staging_directory_path = self.cache.staging_directory()
+        try:
+            counts = self._create_report(
+                original_df,
+                *report_arguments,
+                staging_directory_path,
+                **report_options,
+            )
+            copy_report_files(staging_directory_path, output_directory_path)
+            profile_file_path = os.path.join(staging_directory_path, PROFILE_FILE_NAME)
+            if os.path.exists(profile_file_path):
+                os.remove(profile_file_path)
+        except BaseException:
+            shutil.rmtree(staging_directory_path, ignore_errors=True)
+            raise
+        self.cache.put(key, staging_directory_path, counts)
+        return counts
+
+    def _create_report(
+        self,
+        original_df,
+        years_per_band,
+        age_column_name,
+        sex_column_name,
+        ethnicity_column_name,
+        race_column_name,
+        ses_column_name,
+        is_deceased_column_name,
+        output_directory_path,
+        graph_processes,
+        report_format,
+        render_graphs,
+        report_type,
+        sort_rows,
+        protect_counts,
+    ):
+        row_count = len(original_df)
+        with self.profiler.stage("report", rows=row_count):
+            with self.profiler.stage("transform", rows=row_count):
+                cleaned_results_df = self._transform_rows(
+                    original_df,
+                    years_per_band,
+                    age_column_name,
+                    sex_column_name,
+                    ethnicity_column_name,
+                    race_column_name,
+                    ses_column_name,
+                    is_deceased_column_name,
+                    sort_rows=sort_rows and report_type == "rows",
+                )
+
+            if not os.path.exists(output_directory_path):
+                os.makedirs(output_directory_path)
+
+            # Count before writing anything, so that small groups can be protected first. Change the boolean
+            # field from True False to make it easier to read in visual presentations
+            with self.profiler.stage("count_categories", rows=row_count):
+                counts = self._count_transformed(
+                    cleaned_results_df, years_per_band, original_df, ses_column_name
+                )
+                if "is_deceased" in counts.levels:
+                    counts = counts.rename_levels("is_deceased", IS_DECEASED_LABELS)
+            unprotected_counts = counts
+            disclosure_plan = self.apply_disclosure_control(
+                counts, ses_column_name, output_directory_path, report_format
+            )
+            if disclosure_plan is not None:
+                counts = disclosure_plan.counts
 
+            # Write results out to a file
+            if report_type == "rows":
+                cleaned_results_df = to_pandas(cleaned_results_df)
+                if disclosure_plan is not None:
+                    cleaned_results_df = disclosure_plan.protect_rows(
+                        cleaned_results_df
+                    )
+                with self.profiler.stage("write_report", rows=row_count):
+                    write_table(
+                        cleaned_results_df,
+                        _report_file_path(output_directory_path, report_format),
+                        sep="|",
+                    )
+
+            if report_type == "aggregate":
+                with self.profiler.stage("write_report"):
+                    write_aggregate_report(counts, output_directory_path, report_format)
+
+            if render_graphs:
+                with self.profiler.stage("build_graph"):
+                    build_graphs(
+                        counts, output_directory_path, graph_processes, self.profiler
+                    )
+        self.profiler.write_json(os.path.join(output_directory_path, PROFILE_FILE_NAME))
+        return counts if protect_counts else unprotected_counts
+
+    def count_categories(
+        self,
+        original_df,
+        years_per_age_band,
+        age_column_name,
+        sex_column_name,
+        ethnicity_column_name,
+        race_column_name,
+        ses_column_name,
+        is_deceased_column_name,
+    ):
+        """
+        Transforms demographic data and counts the people in each combination of the transformed columns.
+        Counts of separate chunks of the same data can be merged with DiversityCounts.merge.
+        Args: the same as transform
+        Returns: a DiversityCounts over the transformed columns
+        """
+        # counts do not depend on the order of the rows
+        df = self._transform_rows(
+            original_df,
+            years_per_age_band,
+            age_column_name,
+            sex_column_name,
+            ethnicity_column_name,
+            race_column_name,
+            ses_column_name,
+            is_deceased_column_name,
+            sort_rows=False,
+        )
+        return self._count_transformed(
+            df, years_per_age_band, original_df, ses_column_name
+        )
+
+    def _count_transformed(
+        self, transformed_df, years_per_age_band, original_df=None, ses_column_name=None
+    ):
+        _, labels = _age_band_table(
+            self.age_lower_limit, self.age_upper_limit, years_per_age_band
+        )
+        backend = backend_for(transformed_df)
+        if backend is not None:
+            counts = _count_table(backend, backend.to_arrow(transformed_df), labels)
+        else:
+            df = transformed_df
+            if "age_band" in df:
+                # every chunk keeps the full band table so that bands of merged counts stay in order
+                df = df.assign(age_band=df["age_band"].cat.set_categories(labels))
+            counts = DiversityCounts.from_frame(df)
+        level_ranks = self._ses_level_ranks(original_df, ses_column_name)
+        if level_ranks is not None and ses_column_name in counts.levels:
+            # chunks missing some ses levels are merged in ses_level order
+            counts = counts.rank_levels(ses_column_name, level_ranks)
+        return counts
+
+    def _ses_level_ranks(self, original_df, ses_column_name):
+        """
+        Returns: the ranks of the ses levels of the input data when they are ordered by transform_ses_order,
+        otherwise None
+        """
+        if original_df is None or self.transform_ses_routine is not transform_ses_order:
+            return None
+        column_names = _column_names(original_df)
+        if ses_column_name not in column_names or "ses_level" not in column_names:
+            return None
+        backend = backend_for(original_df)
+        if backend is not None:
+            original_df = backend.to_pandas(
+                backend.to_arrow(original_df), ["ses_level", ses_column_name]
+            )
+        return ses_level_ranks(original_df, ses_column_name)
+
+    def create_diversity_analysis_report_from_chunks(
+        self,
+        chunks,
+        years_per_band,
+        age_column_name,
+        sex_column_name,
+        ethnicity_column_name,
+        race_column_name,
+        ses_column_name,
+        is_deceased_column_name,
+        output_directory_path,
+        graph_processes=None,
+        report_format="csv",
+        render_graphs=True,
+        report_type="rows",
+        sort_rows=True,
+        protect_counts=True,
+    ):
+        """
+        Streaming version of create_diversity_analysis_report for data that does not fit in memory, eg: the
+        chunks returned by pd.read_csv(path, chunksize=100000). Each chunk is transformed, appended to the
+        report and counted, and the graphs are drawn from the merged counts. Rows in the report are sorted
+        within each chunk only. With disclosure control the rows are first appended to a staging file, which
+        is protected one chunk at a time into the report once every chunk is counted. The 'feather'
+        report_format is only supported by 'aggregate' reports, which are written once all chunks are counted.
+        Args:
+            chunks: an iterable of demographic data frames
+            other arguments: the same as create_diversity_analysis_report
+        Returns: the merged DiversityCounts
+        """
+        _check_report_type(report_type)
         if not os.path.exists(output_directory_path):
             os.makedirs(output_directory_path)
+        counts = None
+        with contextlib.ExitStack() as exit_stack:
+            report_record = exit_stack.enter_context(self.profiler.stage("report"))
+            report_writer = None
+            report_file_path = _report_file_path(output_directory_path, report_format)
+            if report_type == "rows":
+                # small groups are only known once every chunk is counted
+                if self.disclosure_control is not None:
+                    report_file_path = _report_file_path(
+                        output_directory_path,
+                        report_format,
+                        UNPROTECTED_REPORT_FILE_NAME,
+                    )
+                    # the unprotected rows are never left behind, even if the report fails
+                    exit_stack.callback(_remove_file, report_file_path)
+                report_writer = exit_stack.enter_context(
+                    ChunkedTableWriter(report_file_path, sep="|")
+                )
+            row_count = 0
+            largest_chunk_row_count = 0
+            for chunk_number, chunk_df in enumerate(chunks):
+                chunk_row_count = len(chunk_df)
+                row_count += chunk_row_count
+                largest_chunk_row_count = max(largest_chunk_row_count, chunk_row_count)
+                with self.profiler.stage("transform", rows=chunk_row_count):
+                    cleaned_chunk_df = self._transform_rows(
+                        chunk_df,
+                        years_per_band,
+                        age_column_name,
+                        sex_column_name,
+                        ethnicity_column_name,
+                        race_column_name,
+                        ses_column_name,
+                        is_deceased_column_name,
+                        sort_rows=sort_rows and report_writer is not None,
+                    )
+                if report_writer is not None:
+                    with self.profiler.stage("write_report", rows=chunk_row_count):
+                        report_writer.write(to_pandas(cleaned_chunk_df))
+                with self.profiler.stage("count_categories", rows=chunk_row_count):
+                    chunk_counts = self._count_transformed(
+                        cleaned_chunk_df, years_per_band, chunk_df, ses_column_name
+                    )
+                    counts = (
+                        chunk_counts if counts is None else counts.merge(chunk_counts)
+                    )
+                logger.debug(f"Processed chunk {chunk_number} of {chunk_row_count} rows")
+            report_record["rows"] = row_count
+
+            if report_writer is not None:
+                report_writer.close()
+
+            if counts is not None:
+                if "is_deceased" in counts.levels:
+                    counts = counts.rename_levels("is_deceased", IS_DECEASED_LABELS)
+                unprotected_counts = counts
+                disclosure_plan = self.apply_disclosure_control(
+                    counts, ses_column_name, output_directory_path, report_format
+                )
+                if disclosure_plan is not None:
+                    counts = disclosure_plan.counts
+                    if report_writer is not None:
+                        with self.profiler.stage("write_report", rows=row_count):
+                            disclosure_plan.protect_file(
+                                report_file_path,
+                                _report_file_path(output_directory_path, report_format),
+                                largest_chunk_row_count,
+                            )
+                if report_type == "aggregate":
+                    with self.profiler.stage("write_report"):
+                        write_aggregate_report(
+                            counts, output_directory_path, report_format
+                        )
+
+                if render_graphs:
+                    with self.profiler.stage("build_graph"):
+                        build_graphs(
+                            counts,
+                            output_directory_path,
+                            graph_processes,
+                            self.profiler,
+                        )
+        self.profiler.write_json(os.path.join(output_directory_path, PROFILE_FILE_NAME))
+
+        if counts is None:
+            logger.warning("No data to assess")
+            return None
+        return counts if protect_counts else unprotected_counts
 
-        # Write results out to a file
-        csv_output_file_path = os.path.join(
-            output_directory_path, "diversity_analysis_report.csv"
+    def apply_disclosure_control(
+        self, counts, ses_column_name, output_directory_path, report_format="csv"
+    ):
+        """
+        Protects the small groups of people in counts with the disclosure control of this instance, if any,
+        and writes what it changed to diversity_disclosure_changes in the output directory
+        Args:
+            counts: the DiversityCounts of the transformed data
+            ses_column_name: column name that describes ses
+            output_directory_path: directory where the table of changes will be stored
+            report_format (optional): 'csv' (pipe delimited), 'parquet' or 'feather'
+        Returns: a DisclosurePlan holding the protected counts, or None without disclosure control
+        """
+        if self.disclosure_control is None:
+            return None
+        with self.profiler.stage("disclosure_control"):
+            # the rows still hold the is_deceased values the counts were relabelled from
+            disclosure_plan = self.disclosure_control.protect(
+                counts, ses_column_name, {"is_deceased": IS_DECEASED_LABELS}
+            )
+            write_disclosure_report(
+                disclosure_plan, output_directory_path, report_format
+            )
+        return disclosure_plan
+
+
+def write_aggregate_report(counts, output_directory_path, report_format="csv"):
+    """
+    Writes the tables of an 'aggregate' report: the number of people per category of each column, per pair
+    of categories of every two columns and the number of missing values per column. Missing categories are
+    labelled 'not provided'.
+    Args:
+        counts: the DiversityCounts of the transformed data
+        output_directory_path: directory where the tables will be stored
+        report_format (optional): 'csv' (pipe delimited), 'parquet' or 'feather'
+    """
+    for table_name, file_name in AGGREGATE_REPORT_FILE_NAMES.items():
+        if table_name == "missing_table":
+            table_df = counts.missing_table()
+        else:
+            table_df = getattr(counts, table_name)(MISSING_LABEL)
+        write_table(
+            table_df,
+            _report_file_path(output_directory_path, report_format, file_name),
+            sep="|",
         )
-        cleaned_results_df.to_csv(
-            csv_output_file_path, sep="|", encoding="utf-8", index=False,
+
+
+def _check_report_type(report_type):
+    if report_type not in REPORT_TYPES:
+        raise ValueError(
+            f"Unknown report type {report_type}, expected one of {list(REPORT_TYPES)}"
         )
 
-        # Write out graphs. Change the boolean field from True False to make it easier to read in visual
-        # presentations
-        if "is_deceased" in cleaned_results_df:
-            cleaned_results_df["is_deceased"] = cleaned_results_df[
-                "is_deceased"
-            ].astype(str)
-            cleaned_results_df["is_deceased"] = cleaned_results_df[
-                "is_deceased"
-            ].replace({"True": "Yes", "False": "No"}, regex=False)
 
-        grapher = GraphUtility(cleaned_results_df, output_directory_path)
-        grapher.build_graph()
+def build_graphs(
+    counts, output_directory_path, graph_processes=None, profiler=NULL_PROFILER
+):
+    """
+    Draws the graphs of a report from its counts, eg: the merged counts of several sites or chunks
+    Args:
+        counts: a DiversityCounts
+        output_directory_path: directory where the graphs will be stored
+        graph_processes (optional): number of processes to render the graphs in at the same time
+        profiler (optional): a StageProfiler recording the time each graph takes
+    """
+    # matplotlib and seaborn take a while to import, so they are only loaded once a graph is drawn
+    from diversity_analysis_tool.graph_construction import GraphUtility
+
+    grapher = GraphUtility(None, output_directory_path, counts=counts, profiler=profiler)
+    grapher.build_graph(processes=graph_processes)
+
+
+def _remove_file(file_path):
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+def _used_column_names(available_column_names, column_names):
+    # 'ses_level' is not passed in by name but is used to order the ses levels when present
+    return [
+        column_name
+        for column_name in dict.fromkeys(list(column_names) + ["ses_level"])
+        if column_name is not None and column_name in available_column_names
+    ]
+
+
+def _column_names(df):
+    backend = backend_for(df)
+    return df.columns if backend is None else backend.column_names(df)
+
+
+def _output_column_names(
+    available_column_names,
+    age_column_name,
+    sex_column_name,
+    ethnicity_column_name,
+    race_column_name,
+    ses_column_name,
+    is_deceased_column_name,
+):
+    """
+    Returns: the names of the transformed columns present, in report order, and the dictionary renaming
+    the input columns to them
+    """
+    # keeping ses_column_name as socio-economic status can be measured in different ways
+    colname_dict = {
+        "age_band": age_column_name,
+        "sex": sex_column_name,
+        "ethnicity": ethnicity_column_name,
+        "race": race_column_name,
+        "is_deceased": is_deceased_column_name,
+        ses_column_name: ses_column_name,
+    }
+    all_columns_list = [
+        k for k, v in colname_dict.items() if v in available_column_names
+    ]
+    # transformed columns are named after what they describe, whatever they are called in the input
+    rename_dict = {
+        v: k
+        for k, v in colname_dict.items()
+        if k != "age_band" and k in all_columns_list
+    }
+    return all_columns_list, rename_dict
+
+
+def _count_table(backend, table, age_band_labels):
+    """counts a transformed Arrow table from the dictionary indices of its columns, see DiversityCounts.from_frame"""
+    levels, codes, categorical, ordered = {}, {}, {}, {}
+    for column_name in table.schema.names:
+        column_codes, uniques, column_ordered = backend.category_codes(
+            table, column_name
+        )
+        categorical[column_name] = backend.is_categorical(table, column_name)
+        if column_name == "age_band":
+            # every chunk keeps the full band table so that bands of merged counts stay in order
+            column_codes = _recode(
+                column_codes, pd.Index(age_band_labels).get_indexer(uniques)
+            )
+            uniques = pd.Index(age_band_labels)
+        elif not categorical[column_name]:
+            try:
+                order = uniques.argsort()
+            except TypeError:
+                # mixed types (eg: True and 'True') cannot be sorted
+                order = np.arange(len(uniques))
+            column_codes = _recode(column_codes, np.argsort(order))
+            uniques = uniques[order]
+        levels[column_name] = uniques
+        codes[column_name] = column_codes
+        ordered[column_name] = column_ordered
+    return DiversityCounts.from_codes(
+        levels, codes, categorical, ordered, row_count=table.num_rows
+    )
+
+
+def _recode(codes, positions):
+    """the codes of values at new positions, missing values (-1) stay missing"""
+    return np.where(codes >= 0, np.append(positions, -1)[codes], -1)
+
+
+def _routine_lookup(routine):
+    """the CodeLookup a transform routine maps its column with, or None if it does something else"""
+    if isinstance(routine, SchemeTransform):
+        return routine.scheme.lookups[routine.field]
+    field = _NHS_ROUTINE_FIELDS.get(routine)
+    if field is not None:
+        return BUILT_IN_SCHEMES["nhs"].lookups[field]
+    return None
+
+
+def _routine_identity(routine):
+    """
+    the name of a transform routine with a hash of its code, and of the code tables of the NHS scheme for
+    the NHS routines, so that editing a routine or a code table it maps with changes it
+    """
+    if routine is None:
+        return None
+    name = f"{getattr(routine, '__module__', '')}.{getattr(routine, '__qualname__', repr(routine))}"
+    code = getattr(routine, "__code__", None)
+    if code is None:
+        return name
+    code_hash = hashlib.sha256()
+    _hash_code(code, code_hash)
+    if routine in _NHS_ROUTINE_FIELDS:
+        # the code tables live in nhs_codes rather than in the code of the routine
+        code_hash.update(BUILT_IN_SCHEMES["nhs"].digest().encode("utf-8"))
+    return f"{name}:{code_hash.hexdigest()[:16]}"
+
+
+def _hash_code(code, code_hash):
+    code_hash.update(code.co_code)
+    for constant in code.co_consts:
+        # nested functions are code objects, whose repr holds a memory address
+        if hasattr(constant, "co_code"):
+            _hash_code(constant, code_hash)
+        else:
+            code_hash.update(repr(constant).encode("utf-8"))
+
+
+def _report_file_path(
+    output_directory_path, report_format, file_name="diversity_analysis_report"
+):
+    if report_format not in REPORT_FILE_EXTENSIONS:
+        raise ValueError(
+            f"Unknown report format {report_format}, expected one of {list(REPORT_FILE_EXTENSIONS)}"
+        )
+    return os.path.join(
+        output_directory_path, file_name + REPORT_FILE_EXTENSIONS[report_format]
+    )
 
 
 # ==========================
 # Age Transformation Methods
 # ==========================
+@functools.lru_cache(maxsize=None)
+def _age_band_table(start_age, end_age, years_per_band):
+    """
+    Computes the band edges and labels used by create_age_bands. The table only depends on the band
+    parameters, so it is built once and shared by every call using them.
+    Args:
+        start_age: minimum age in the age bands
+        end_age: the maximum upper limit for an age
+        years_per_band: the interval in an age band
+    Returns: a tuple of the band edges as a numpy array and the band labels, eg: '0 - 5', ..., '90plus'
+    """
+    edges = np.arange(start_age, end_age + 1, years_per_band, dtype="float64")
+    edges.setflags(write=False)
+    labels = [
+        "%d - %d" % (edges[i], edges[i + 1]) for i in range(len(edges) - 1)
+    ] + ["%dplus" % edges[-1]]
+    return edges, tuple(labels)
+
+
 def create_age_bands(
     original_df, age_field_name, start_age=0, end_age=90, years_per_band=5
 ):
@@ -187,48 +987,70 @@ def create_age_bands(
         years_per_band: the interval in an age band
     Returns: a data frame with a new column called 'age_band'
     """
-    df = original_df.copy()
+    # a shallow copy is enough as the new column is added to the copy only
+    df = original_df.copy(deep=False)
 
     banded_field_name = "age_band"
 
-    bin_buckets = [item for item in range(start_age, end_age + 1, years_per_band)]
-    bin_buckets.append(999)
-    lbs = [
-        "(%d, %d]" % (bin_buckets[i], bin_buckets[i + 1])
-        for i in range(len(bin_buckets) - 1)
-    ]
+    codes, labels = age_band_codes(
+        df[age_field_name].to_numpy(dtype="float64", na_value=np.nan),
+        start_age,
+        end_age,
+        years_per_band,
+    )
 
-    df[banded_field_name] = pd.cut(
-        x=df[age_field_name], bins=bin_buckets, labels=lbs, include_lowest=True
-    ).astype(str)
-    df[banded_field_name] = df[banded_field_name].str.strip()
+    # only the bands present in the data are kept, in the order of the label table, for visualisation later
+    df[banded_field_name] = pd.Categorical.from_codes(
+        codes, categories=labels, ordered=True
+    ).remove_unused_categories()
 
-    current_last_band_name = f"({end_age}, 999]"
-    last_band_name = f"({end_age}plus]"
+    return df
 
-    df[banded_field_name] = df[banded_field_name].replace(
-        current_last_band_name, last_band_name, regex=False
-    )
 
-    df[banded_field_name] = df[banded_field_name].astype(str)
-    df[banded_field_name] = df[banded_field_name].apply(
-        lambda x: str(x[x.find("(") + 1 : x.find("]")])
-    )
-    df[banded_field_name] = df[banded_field_name].apply(lambda x: x.replace(",", " -"))
-
-    # the bands need to be ordered by first age in range for visualisation later
-    order = df[df[banded_field_name] != "na"][banded_field_name].unique()
-    sorted_idx = np.argsort([int(x[:2]) for x in order])
-    new_order = order[sorted_idx]
-    # fix order for the column
-    df[banded_field_name] = pd.Categorical(
-        df[banded_field_name], categories=new_order, ordered=True
-    )
+def age_band_codes(ages, start_age=0, end_age=90, years_per_band=5):
+    """
+    The age band of each age as a position in the band labels, see create_age_bands
+    Args:
+        ages: float numpy array of ages, with missing ages as NaN
+        start_age, end_age, years_per_band (optional): see create_age_bands
+    Returns: a tuple of the integer array of the band of each age (-1 when missing) and the band labels
+    """
+    edges, labels = _age_band_table(start_age, end_age, years_per_band)
 
-    # remove the string 'na' and replace with numpy nan so that missing rates can be computed later
-    df[banded_field_name] = df[banded_field_name].replace("na", np.nan)
+    # Bands are closed on the right, like (30, 35], with the first band also including start_age. Anything
+    # above the last edge falls in the '[end]plus' band; missing ages and ages below start_age get code -1.
+    codes = np.searchsorted(edges, ages, side="left") - 1
+    codes[ages == edges[0]] = 0
+    codes[np.isnan(ages) | (ages < edges[0])] = -1
+    return codes, labels
 
-    return df
+
+def _present_categories(codes, labels):
+    """only the labels which some row has, in the same order, like Categorical.remove_unused_categories"""
+    present = np.bincount(codes[codes >= 0], minlength=len(labels)) > 0
+    positions = np.cumsum(present) - 1
+    return _recode(codes, positions), [
+        label for label, is_present in zip(labels, present) if is_present
+    ]
+
+
+# =====================================
+# Coded Column Transformation Methods
+# =====================================
+def map_codes_to_categorical(values, code_dict, missing_label, missing_codes=()):
+    """
+    Maps a column of source codes to a pandas Categorical whose categories are the labels in code_dict.
+    Each distinct value is matched once against the dictionary keys and the codes of the rows are
+    translated to label codes with an array lookup, see CodeLookup. Codes which are not in code_dict keep
+    their own value as a label so that they still show up in the report.
+    Args:
+        values: a series of source codes (eg: the 'ethnicity' column)
+        code_dict: dictionary of source code to label (eg: NHS_ETHNICITY_CODE_DICT)
+        missing_label: label given to empty values (eg: 'Unknown'). If None empty values stay missing.
+        missing_codes (optional): source codes which should also be treated as empty values (eg: '')
+    Returns: a Categorical of labels
+    """
+    return CodeLookup(code_dict, missing_label, missing_codes).map(values)
 
 
 # =====================================
@@ -243,24 +1065,18 @@ def transform_nhs_sex(original_df, sex_column_name):
     Args:
         original_df:  original demographic data frame
         sex_column_name: the name of the column in the input data describing sex (eg: 'sex')
-    Returns: a data frame where the sex column has words instead of numeric codes
+    Returns: a data frame where the sex column is a categorical of words instead of numeric codes
     """
     if not sex_column_name in original_df:
         logger.info("No sex field is present")
         return original_df
 
-    df = original_df.copy()
+    df = original_df.copy(deep=False)
 
-    df[sex_column_name] = df[sex_column_name].astype("Int64")
-    df[sex_column_name] = df[sex_column_name].replace(np.nan, -1, regex=True)
-    df[sex_column_name] = df[sex_column_name].astype(str)
-    replace_dict = {
-        "1": "Male",
-        "2": "Female",
-        "8": "Not specified",
-        "-1": "Unknown",
-    }
-    df[sex_column_name] = df[sex_column_name].replace(replace_dict, regex=False)
+    # the code table of the nhs scheme is compiled once and shared by every call
+    df[sex_column_name] = (
+        BUILT_IN_SCHEMES["nhs"].lookups["sex"].map(df[sex_column_name])
+    )
     return df
 
 
@@ -279,17 +1095,15 @@ def transform_desktop_application_database_sex(original_df, sex_column_name):
         logger.info("No sex field is present")
         return original_df
 
-    df = original_df.copy()
-    df[sex_column_name] = df[sex_column_name].astype("Int64")
-    df[sex_column_name] = df[sex_column_name].replace(np.nan, -1, regex=True)
-    df[sex_column_name] = df[sex_column_name].astype(str)
+    df = original_df.copy(deep=False)
     replace_dict = {
-        "-1": "Unknown",
-        "1": "Male",
-        "2": "Female",
-        "8": "Not specified",
+        1: "Male",
+        2: "Female",
+        8: "Not specified",
     }
-    df[sex_column_name] = df[sex_column_name].replace(replace_dict, regex=False)
+    df[sex_column_name] = map_codes_to_categorical(
+        integer_codes(df[sex_column_name]), replace_dict, "Unknown"
+    )
     return df
 
 
@@ -304,16 +1118,12 @@ def transform_nhs_ethnicity(df, ethnicity_column_name):
     Args:
         df: demographic data frame
         ethnicity_column_name: the name of the column in the input data that describes ethnicity
-    Returns: Dataframe with updated ethnicity column
+    Returns: Dataframe with updated ethnicity column as a categorical
 
     """
-    df1 = df.copy()
-    df1[ethnicity_column_name] = df[ethnicity_column_name].replace(
-        "", np.nan, regex=True
-    )
-    df1[ethnicity_column_name].fillna("Unknown", inplace=True)
-    df1[ethnicity_column_name] = df1[ethnicity_column_name].apply(
-        lambda x: NHS_ETHNICITY_CODE_DICT[x]
+    df1 = df.copy(deep=False)
+    df1[ethnicity_column_name] = (
+        BUILT_IN_SCHEMES["nhs"].lookups["ethnicity"].map(df[ethnicity_column_name])
     )
     return df1
 
@@ -329,14 +1139,16 @@ def transform_nhs_race(df, race_column_name):
     Args:
         df: demographic data
         race_column_name: the column name in the demographic data that describes race
-    Returns: Dataframe with updated race column
+    Returns: Dataframe with updated race column as a categorical
     """
     if not race_column_name:
-        print("There is no race column")
+        logger.info("No race field is present")
         return df
 
-    df[race_column_name].fillna("Unknown", inplace=True)
-    df[race_column_name] = df[race_column_name].apply(lambda x: NHS_RACE_CODE_DICT[x])
+    df = df.copy(deep=False)
+    df[race_column_name] = (
+        BUILT_IN_SCHEMES["nhs"].lookups["race"].map(df[race_column_name])
+    )
     return df
 
 
@@ -351,10 +1163,45 @@ def transform_ses_order(df, ses_column_name):
     if "ses_level" not in df.columns.values:
         return df
 
-    # ordering the levels by ses_level:
-    level_order = sorted(set(zip(df.ses_level, df[ses_column_name])))
-    level_order = [lev[1] for lev in level_order]
-    df[ses_column_name] = df[ses_column_name].astype("category")
-    df[ses_column_name].cat.reorder_categories(level_order, inplace=True)
+    level_order = list(ses_level_ranks(df, ses_column_name))
+    df = df.copy(deep=False)
+    ses_categorical = df[ses_column_name].astype("category")
+    # categories of a categorical input that are not in the data go last
+    unused_categories = [
+        category
+        for category in ses_categorical.cat.categories
+        if category not in set(level_order)
+    ]
+    df[ses_column_name] = ses_categorical.cat.reorder_categories(
+        level_order + unused_categories
+    )
 
     return df
+
+
+def ses_level_ranks(df, ses_column_name):
+    """
+    The lowest ses_level of each ses level, which ranks the levels in the order transform_ses_order puts
+    them in (by ses_level, then by label). Missing values are left out.
+    Args:
+        df: demographic data with a ses_level column
+        ses_column_name: the column name in the demographic data that describes socio-economic status
+    Returns: dictionary of ses level to its lowest ses_level value, in transform_ses_order order
+    """
+    level_pairs = (
+        df[["ses_level", ses_column_name]]
+        .dropna()
+        .drop_duplicates()
+        .sort_values(["ses_level", ses_column_name])
+        .drop_duplicates(ses_column_name)
+    )
+    return dict(zip(level_pairs[ses_column_name], level_pairs["ses_level"]))
+
+
+# The fields of the NHS scheme mapped by the NHS transform routines, which let tables of other backends than
+# pandas be mapped without calling the routines
+_NHS_ROUTINE_FIELDS = {
+    transform_nhs_sex: "sex",
+    transform_nhs_ethnicity: "ethnicity",
+    transform_nhs_race: "race",
+}
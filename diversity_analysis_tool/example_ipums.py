@@ -1,7 +1,7 @@
 import logging
 
 from diversity_analysis_tool.diversity import AssessDiversity
-from diversity_analysis_tool.diversity import GraphUtility
+from diversity_analysis_tool.graph_construction import GraphUtility
 
 import pandas as pd
 
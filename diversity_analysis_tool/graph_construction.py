@@ -1,26 +1,69 @@
 import os
+import time
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+from diversity_analysis_tool.aggregates import DiversityCounts
+from diversity_analysis_tool.profiling import NULL_PROFILER
+
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+_graph_style_is_set = False
+
 
 class GraphUtility:
     # =============
     # Graph Methods
     # =============
-    def __init__(self, df, output_directory_path):
+    def __init__(self, df, output_directory_path, counts=None, profiler=None):
+        """
+        Args:
+            df: transformed demographic data frame, can be None when counts are given
+            output_directory_path: directory where the graphs will be stored
+            counts (optional): a DiversityCounts to draw the graphs from instead of df, eg: the merged
+            counts of a file read in chunks
+            profiler (optional): a StageProfiler recording the time taken to render each graph
+        """
         self.df = df
         self.output_directory_path = output_directory_path
+        # every graph is a sum over one table of counts, so the rows of df are only grouped once
+        self.counts = counts if counts is not None else DiversityCounts.from_frame(df)
+        self.profiler = profiler if profiler is not None else NULL_PROFILER
+        self._executor = None
+        self._pending_renders = []
 
-    def build_graph(self):
+    def build_graph(self, processes=None):
         """this function collects columns with predifined column names and maps
-        through a dictionary of graphing functions"""
+        through a dictionary of graphing functions
+
+        Args:
+            processes (optional): number of processes to render the graphs in at the same time. If none
+            the graphs are rendered one after another in this process.
+        """
+        if processes and processes > 1:
+            with ProcessPoolExecutor(
+                max_workers=processes, initializer=set_graph_style
+            ) as executor:
+                self._executor = executor
+                try:
+                    self._build_graphs()
+                finally:
+                    self._executor = None
+                pending_renders, self._pending_renders = self._pending_renders, []
+                for graph_name, pending_render in pending_renders:
+                    # raises any error from the worker process
+                    seconds = pending_render.result()
+                    self.profiler.add_record(graph_name, seconds)
+        else:
+            self._build_graphs()
+
+    def _build_graphs(self):
 
         colname_dict = {
             "age_band": "Age Band",
@@ -29,10 +72,10 @@ class GraphUtility:
             "sex": "Sex",
         }
         colname_dict = {
-            k: v for k, v in colname_dict.items() if k in self.df.columns.values
+            k: v for k, v in colname_dict.items() if k in self._column_names()
         }
         # Add missing colnames
-        missing_cols = list(set(self.df.columns.values) - set(colname_dict.keys()))
+        missing_cols = list(set(self._column_names()) - set(colname_dict.keys()))
         colname_dict.update({colname: colname for colname in missing_cols})
 
         # Plot individual feature graphs
@@ -44,7 +87,7 @@ class GraphUtility:
             )
 
         # Two variable graphs
-        if set(["age_band", "ethnicity"]).issubset(self.df.columns.values):
+        if set(["age_band", "ethnicity"]).issubset(self._column_names()):
             self.generate_stacked_bar_graph(
                 "age_band",
                 "ethnicity",
@@ -52,7 +95,7 @@ class GraphUtility:
                 colname_dict["age_band"],
                 colname_dict["ethnicity"],
             )
-        if set(["age_band", "race"]).issubset(self.df.columns.values):
+        if set(["age_band", "race"]).issubset(self._column_names()):
             self.generate_stacked_bar_graph(
                 "age_band",
                 "race",
@@ -60,7 +103,7 @@ class GraphUtility:
                 colname_dict["age_band"],
                 colname_dict["race"],
             )
-        if set(["race", "sex"]).issubset(self.df.columns.values):
+        if set(["race", "sex"]).issubset(self._column_names()):
             self.generate_stacked_bar_graph(
                 "race",
                 "sex",
@@ -68,7 +111,7 @@ class GraphUtility:
                 colname_dict["race"],
                 colname_dict["sex"],
             )
-        if set(["ethnicity", "sex"]).issubset(self.df.columns.values):
+        if set(["ethnicity", "sex"]).issubset(self._column_names()):
             self.generate_stacked_bar_graph(
                 "ethnicity",
                 "sex",
@@ -76,7 +119,7 @@ class GraphUtility:
                 colname_dict["ethnicity"],
                 colname_dict["sex"],
             )
-        if set(["age_band", "sex"]).issubset(self.df.columns.values):
+        if set(["age_band", "sex"]).issubset(self._column_names()):
             self.generate_stacked_bar_graph(
                 "age_band",
                 "sex",
@@ -102,32 +145,22 @@ class GraphUtility:
         """
 
         missing_rates = pd.DataFrame(
-            self.df[colname_dict.keys()].isna().sum(axis=0)
+            self._missing_counts(list(colname_dict.keys()))
         ).rename(colname_dict)
 
         if show_fraction:
-            missing_rates = missing_rates / self.df.shape[0]
-            plt.xlim(0, 1)
-
-        sns.set(
-            style="whitegrid",
-            palette="colorblind",
-            font="DejaVu Sans",
-            font_scale=1,
-            color_codes=True,
-        )
-
-        missing_rates.plot(kind="barh", stacked=False, legend=False)
-
-        plt.xticks(rotation=-45)
-        if x_label:
-            plt.xlabel(x_label)
-        if y_label:
-            plt.ylabel(y_label)
+            missing_rates = missing_rates / self._row_count()
 
         file_path = os.path.join(self.output_directory_path, f"Missingness_bar_chart")
-        plt.savefig(file_path, bbox_inches="tight")
-        logger.info(f"successfully saved missingness bar graph")
+        self._render(
+            os.path.basename(file_path),
+            render_missing_rates,
+            missing_rates,
+            file_path,
+            x_label,
+            y_label,
+            show_fraction,
+        )
 
     def generate_bar_graph(self, column_name, x_label=None, y_label=None):
         """
@@ -137,25 +170,19 @@ class GraphUtility:
             x_label (optional): label for x axis. If none no x-axis label is shown.
             y_label (optional): label for y axis. If none the major_category_column_name is used as label
         """
-        sns.set(
-            style="whitegrid",
-            palette="colorblind",
-            font="DejaVu Sans",
-            font_scale=1,
-            color_codes=True,
-        )
-        self.df[column_name].sort_values(
-            na_position="last", ascending=False
-        ).value_counts(sort=False).plot(kind="barh", stacked=False, edgecolor="none")
-        plt.xticks(rotation=-45)
-        if x_label:
-            plt.xlabel(x_label)
-        if y_label:
-            plt.ylabel(y_label)
+        counts = self._column_counts(column_name)
+        # categorical columns count every category, only the ones present in the data are shown
+        counts = counts[counts > 0]
 
         file_path = os.path.join(self.output_directory_path, f"{column_name}_bar_chart")
-        plt.savefig(file_path, bbox_inches="tight")
-        logger.info(f"successfully saved {column_name} bar graph")
+        self._render(
+            os.path.basename(file_path),
+            render_bar_graph,
+            counts,
+            file_path,
+            x_label,
+            y_label,
+        )
 
     def generate_stacked_bar_graph(
         self,
@@ -176,6 +203,85 @@ class GraphUtility:
             y_label (optional): label for y axis. If none the major_category_column_name is used as label
             legend_title (optional): title for legend. If none the minor_category_column_name is used as  title
         """
+        results_df = self._pair_counts(
+            major_category_column_name, minor_category_column_name, "not provided"
+        )
+        all_df = pd.DataFrame(results_df["All"]).T.drop(columns="All")
+        filtered = results_df.drop(labels="All").drop(columns=["All"])
+        # removing index name so it doesn't appear as label 'all'
+        all_df.index = [""]
+
+        file_paths = [
+            os.path.join(
+                self.output_directory_path,
+                f"{major_category_column_name}_{minor_category_column_name}_stacked_bar_chart",
+            ),
+            os.path.join(
+                self.output_directory_path,
+                f"{major_category_column_name}_stacked_bar_chart",
+            ),
+        ]
+        self._render(
+            os.path.basename(file_paths[0]),
+            render_stacked_bar_graphs,
+            filtered,
+            all_df,
+            file_paths,
+            x_label,
+            y_label,
+            legend_title,
+        )
+
+    def _render(self, graph_name, render_function, *args):
+        """runs a render function straight away or, while build_graph uses a process pool, in the pool"""
+        if self._executor is None:
+            with self.profiler.stage(graph_name):
+                render_function(*args)
+        else:
+            self._pending_renders.append(
+                (graph_name, self._executor.submit(_timed, render_function, *args))
+            )
+
+    # ===================
+    # Graph Data Methods
+    # ===================
+    def _column_names(self):
+        return np.array(self.counts.column_names)
+
+    def _row_count(self):
+        return self.counts.row_count
+
+    def _column_counts(self, column_name):
+        """number of people per label of a column, in the order the bars are drawn"""
+        counts = self.counts.column_counts(column_name)
+        if self.counts.categorical[column_name]:
+            return counts
+        return counts.sort_index(ascending=False)
+
+    def _missing_counts(self, column_names):
+        return self.counts.missing_counts(column_names)
+
+    def _pair_counts(
+        self, major_category_column_name, minor_category_column_name, missing_label
+    ):
+        """cross tabulation of two columns with 'All' margins, missing minor labels are counted as missing_label"""
+        results_df = self.counts.pair_counts(
+            major_category_column_name, minor_category_column_name, missing_label
+        )
+        results_df["All"] = results_df.sum(axis=1)
+        results_df.loc["All"] = results_df.sum(axis=0)
+        return results_df
+
+
+# ==============
+# Render Methods
+# ==============
+# These draw on their own figure, which is closed once saved, so they can run one after another or in
+# separate processes without graphs leaking into each other.
+def set_graph_style():
+    """applies the seaborn style of all graphs, once per process"""
+    global _graph_style_is_set
+    if not _graph_style_is_set:
         sns.set(
             style="whitegrid",
             palette="colorblind",
@@ -183,56 +289,92 @@ class GraphUtility:
             font_scale=1,
             color_codes=True,
         )
+        _graph_style_is_set = True
 
-        stacked_bar_graph_df = self.df[
-            [major_category_column_name, minor_category_column_name]
-        ]
-        stacked_bar_graph_df = stacked_bar_graph_df.fillna(
-            {minor_category_column_name: "not provided"}
-        )
 
-        results_df = pd.crosstab(
-            stacked_bar_graph_df[major_category_column_name],
-            stacked_bar_graph_df[minor_category_column_name],
-            margins=True,
-        )
-        all_df = pd.DataFrame(results_df["All"]).T.drop(columns="All")
-        filtered = results_df.drop(labels="All").drop(columns=["All"])
+def render_missing_rates(missing_rates, file_path, x_label, y_label, show_fraction):
+    set_graph_style()
+    fig, ax = plt.subplots()
+    try:
+        missing_rates.plot(kind="barh", stacked=False, legend=False, ax=ax)
+        if show_fraction:
+            ax.set_xlim(0, 1)
+        _label_axes(ax, x_label, y_label, rotate_x_ticks=True)
+        fig.savefig(file_path, bbox_inches="tight")
+    finally:
+        plt.close(fig)
+    logger.info(f"successfully saved missingness bar graph")
 
-        # plot stacked major/minor
-        filename = f"{major_category_column_name}_{minor_category_column_name}_stacked_bar_chart"
-        self._create_stacked_figure(filtered)
-        plt.xticks(rotation=-45)
-        if x_label:
-            plt.xlabel(x_label)
-        if y_label:
-            plt.ylabel(y_label)
+
+def render_bar_graph(counts, file_path, x_label, y_label):
+    set_graph_style()
+    fig, ax = plt.subplots()
+    try:
+        counts.plot(kind="barh", stacked=False, edgecolor="none", ax=ax)
+        _label_axes(ax, x_label, y_label, rotate_x_ticks=True)
+        fig.savefig(file_path, bbox_inches="tight")
+    finally:
+        plt.close(fig)
+    logger.info(f"successfully saved {counts.name} bar graph")
+
+
+def render_stacked_bar_graphs(
+    filtered, all_df, file_paths, x_label, y_label, legend_title
+):
+    set_graph_style()
+    major_minor_file_path, major_file_path = file_paths
+
+    # plot stacked major/minor
+    fig, ax = _create_stacked_figure(filtered)
+    try:
+        _label_axes(ax, x_label, y_label, rotate_x_ticks=True)
         if legend_title:
-            plt.legend(title=legend_title, bbox_to_anchor=(1.05, 1), loc="upper left")
-        file_path = os.path.join(self.output_directory_path, filename)
-        plt.savefig(file_path, bbox_inches="tight")
+            ax.legend(title=legend_title, bbox_to_anchor=(1.05, 1), loc="upper left")
+        fig.savefig(major_minor_file_path, bbox_inches="tight")
+    finally:
+        plt.close(fig)
 
-        # plot only major
-        filename = f"{major_category_column_name}_stacked_bar_chart"
-        # removing index name so it doesn't appear as label 'all'
-        all_df.index = [""]
-        self._create_stacked_figure(all_df)
-        if x_label:
-            plt.xlabel(x_label)
+    # plot only major
+    fig, ax = _create_stacked_figure(all_df)
+    try:
+        _label_axes(ax, x_label, None)
         if y_label:
-            plt.legend(title=y_label, bbox_to_anchor=(1.05, 1), loc="upper left")
-        file_path = os.path.join(self.output_directory_path, filename)
-        plt.savefig(file_path, bbox_inches="tight")
-
-        logger.info(
-            (
-                "successfully saved stacked bar graph for "
-                f"{major_category_column_name} and {minor_category_column_name}"
-            )
+            ax.legend(title=y_label, bbox_to_anchor=(1.05, 1), loc="upper left")
+        fig.savefig(major_file_path, bbox_inches="tight")
+    finally:
+        plt.close(fig)
+
+    logger.info(
+        (
+            "successfully saved stacked bar graph for "
+            f"{filtered.index.name} and {filtered.columns.name}"
         )
+    )
+
+
+def _timed(render_function, *args):
+    """runs a render function in a worker process, returning the seconds it took"""
+    start = time.perf_counter()
+    render_function(*args)
+    return time.perf_counter() - start
+
+
+def _create_stacked_figure(frames):
+    fig, ax = plt.subplots()
+    try:
+        frames.plot(kind="barh", stacked=True, edgecolor="none", ax=ax)
+    except Exception:
+        plt.close(fig)
+        raise
+    ax.legend(title=frames.columns.name)
+    fig.subplots_adjust(bottom=0.30)
+    return fig, ax
+
 
-    def _create_stacked_figure(self, frames):
-        fig = frames.plot(kind="barh", stacked=True, edgecolor="none")
-        plt.legend(title=frames.columns.name)
-        plt.gcf().subplots_adjust(bottom=0.30)
-        return fig
+def _label_axes(ax, x_label, y_label, rotate_x_ticks=False):
+    if rotate_x_ticks:
+        ax.tick_params(axis="x", labelrotation=-45)
+    if x_label:
+        ax.set_xlabel(x_label)
+    if y_label:
+        ax.set_ylabel(y_label)
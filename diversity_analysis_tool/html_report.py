@@ -0,0 +1,306 @@
+import os
+import html
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+HTML_REPORT_FILE_NAME = "diversity_report.html"
+AGGREGATES_FILE_NAME = "diversity_aggregates.json"
+AGGREGATES_VERSION = 1
+# The pairs of columns shown first, the same as the stacked bar graphs of GraphUtility
+DEFAULT_PAIRS = [
+    ("age_band", "ethnicity"),
+    ("age_band", "race"),
+    ("race", "sex"),
+    ("ethnicity", "sex"),
+    ("age_band", "sex"),
+]
+
+
+def report_data(counts, title="Diversity report"):
+    """
+    The aggregates an HTML report is drawn from: the number of people per combination of categories of
+    every column, from which any single column or pair of columns can be summed in the browser
+    Args:
+        counts: the DiversityCounts of the transformed data
+        title (optional): title of the report
+    Returns: a dictionary that can be saved as JSON
+    """
+    column_names = counts.column_names
+    return {
+        "version": AGGREGATES_VERSION,
+        "title": title,
+        "people": counts.row_count,
+        "pairs": [
+            list(pair)
+            for pair in DEFAULT_PAIRS
+            if pair[0] in column_names and pair[1] in column_names
+        ],
+        "counts": counts.to_dict(),
+    }
+
+
+def write_html_report(counts, output_directory_path, title="Diversity report"):
+    """
+    Writes diversity_aggregates.json, a compact JSON of the counts, and diversity_report.html, a single
+    self-contained page with the same counts embedded that draws the bar, stacked bar and missingness charts
+    in the browser. Any two columns can be paired and adjacent age bands merged into wider bands on the page
+    without running the report again, and nothing is rendered here, so it takes a fraction of the time of
+    the PNG graphs.
+    Args:
+        counts: the DiversityCounts of the transformed data
+        output_directory_path: directory where the files will be stored
+        title (optional): title of the report
+    Returns: the paths of the HTML report and of the JSON aggregates
+    """
+    data = report_data(counts, title)
+    data_text = json.dumps(data, separators=(",", ":"))
+    if not os.path.exists(output_directory_path):
+        os.makedirs(output_directory_path)
+
+    json_file_path = os.path.join(output_directory_path, AGGREGATES_FILE_NAME)
+    with open(json_file_path, "w") as json_file:
+        json_file.write(data_text)
+
+    html_file_path = os.path.join(output_directory_path, HTML_REPORT_FILE_NAME)
+    page = _PAGE_TEMPLATE.replace("__TITLE__", html.escape(title)).replace(
+        # the JSON must not close the script element it is embedded in
+        "__DATA__",
+        data_text.replace("</", "<\\/"),
+    )
+    with open(html_file_path, "w", encoding="utf-8") as html_file:
+        html_file.write(page)
+    logger.info(f"successfully saved HTML report of {data['people']} people")
+    return html_file_path, json_file_path
+
+
+_PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>__TITLE__</title>
+<style>
+  body { font-family: "DejaVu Sans", Arial, sans-serif; margin: 2em; color: #222; }
+  h1 { font-size: 1.6em; }
+  h2 { font-size: 1.2em; margin-top: 2em; }
+  .controls { margin: 0.5em 0; }
+  .controls label { margin-right: 1em; }
+  .chart { margin: 0.5em 0 1.5em 0; }
+  svg text { font-size: 12px; }
+  .legend span { display: inline-block; margin-right: 1em; font-size: 12px; }
+  .legend i { display: inline-block; width: 10px; height: 10px; margin-right: 4px; }
+</style>
+</head>
+<body>
+<h1>__TITLE__</h1>
+<p id="summary"></p>
+<div class="controls">
+  <label id="band-control">Age band width
+    <select id="band-width"><option value="1">as reported</option><option value="2">x2</option>
+    <option value="3">x3</option><option value="4">x4</option></select></label>
+</div>
+<h2>Fields</h2>
+<div id="columns"></div>
+<h2>Pairs of fields</h2>
+<div class="controls">
+  <label>Bars <select id="major"></select></label>
+  <label>Stacks <select id="minor"></select></label>
+  <label><input type="checkbox" id="shares"> Shares of each bar</label>
+</div>
+<div id="pair" class="chart"></div>
+<h2>Missing values</h2>
+<div id="missing" class="chart"></div>
+<script type="application/json" id="diversity-data">__DATA__</script>
+<script>
+(function () {
+  "use strict";
+  var data = JSON.parse(document.getElementById("diversity-data").textContent);
+  var counts = data.counts;
+  var cube = counts.cube;
+  var columns = counts.column_names;
+  var people = cube.count;
+  var missingLabel = "not provided";
+  var palette = ["#0173b2", "#de8f05", "#029e73", "#d55e00", "#cc78bc", "#ca9161", "#fbafe4", "#949494",
+                 "#ece133", "#56b4e9"];
+  var bandPattern = /^(\\d+)(?: - (\\d+)|plus)$/;
+  var svgNamespace = "http://www.w3.org/2000/svg";
+
+  // labels of a column and the label of each of its codes, merging adjacent age bands when asked to
+  function grouping(column) {
+    var levels = counts.levels[column].map(String);
+    var width = column === "age_band" ? Number(document.getElementById("band-width").value) : 1;
+    if (width === 1) {
+      return {labels: levels, lookup: levels.map(function (_, position) { return position; })};
+    }
+    var labels = [];
+    var lookup = [];
+    for (var start = 0; start < levels.length; start += width) {
+      var group = levels.slice(start, start + width);
+      var first = bandPattern.exec(group[0]);
+      var last = bandPattern.exec(group[group.length - 1]);
+      var label = group.length === 1 ? group[0] : group[0] + " to " + group[group.length - 1];
+      if (first && last) {
+        label = last[2] === undefined ? first[1] + "plus" : first[1] + " - " + last[2];
+      }
+      group.forEach(function () { lookup.push(labels.length); });
+      labels.push(label);
+    }
+    return {labels: labels, lookup: lookup};
+  }
+
+  function columnCounts(column) {
+    var groups = grouping(column);
+    var totals = groups.labels.map(function () { return 0; });
+    var missing = 0;
+    cube[column].forEach(function (code, row) {
+      if (code < 0) { missing += people[row]; } else { totals[groups.lookup[code]] += people[row]; }
+    });
+    return {labels: groups.labels, totals: totals, missing: missing};
+  }
+
+  function pairCounts(major, minor) {
+    var majorGroups = grouping(major);
+    var minorGroups = grouping(minor);
+    var minorLabels = minorGroups.labels.concat([missingLabel]);
+    var table = majorGroups.labels.map(function () { return minorLabels.map(function () { return 0; }); });
+    var majorCodes = cube[major];
+    var minorCodes = cube[minor];
+    for (var row = 0; row < people.length; row++) {
+      if (majorCodes[row] < 0) { continue; }
+      var minorPosition = minorCodes[row] < 0 ? minorLabels.length - 1 : minorGroups.lookup[minorCodes[row]];
+      table[majorGroups.lookup[majorCodes[row]]][minorPosition] += people[row];
+    }
+    return {majorLabels: majorGroups.labels, minorLabels: minorLabels, table: table};
+  }
+
+  function element(name, attributes, text) {
+    var node = document.createElementNS(svgNamespace, name);
+    Object.keys(attributes).forEach(function (key) { node.setAttribute(key, attributes[key]); });
+    if (text !== undefined) { node.textContent = text; }
+    return node;
+  }
+
+  // horizontal bars, each made of one or more stacked segments
+  function barChart(container, labels, segments, maximum, format) {
+    var labelWidth = 220, barWidth = 420, rowHeight = 20;
+    var svg = element("svg", {width: labelWidth + barWidth + 90, height: labels.length * rowHeight + 10});
+    labels.forEach(function (label, position) {
+      var y = position * rowHeight + 5;
+      svg.appendChild(element("text", {x: labelWidth - 6, y: y + 14, "text-anchor": "end"}, label));
+      var x = labelWidth;
+      var total = 0;
+      segments[position].forEach(function (value, segment) {
+        var width = maximum > 0 ? value / maximum * barWidth : 0;
+        var bar = element("rect", {x: x, y: y, width: width, height: rowHeight - 4,
+                                   fill: palette[segment % palette.length]});
+        bar.appendChild(element("title", {}, label + ": " + format(value)));
+        svg.appendChild(bar);
+        x += width;
+        total += value;
+      });
+      svg.appendChild(element("text", {x: x + 4, y: y + 14}, format(total)));
+    });
+    container.appendChild(svg);
+  }
+
+  function legend(container, labels) {
+    var block = document.createElement("div");
+    block.className = "legend";
+    labels.forEach(function (label, position) {
+      var item = document.createElement("span");
+      var swatch = document.createElement("i");
+      swatch.style.background = palette[position % palette.length];
+      item.appendChild(swatch);
+      item.appendChild(document.createTextNode(label));
+      block.appendChild(item);
+    });
+    container.appendChild(block);
+  }
+
+  function formatCount(value) { return String(Math.round(value)); }
+  function formatShare(value) { return (value * 100).toFixed(1) + "%"; }
+
+  function drawColumns() {
+    var container = document.getElementById("columns");
+    container.innerHTML = "";
+    columns.forEach(function (column) {
+      var result = columnCounts(column);
+      var shown = result.labels.map(function (_, position) { return position; })
+        .filter(function (position) { return result.totals[position] > 0; });
+      var heading = document.createElement("h3");
+      heading.textContent = column;
+      container.appendChild(heading);
+      barChart(container, shown.map(function (position) { return result.labels[position]; }),
+               shown.map(function (position) { return [result.totals[position]]; }),
+               Math.max.apply(null, result.totals.concat([0])), formatCount);
+    });
+  }
+
+  function drawPair() {
+    var container = document.getElementById("pair");
+    container.innerHTML = "";
+    var major = document.getElementById("major").value;
+    var minor = document.getElementById("minor").value;
+    var shares = document.getElementById("shares").checked;
+    var result = pairCounts(major, minor);
+    var rowTotals = result.table.map(function (row) { return row.reduce(function (a, b) { return a + b; }, 0); });
+    var minorShown = result.minorLabels.map(function (_, position) { return position; }).filter(function (position) {
+      return result.table.some(function (row) { return row[position] > 0; });
+    });
+    var majorShown = result.majorLabels.map(function (_, position) { return position; })
+      .filter(function (position) { return rowTotals[position] > 0; });
+    var segments = majorShown.map(function (position) {
+      return minorShown.map(function (minorPosition) {
+        var value = result.table[position][minorPosition];
+        return shares ? value / rowTotals[position] : value;
+      });
+    });
+    legend(container, minorShown.map(function (position) { return result.minorLabels[position]; }));
+    barChart(container, majorShown.map(function (position) { return result.majorLabels[position]; }), segments,
+             shares ? 1 : Math.max.apply(null, rowTotals.concat([0])), shares ? formatShare : formatCount);
+  }
+
+  function drawMissing() {
+    var container = document.getElementById("missing");
+    container.innerHTML = "";
+    var total = data.people || 1;
+    barChart(container, columns, columns.map(function (column) { return [columnCounts(column).missing / total]; }),
+             1, formatShare);
+  }
+
+  function fillSelect(id, selected) {
+    var select = document.getElementById(id);
+    columns.forEach(function (column) {
+      var option = document.createElement("option");
+      option.value = column;
+      option.textContent = column;
+      option.selected = column === selected;
+      select.appendChild(option);
+    });
+    select.addEventListener("change", drawPair);
+  }
+
+  var firstPair = data.pairs.length ? data.pairs[0] : [columns[0], columns[Math.min(1, columns.length - 1)]];
+  fillSelect("major", firstPair[0]);
+  fillSelect("minor", firstPair[1]);
+  document.getElementById("shares").addEventListener("change", drawPair);
+  document.getElementById("summary").textContent = data.people + " people, " + columns.length + " fields";
+  if (columns.indexOf("age_band") < 0) {
+    document.getElementById("band-control").style.display = "none";
+  }
+  document.getElementById("band-width").addEventListener("change", function () {
+    drawColumns();
+    drawPair();
+  });
+  if (columns.length) {
+    drawColumns();
+    drawPair();
+    drawMissing();
+  }
+})();
+</script>
+</body>
+</html>
+"""
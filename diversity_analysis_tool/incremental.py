@@ -0,0 +1,259 @@
+import os
+import json
+import hashlib
+import logging
+
+from diversity_analysis_tool.aggregates import DiversityCounts
+from diversity_analysis_tool.diversity import (
+    IS_DECEASED_LABELS,
+    build_graphs,
+    write_aggregate_report,
+)
+from diversity_analysis_tool.loading import file_format, read_demographic_data
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+STATE_FILE_NAME = "diversity_state.json"
+STATE_VERSION = 1
+
+# Number of bytes at the start of a csv file whose hash tells whether rows already assessed were rewritten
+HEAD_BYTE_COUNT = 2 ** 16
+
+
+def create_incremental_report(
+    assess_diversity,
+    input_file_paths,
+    years_per_band,
+    age_column_name,
+    sex_column_name,
+    ethnicity_column_name,
+    race_column_name,
+    ses_column_name,
+    is_deceased_column_name,
+    output_directory_path,
+    chunksize=None,
+    graph_processes=None,
+    report_format="csv",
+    render_graphs=True,
+):
+    """
+    Assesses extracts that grow by appending rows (or new files) between runs. The counts of every run are
+    saved in diversity_state.json in the output directory, along with a watermark of the rows of each file
+    they cover, so the next run only reads the rows appended since and merges their counts in. The
+    aggregate report and the graphs are then drawn from the merged counts.
+
+    Everything is assessed again when the parameters of the report change, when a file assessed before
+    is gone, shrank or had its first rows rewritten. Files must not be written to while they are assessed.
+    Args:
+        assess_diversity: the AssessDiversity to transform the data with
+        input_file_paths: paths to the csv, Parquet or Arrow IPC/Feather files making up the cohort, their
+        file names must be different
+        chunksize (optional): read the new rows of each file this many rows at a time
+        graph_processes (optional): number of processes to render the graphs in at the same time
+        report_format (optional): format of the aggregate tables, see create_diversity_analysis_report
+        render_graphs (optional): whether to draw the graphs, defaults to True
+        other arguments: the same as AssessDiversity.create_diversity_analysis_report
+    Returns: the DiversityCounts of every row assessed so far, protected by the disclosure control of
+    assess_diversity if any, or None if there is no data
+    """
+    column_names = {
+        "age": age_column_name,
+        "sex": sex_column_name,
+        "ethnicity": ethnicity_column_name,
+        "race": race_column_name,
+        "ses": ses_column_name,
+        "is_deceased": is_deceased_column_name,
+    }
+    file_names = [os.path.basename(file_path) for file_path in input_file_paths]
+    if len(set(file_names)) != len(file_names):
+        raise ValueError(
+            "Extracts assessed incrementally must have different file names"
+        )
+
+    state_file_path = os.path.join(output_directory_path, STATE_FILE_NAME)
+    parameters = assess_diversity.report_parameters(years_per_band, column_names)
+    state = load_state(state_file_path)
+    if state is not None and not _state_is_valid(
+        state, parameters, dict(zip(file_names, input_file_paths))
+    ):
+        state = None
+    if state is None:
+        state = {
+            "version": STATE_VERSION,
+            "parameters": parameters,
+            "files": {},
+            "counts": None,
+        }
+    counts = (
+        DiversityCounts.from_dict(state["counts"])
+        if state["counts"] is not None
+        else None
+    )
+
+    for file_name, file_path in zip(file_names, input_file_paths):
+        watermark = state["files"].get(file_name, {"rows": 0, "bytes": 0})
+        new_watermark = file_watermark(file_path)
+        new_counts, new_row_count = _count_new_rows(
+            assess_diversity,
+            file_path,
+            column_names,
+            years_per_band,
+            watermark,
+            chunksize,
+        )
+        logger.info(f"Assessed {new_row_count} new rows of {file_path}")
+        new_watermark["rows"] = watermark["rows"] + new_row_count
+        state["files"][file_name] = new_watermark
+        if new_counts is not None:
+            counts = new_counts if counts is None else counts.merge(new_counts)
+
+    if counts is None:
+        logger.warning("No data to assess")
+        return None
+
+    if not os.path.exists(output_directory_path):
+        os.makedirs(output_directory_path)
+    # the state keeps the counts as they are, only what is written is protected
+    report_counts = counts
+    disclosure_plan = assess_diversity.apply_disclosure_control(
+        counts, ses_column_name, output_directory_path, report_format
+    )
+    if disclosure_plan is not None:
+        report_counts = disclosure_plan.counts
+    write_aggregate_report(report_counts, output_directory_path, report_format)
+    if render_graphs:
+        build_graphs(
+            report_counts,
+            output_directory_path,
+            graph_processes,
+            assess_diversity.profiler,
+        )
+
+    # the state is saved last, so a run that fails part way is repeated in full next time
+    state["counts"] = counts.to_dict()
+    save_state(state_file_path, state)
+    return report_counts
+
+
+def file_watermark(file_path):
+    """
+    Describes the current content of a file so that the next run can tell whether rows were only appended
+    to it. For csv files the size in bytes and a hash of the first bytes are recorded, as the size is also
+    where the next run starts reading.
+    Returns: a dictionary that can be saved as JSON
+    """
+    if file_format(file_path) != "csv":
+        return {}
+    with open(file_path, "rb") as data_file:
+        head = data_file.read(HEAD_BYTE_COUNT)
+        data_file.seek(0, os.SEEK_END)
+        byte_count = data_file.tell()
+        if byte_count:
+            data_file.seek(byte_count - 1)
+            ends_with_newline = data_file.read(1) == b"\n"
+    return {
+        "bytes": byte_count,
+        "head_sha256": hashlib.sha256(head).hexdigest(),
+        # the next run can only start reading at the end of the file if the last row is complete
+        "complete": byte_count == 0 or ends_with_newline,
+    }
+
+
+def load_state(state_file_path):
+    """Returns: the saved state of an incremental report or None if there is none"""
+    if not os.path.exists(state_file_path):
+        return None
+    with open(state_file_path) as state_file:
+        return json.load(state_file)
+
+
+def save_state(state_file_path, state):
+    # written next to the old state and then moved over it, so an interrupted run never leaves half a file
+    temporary_file_path = state_file_path + ".tmp"
+    with open(temporary_file_path, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary_file_path, state_file_path)
+    logger.info(f"successfully saved state to {state_file_path}")
+
+
+def _state_is_valid(state, parameters, file_paths):
+    if state.get("version") != STATE_VERSION:
+        logger.warning(
+            "Saved state is from another version, assessing everything again"
+        )
+        return False
+    if state["parameters"] != parameters:
+        logger.warning("Report parameters changed, assessing everything again")
+        return False
+    for file_name, watermark in state["files"].items():
+        if file_name not in file_paths:
+            logger.warning(
+                f"{file_name} was assessed before but is gone, assessing everything again"
+            )
+            return False
+        if not _only_appended(file_paths[file_name], watermark):
+            logger.warning(
+                f"{file_name} was changed, not appended to, assessing everything again"
+            )
+            return False
+    return True
+
+
+def _only_appended(file_path, watermark):
+    if file_format(file_path) != "csv":
+        # Parquet and Arrow files are rewritten as a whole, the rows already assessed are assumed to be
+        # kept first
+        return _row_count(file_path) >= watermark["rows"]
+    current_watermark = file_watermark(file_path)
+    if not watermark["complete"] or current_watermark["bytes"] < watermark["bytes"]:
+        return False
+    if watermark["bytes"] >= HEAD_BYTE_COUNT:
+        return current_watermark["head_sha256"] == watermark["head_sha256"]
+    # the file was shorter than the hashed head, so only its old length can be compared
+    with open(file_path, "rb") as data_file:
+        head = data_file.read(watermark["bytes"])
+    return hashlib.sha256(head).hexdigest() == watermark["head_sha256"]
+
+
+def _row_count(file_path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if file_format(file_path) == "parquet":
+        return pq.ParquetFile(file_path).metadata.num_rows
+    return pa.ipc.open_file(pa.memory_map(file_path)).read_all().num_rows
+
+
+def _count_new_rows(
+    assess_diversity, file_path, column_names, years_per_band, watermark, chunksize
+):
+    """counts the rows of a file after its watermark, returning the counts (or None) and the row count"""
+    if file_format(file_path) == "csv":
+        position = dict(skip_bytes=watermark.get("bytes", 0))
+    else:
+        position = dict(skip_rows=watermark["rows"])
+    data = read_demographic_data(file_path, column_names, chunksize, **position)
+    chunks = data if chunksize else [data]
+
+    counts = None
+    row_count = 0
+    for chunk_df in chunks:
+        if chunk_df.empty:
+            continue
+        row_count += len(chunk_df)
+        chunk_counts = assess_diversity.count_categories(
+            chunk_df,
+            years_per_band,
+            column_names["age"],
+            column_names["sex"],
+            column_names["ethnicity"],
+            column_names["race"],
+            column_names["ses"],
+            column_names["is_deceased"],
+        )
+        counts = chunk_counts if counts is None else counts.merge(chunk_counts)
+    if counts is not None and "is_deceased" in counts.levels:
+        counts = counts.rename_levels("is_deceased", IS_DECEASED_LABELS)
+    return counts, row_count
+
@@ -0,0 +1,205 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from diversity_analysis_tool.loading import REPORT_FILE_EXTENSIONS, write_table
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+INDEX_REPORT_FILE_NAME = "diversity_indices"
+INDEX_NAMES = ("shannon", "simpson", "gini_simpson", "effective_groups")
+DEFAULT_BOOTSTRAP_SAMPLES = 1000
+DEFAULT_STRATA_COLUMN_NAMES = ("age_band",)
+
+
+def diversity_indices(
+    counts,
+    column_names=None,
+    strata_column_names=(),
+    bootstrap_samples=DEFAULT_BOOTSTRAP_SAMPLES,
+    confidence=0.95,
+    seed=0,
+    processes=None,
+):
+    """
+    Diversity indices of each column, over the whole cohort and within each category of the strata columns
+    (eg: the ethnic diversity per age band), with percentile bootstrap confidence intervals:
+
+    - shannon: Shannon entropy -sum(p * ln(p)) of the shares p of the categories
+    - simpson: sum(p ** 2), the chance that two people drawn at random are in the same category
+    - gini_simpson: 1 - simpson, the chance that they are in different categories
+    - effective_groups: exp(shannon), the number of equally common categories that would be as diverse
+
+    Missing values are left out. The bootstrap redraws the category counts from a multinomial distribution
+    with the observed shares rather than resampling rows, so it takes as long for 10 million people as for
+    a thousand. Each column gets its own random stream spawned from seed, so results are the same whatever
+    the number of processes.
+    Args:
+        counts: the DiversityCounts of the transformed data
+        column_names (optional): the columns to compute indices of, defaults to every column of counts
+        strata_column_names (optional): columns to compute the indices within each category of
+        bootstrap_samples (optional): number of bootstrap samples, 0 leaves out the confidence intervals
+        confidence (optional): level of the confidence intervals, defaults to 0.95
+        seed (optional): seed of the bootstrap samples
+        processes (optional): number of processes to bootstrap columns in at the same time. If none the
+        columns are bootstrapped one after another in this process.
+    Returns: a data frame with one row per column and stratum, with the columns 'column', 'stratum_column'
+    and 'stratum' (None for the whole cohort), 'people', 'groups' (number of categories with people in
+    them), and each index with its '_low' and '_high' bounds
+    """
+    if column_names is None:
+        column_names = counts.column_names
+    tasks = []
+    for column_name in column_names:
+        stratum_keys = [(None, None)]
+        tables = [counts.column_counts(column_name).to_numpy()[np.newaxis, :]]
+        for strata_column_name in strata_column_names:
+            if strata_column_name == column_name:
+                continue
+            table_df = counts.pair_counts(strata_column_name, column_name)
+            # every stratum needs the same categories, as they are bootstrapped together
+            table_df = table_df.reindex(
+                columns=counts.levels[column_name], fill_value=0
+            )
+            stratum_keys.extend(
+                (strata_column_name, stratum) for stratum in table_df.index
+            )
+            tables.append(table_df.to_numpy())
+        tasks.append((column_name, stratum_keys, np.concatenate(tables)))
+
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(tasks))
+    task_arguments = [
+        (table, bootstrap_samples, confidence, seed_sequence)
+        for (_, _, table), seed_sequence in zip(tasks, seed_sequences)
+    ]
+    if processes and processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_bootstrap_indices, *zip(*task_arguments)))
+    else:
+        results = [_bootstrap_indices(*arguments) for arguments in task_arguments]
+
+    index_tables = []
+    for (column_name, stratum_keys, table), result in zip(tasks, results):
+        index_table = {
+            "column": column_name,
+            "stratum_column": [key[0] for key in stratum_keys],
+            "stratum": [key[1] for key in stratum_keys],
+            "people": table.sum(axis=1),
+            "groups": (table > 0).sum(axis=1),
+        }
+        index_table.update(result)
+        index_tables.append(pd.DataFrame(index_table))
+    if not index_tables:
+        return pd.DataFrame(
+            columns=["column", "stratum_column", "stratum", "people", "groups"]
+            + _index_column_names()
+        )
+    return pd.concat(index_tables, ignore_index=True)
+
+
+def write_index_report(
+    counts,
+    output_directory_path,
+    report_format="csv",
+    strata_column_names=DEFAULT_STRATA_COLUMN_NAMES,
+    bootstrap_samples=DEFAULT_BOOTSTRAP_SAMPLES,
+    seed=0,
+    processes=None,
+):
+    """
+    Writes the diversity indices of every column, overall and within each stratum, to diversity_indices in
+    the output directory, see diversity_indices
+    Args:
+        counts: the DiversityCounts of the transformed data
+        output_directory_path: directory where the table will be stored
+        report_format (optional): 'csv' (pipe delimited), 'parquet' or 'feather'
+        strata_column_names (optional): defaults to age_band, strata columns not in counts are left out
+        bootstrap_samples, seed, processes (optional): see diversity_indices
+    Returns: the data frame of indices
+    """
+    indices_df = diversity_indices(
+        counts,
+        strata_column_names=[
+            column_name
+            for column_name in strata_column_names
+            if column_name in counts.levels
+        ],
+        bootstrap_samples=bootstrap_samples,
+        seed=seed,
+        processes=processes,
+    )
+    write_table(
+        indices_df,
+        os.path.join(
+            output_directory_path,
+            INDEX_REPORT_FILE_NAME + REPORT_FILE_EXTENSIONS[report_format],
+        ),
+        sep="|",
+    )
+    return indices_df
+
+
+def index_values(category_counts):
+    """
+    Args:
+        category_counts: array of the number of people per category along the last axis, any leading axes
+        (eg: strata, bootstrap samples) are computed at once
+    Returns: a dictionary of index name to an array of the leading shape, NaN where there are no people
+    """
+    category_counts = np.asarray(category_counts, dtype="float64")
+    people = category_counts.sum(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shares = category_counts / people
+        # 0 * ln(0) is taken as 0
+        shannon = -np.where(shares > 0, shares * np.log(shares), 0.0).sum(axis=-1)
+        simpson = (shares ** 2).sum(axis=-1)
+    empty = people[..., 0] == 0
+    shannon[empty] = np.nan
+    simpson[empty] = np.nan
+    return {
+        "shannon": shannon,
+        "simpson": simpson,
+        "gini_simpson": 1 - simpson,
+        "effective_groups": np.exp(shannon),
+    }
+
+
+def _bootstrap_indices(table, bootstrap_samples, confidence, seed_sequence):
+    """the indices of each row of a table of category counts, with their bootstrap confidence intervals"""
+    result = {}
+    values = index_values(table)
+    if bootstrap_samples:
+        people = table.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            shares = np.nan_to_num(table / people[:, np.newaxis])
+        rng = np.random.default_rng(seed_sequence)
+        # one stratum at a time, as Generator.multinomial only takes 2-D pvals from NumPy 1.22
+        samples = np.zeros((bootstrap_samples,) + table.shape, dtype="int64")
+        for row, (row_people, row_shares) in enumerate(zip(people, shares)):
+            samples[:, row] = rng.multinomial(
+                int(row_people), row_shares, size=bootstrap_samples
+            )
+        sample_values = index_values(samples)
+        tail = (1 - confidence) / 2
+    for index_name in INDEX_NAMES:
+        result[index_name] = values[index_name]
+        if bootstrap_samples:
+            # rows without people have NaN samples and so NaN bounds
+            low, high = np.quantile(sample_values[index_name], [tail, 1 - tail], axis=0)
+        else:
+            low = high = np.full(len(table), np.nan)
+        result[f"{index_name}_low"] = low
+        result[f"{index_name}_high"] = high
+    return result
+
+
+def _index_column_names():
+    return [
+        column_name
+        for index_name in INDEX_NAMES
+        for column_name in [index_name, f"{index_name}_low", f"{index_name}_high"]
+    ]
@@ -0,0 +1,36 @@
+# Codes of the IPUMS USA variables in the example extract (input/usa_00004.csv), defined here:
+# https://usa.ipums.org/usa-action/variables/SEX#codes_section
+IPUMS_SEX_CODE_DICT = {
+    1: "Male",
+    2: "Female",
+}
+
+# https://usa.ipums.org/usa-action/variables/RACE#codes_section
+IPUMS_RACE_CODE_DICT = {
+    1: "White",
+    2: "Black/African American/Negro",
+    3: "American Indian or Alaska Native",
+    4: "Chinese",
+    5: "Japanese",
+    6: "Other Asian or Pacific Islander",
+    7: "Other race, nec",
+    8: "Two major races",
+    9: "Three or more major races",
+}
+
+# Educational attainment, which stands in for socio economic status. The codes are in order of attainment.
+# https://usa.ipums.org/usa-action/variables/EDUC#codes_section
+IPUMS_EDUC_CODE_DICT = {
+    0: "N/A or no schooling",
+    1: "Nursery school to grade 4",
+    2: "Grade 5, 6, 7, or 8",
+    3: "Grade 9",
+    4: "Grade 10",
+    5: "Grade 11",
+    6: "Grade 12",
+    7: "1 year of college",
+    8: "2 years of college",
+    9: "3 years of college",
+    10: "4 years of college",
+    11: "5+ years of college",
+}
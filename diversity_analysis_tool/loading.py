@@ -0,0 +1,444 @@
+import io
+import os
+import json
+import logging
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# The demographic fields the tool assesses and the column name each is read from by default
+DEFAULT_COLUMN_NAMES = {
+    "age": "age",
+    "sex": "sex",
+    "ethnicity": "ethnicity",
+    "race": "race",
+    "ses": "educ",
+    "is_deceased": "is_deceased",
+}
+
+# Compact dtypes the fields are parsed into. Coded fields only have a handful of distinct values, so they are
+# read as categoricals rather than one Python object per row. Ages can be fractional (eg: 34.5) and flags
+# can be coded as anything (eg: Y and N), so neither is parsed into a stricter dtype.
+FIELD_DTYPES = {
+    "age": "float32",
+    "sex": "category",
+    "ethnicity": "category",
+    "race": "category",
+    "ses": "category",
+    "is_deceased": "category",
+}
+
+# Columns which are not named in the column mapping but are used by transformations when present
+OPTIONAL_COLUMN_NAMES = ["ses_level"]
+
+# File extensions of the formats that can be read and written besides csv. Both need pyarrow.
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+ARROW_EXTENSIONS = (".feather", ".arrow", ".ipc")
+REPORT_FILE_EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+
+
+def load_column_names(config_file_path=None, **column_names):
+    """
+    Builds the mapping of demographic field to the name of the column it is read from.
+    Args:
+        config_file_path (optional): path to a JSON file mapping fields to column names, eg:
+        {"age": "AGE", "ses": "INCTOT", "ethnicity": null}. A null column name means the field is not in the data.
+        column_names (optional): column names by field, eg: age='AGE'. These take precedence over the file and
+        are ignored when None.
+    Returns: a dictionary with a column name (or None) for every field in DEFAULT_COLUMN_NAMES
+    """
+    mapping = dict(DEFAULT_COLUMN_NAMES)
+    if config_file_path:
+        with open(config_file_path) as config_file:
+            configured_column_names = json.load(config_file)
+        unknown_fields = set(configured_column_names) - set(DEFAULT_COLUMN_NAMES)
+        if unknown_fields:
+            raise ValueError(
+                f"Unknown fields {sorted(unknown_fields)} in {config_file_path}, "
+                f"expected some of {list(DEFAULT_COLUMN_NAMES)}"
+            )
+        mapping.update(configured_column_names)
+    mapping.update(
+        {
+            field: column_name
+            for field, column_name in column_names.items()
+            if column_name is not None
+        }
+    )
+    return mapping
+
+
+def file_format(file_path):
+    """
+    Args:
+        file_path: path to a data file
+    Returns: 'parquet', 'feather' (Arrow IPC) or 'csv', based on the file extension
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in PARQUET_EXTENSIONS:
+        return "parquet"
+    if extension in ARROW_EXTENSIONS:
+        return "feather"
+    return "csv"
+
+
+def read_demographic_data(
+    file_path,
+    column_names,
+    chunksize=None,
+    skip_rows=0,
+    skip_bytes=0,
+    max_rows=None,
+    end_bytes=None,
+):
+    """
+    Reads a csv, Parquet or Arrow IPC/Feather file of demographic data, reading only the mapped columns, in
+    compact dtypes. Columns of the mapping that are not in the file are skipped.
+    Args:
+        file_path: path to the data file
+        column_names: dictionary of field to column name, see load_column_names
+        chunksize (optional): read the file this many rows at a time
+        skip_rows (optional): number of rows at the start of the file to leave out, eg: rows already assessed
+        skip_bytes (optional): csv files only, byte offset of the first row to read. Unlike skip_rows, the
+        rows before it are not even scanned. It must be the start of a line after the header.
+        max_rows (optional): number of rows to read at most, after the rows left out
+        end_bytes (optional): csv files only, byte offset where reading stops. It must be the start of a line
+        or the end of the file, and is used with skip_bytes to read one slice of a file.
+    Returns: a data frame, or an iterator of data frames when chunksize is given
+    """
+    dtypes = {
+        column_name: FIELD_DTYPES[field]
+        for field, column_name in column_names.items()
+        if column_name is not None
+    }
+    wanted_column_names = list(dtypes) + OPTIONAL_COLUMN_NAMES
+
+    if file_format(file_path) != "csv":
+        tables = read_table(
+            file_path,
+            wanted_column_names,
+            chunksize=chunksize,
+            skip_rows=skip_rows,
+            max_rows=max_rows,
+        )
+        if chunksize:
+            return (_compact_dtypes(chunk_df, dtypes) for chunk_df in tables)
+        return _compact_dtypes(tables, dtypes)
+
+    csv_arguments = dict(
+        usecols=lambda column_name: column_name in wanted_column_names,
+        dtype=dtypes,
+        chunksize=chunksize,
+        nrows=max_rows,
+    )
+    if skip_bytes or end_bytes is not None:
+        chunks = _read_csv_from_offset(
+            file_path, skip_bytes, csv_arguments, end_offset=end_bytes
+        )
+        if chunksize:
+            return (_numeric_categories(chunk_df) for chunk_df in chunks)
+        return _numeric_categories(next(chunks))
+
+    if skip_rows:
+        # the header is line 0
+        csv_arguments["skiprows"] = range(1, skip_rows + 1)
+    reader = pd.read_csv(file_path, **csv_arguments)
+    if chunksize:
+        return (_numeric_categories(chunk_df) for chunk_df in reader)
+    return _numeric_categories(reader)
+
+
+def read_table(
+    file_path, column_names=None, chunksize=None, skip_rows=0, max_rows=None
+):
+    """
+    Reads a csv, Parquet or Arrow IPC/Feather file. Only the given columns are read: Parquet only decodes
+    those columns and Arrow IPC files are memory mapped, so other columns are never loaded.
+    Args:
+        file_path: path to the data file
+        column_names (optional): names of the columns to read, columns not in the file are skipped. If none
+        every column is read.
+        chunksize (optional): read the file this many rows at a time
+        skip_rows (optional): number of rows at the start of the file to leave out. Parquet row groups
+        before them are not decoded.
+        max_rows (optional): number of rows to read at most, after the rows left out. Parquet row groups
+        after them are not decoded.
+    Returns: a data frame, or an iterator of data frames when chunksize is given
+    """
+    data_format = file_format(file_path)
+    if data_format == "csv":
+        usecols = None
+        if column_names is not None:
+            usecols = lambda column_name: column_name in column_names
+        return pd.read_csv(
+            file_path,
+            usecols=usecols,
+            chunksize=chunksize,
+            skiprows=range(1, skip_rows + 1) if skip_rows else None,
+            nrows=max_rows,
+        )
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if data_format == "parquet":
+        schema = pq.read_schema(file_path)
+        selected_column_names = _selected_column_names(schema.names, column_names)
+        # text columns are decoded straight into categoricals
+        dictionary_column_names = [
+            column_name
+            for column_name in selected_column_names
+            if pa.types.is_string(schema.field(column_name).type)
+            or pa.types.is_large_string(schema.field(column_name).type)
+        ]
+        parquet_file = pq.ParquetFile(
+            file_path, read_dictionary=dictionary_column_names
+        )
+        row_groups, first_row = _row_groups_from(
+            parquet_file.metadata, skip_rows, max_rows
+        )
+        if chunksize:
+            return _slice_batches(
+                parquet_file.iter_batches(
+                    batch_size=chunksize,
+                    row_groups=row_groups,
+                    columns=selected_column_names,
+                ),
+                first_row,
+                max_rows,
+            )
+        return (
+            parquet_file.read_row_groups(row_groups, columns=selected_column_names)
+            .slice(first_row, max_rows)
+            .to_pandas()
+        )
+
+    # the table keeps referencing the memory map, so it is not closed here
+    table = pa.ipc.open_file(pa.memory_map(file_path)).read_all()
+    table = table.select(_selected_column_names(table.schema.names, column_names))
+    # slicing a memory mapped table does not copy or read the rows left out
+    table = table.slice(skip_rows, max_rows)
+    if chunksize:
+        return (
+            pa.Table.from_batches([batch]).to_pandas()
+            for batch in table.to_batches(max_chunksize=chunksize)
+        )
+    return table.to_pandas()
+
+
+def write_table(df, file_path, sep=","):
+    """
+    Writes a data frame in the format given by the file extension. Parquet files are compressed with zstd.
+    Categorical columns stay categorical in Parquet and Arrow IPC/Feather files.
+    Args:
+        df: the data frame to write
+        file_path: path of the file to write
+        sep (optional): the delimiter of csv files
+    """
+    data_format = file_format(file_path)
+    if data_format == "parquet":
+        df.to_parquet(file_path, compression="zstd", index=False)
+    elif data_format == "feather":
+        df.reset_index(drop=True).to_feather(file_path)
+    else:
+        df.to_csv(file_path, sep=sep, encoding="utf-8", index=False)
+
+
+class ChunkedTableWriter:
+    """
+    Writes data frames one chunk at a time to a single csv or Parquet file, eg: the transformed chunks of a
+    file read with a chunksize. Categorical columns stay categorical in Parquet files, each chunk keeping
+    its own categories. Arrow IPC/Feather files cannot be written in chunks as every chunk would need the
+    same categories.
+    """
+
+    def __init__(self, file_path, sep=","):
+        """
+        Args:
+            file_path: path of the file to write
+            sep (optional): the delimiter of csv files
+        """
+        self.file_path = file_path
+        self.sep = sep
+        self.data_format = file_format(file_path)
+        if self.data_format == "feather":
+            raise ValueError(
+                "Arrow IPC/Feather files cannot be written in chunks, write Parquet instead"
+            )
+        self._parquet_writer = None
+        self._parquet_schema = None
+        self._chunk_count = 0
+
+    def write(self, df):
+        if self.data_format == "parquet":
+            self._write_parquet(df)
+        else:
+            df.to_csv(
+                self.file_path,
+                sep=self.sep,
+                encoding="utf-8",
+                index=False,
+                mode="w" if self._chunk_count == 0 else "a",
+                header=self._chunk_count == 0,
+            )
+        self._chunk_count += 1
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_parquet(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._parquet_writer is None:
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            # chunks may have more categories than the first one, so categories are indexed with int32
+            for field_index, field in enumerate(schema):
+                if pa.types.is_dictionary(field.type):
+                    schema = schema.set(
+                        field_index,
+                        field.with_type(
+                            pa.dictionary(
+                                pa.int32(), field.type.value_type, field.type.ordered
+                            )
+                        ),
+                    )
+            self._parquet_schema = schema
+            self._parquet_writer = pq.ParquetWriter(
+                self.file_path, schema, compression="zstd"
+            )
+        self._parquet_writer.write_table(
+            pa.Table.from_pandas(df, schema=self._parquet_schema, preserve_index=False)
+        )
+
+
+def _read_csv_from_offset(file_path, offset, csv_arguments, end_offset=None):
+    """
+    Reads the rows of a csv file from a byte offset, up to end_offset if given, with the column names of
+    its header. Always yields data frames, the whole rest of the file at once when csv_arguments has no
+    chunksize.
+    """
+    header = pd.read_csv(file_path, nrows=0).columns
+    with open(file_path, "rb") as csv_file:
+        if not offset:
+            # the header is not a row
+            csv_file.readline()
+        else:
+            csv_file.seek(offset)
+        if end_offset is not None:
+            csv_file = io.BufferedReader(
+                _BoundedReader(csv_file, end_offset - csv_file.tell())
+            )
+        reader = pd.read_csv(csv_file, header=None, names=list(header), **csv_arguments)
+        if csv_arguments.get("chunksize"):
+            yield from reader
+        else:
+            yield reader
+
+
+class _BoundedReader(io.RawIOBase):
+    """reads at most byte_count bytes of a binary file, so that a csv reader stops at the end of a slice"""
+
+    def __init__(self, binary_file, byte_count):
+        self.binary_file = binary_file
+        self.remaining_byte_count = byte_count
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.remaining_byte_count <= 0:
+            return 0
+        read_byte_count = self.binary_file.readinto(
+            memoryview(buffer)[: self.remaining_byte_count]
+        )
+        self.remaining_byte_count -= read_byte_count
+        return read_byte_count
+
+
+def _row_groups_from(metadata, skip_rows, max_rows=None):
+    """
+    the Parquet row groups holding the rows after skip_rows, up to max_rows of them, and the position of the
+    first of those rows
+    """
+    row_groups = []
+    first_row = skip_rows
+    selected_row_count = 0
+    for row_group in range(metadata.num_row_groups):
+        row_count = metadata.row_group(row_group).num_rows
+        if max_rows is not None and row_groups and selected_row_count >= max_rows:
+            break
+        if row_groups:
+            row_groups.append(row_group)
+            selected_row_count += row_count
+        elif first_row < row_count:
+            row_groups.append(row_group)
+            selected_row_count += row_count - first_row
+        else:
+            first_row -= row_count
+    return row_groups, first_row
+
+
+def _slice_batches(batches, first_row, max_rows=None):
+    import pyarrow as pa
+
+    remaining_row_count = max_rows
+    for batch in batches:
+        if remaining_row_count is not None and remaining_row_count <= 0:
+            break
+        if first_row >= batch.num_rows:
+            first_row -= batch.num_rows
+            continue
+        batch = batch.slice(first_row, remaining_row_count)
+        if remaining_row_count is not None:
+            remaining_row_count -= batch.num_rows
+        yield pa.Table.from_batches([batch]).to_pandas()
+        first_row = 0
+
+
+def _selected_column_names(available_column_names, column_names):
+    if column_names is None:
+        return list(available_column_names)
+    return [
+        column_name
+        for column_name in available_column_names
+        if column_name in column_names
+    ]
+
+
+def _compact_dtypes(df, dtypes):
+    """converts the columns read from Parquet or Arrow files to the dtypes csv files are parsed into"""
+    for column_name, dtype in dtypes.items():
+        if column_name in df and str(df[column_name].dtype) != dtype:
+            df[column_name] = df[column_name].astype(dtype)
+    return df
+
+
+def _numeric_categories(df):
+    """
+    read_csv always gives categoricals text categories, so codes like 1 and 2 are read as '1' and '2'. The
+    categories (not the rows) of numeric looking categoricals are converted back to numbers.
+    """
+    for column_name in df.columns:
+        column = df[column_name]
+        if not pd.api.types.is_categorical_dtype(column):
+            continue
+        try:
+            numeric_categories = pd.to_numeric(column.cat.categories)
+        except (ValueError, TypeError):
+            continue
+        if numeric_categories.has_duplicates:
+            # eg: '1' and '1.0'
+            continue
+        df[column_name] = column.cat.rename_categories(numeric_categories)
+    return df
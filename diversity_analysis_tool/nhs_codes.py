@@ -43,3 +43,12 @@ NHS_RACE_CODE_DICT = dict(
     Z="Not stated",
     Unknown="Unknown",
 )
+
+# Numeric codes for 'Sex of Patients' defined here:
+# https://www.datadictionary.nhs.uk/data_dictionary/attributes/s/ses/sex_of_patients_de.asp?shownav=1
+# Empty values are reported as 'Unknown'.
+NHS_SEX_CODE_DICT = {
+    1: "Male",
+    2: "Female",
+    8: "Not specified",
+}
@@ -0,0 +1,159 @@
+import json
+import time
+import logging
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+PROFILE_FILE_NAME = "diversity_report_profile.json"
+
+
+class StageProfiler:
+    """
+    Records the wall time, number of rows processed and peak memory of each stage of a report (eg: banding,
+    a transform routine, writing the report, a graph). Stages can be nested, eg: the transform routines
+    within 'transform', and are named by their path, eg: 'report/transform/create_age_bands'.
+
+    Memory is traced with tracemalloc, which slows Python code down, so profiling is only switched on when
+    a StageProfiler is given to AssessDiversity, and tracing started by a profiler is stopped again when its
+    outermost stage finishes.
+    """
+
+    def __init__(self, callback=None, trace_memory=True):
+        """
+        Args:
+            callback (optional): function called with the record of every stage as it finishes, a
+            dictionary with the keys 'stage', 'seconds', 'rows' and 'peak_memory_delta_mb'
+            trace_memory (optional): whether to record peak memory, defaults to True
+        """
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.records = []
+        self._open_stages = []
+        # whether this profiler started tracemalloc, rather than tracing that was already on
+        self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """
+        Profiles the code run within the with block
+        Args:
+            name: name of the stage
+            rows (optional): number of rows the stage processes, can also be set on the yielded record
+        Yields: the record of the stage, a dictionary
+        """
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        path = "/".join([stage["stage"] for stage in self._open_stages] + [name])
+        record = {"stage": path, "rows": rows}
+        open_stage = {"stage": name, "record": record}
+        if self.trace_memory:
+            self._update_open_stage_peaks()
+            open_stage["start_memory"] = tracemalloc.get_traced_memory()[0]
+            open_stage["peak_memory"] = open_stage["start_memory"]
+            _reset_peak()
+        self._open_stages.append(open_stage)
+
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            if self.trace_memory:
+                self._update_open_stage_peaks()
+                record["peak_memory_delta_mb"] = (
+                    open_stage["peak_memory"] - open_stage["start_memory"]
+                ) / 2 ** 20
+            else:
+                record["peak_memory_delta_mb"] = None
+            self._open_stages.pop()
+            if not self._open_stages and self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+            self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def add_record(self, name, seconds, rows=None):
+        """records a stage that ran elsewhere, eg: a graph rendered in another process"""
+        path = "/".join([stage["stage"] for stage in self._open_stages] + [name])
+        record = {
+            "stage": path,
+            "rows": rows,
+            "seconds": seconds,
+            "peak_memory_delta_mb": None,
+        }
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def summary(self):
+        """
+        Returns: one entry per stage path with the number of calls (eg: one per chunk), total seconds, total
+        rows and the largest peak memory delta, in the order the stages first finished
+        """
+        stages = {}
+        for record in self.records:
+            stage = stages.setdefault(
+                record["stage"],
+                {
+                    "stage": record["stage"],
+                    "calls": 0,
+                    "seconds": 0.0,
+                    "rows": None,
+                    "peak_memory_delta_mb": None,
+                },
+            )
+            stage["calls"] += 1
+            stage["seconds"] += record["seconds"]
+            if record["rows"] is not None:
+                stage["rows"] = (stage["rows"] or 0) + record["rows"]
+            if record["peak_memory_delta_mb"] is not None:
+                stage["peak_memory_delta_mb"] = max(
+                    stage["peak_memory_delta_mb"] or 0.0,
+                    record["peak_memory_delta_mb"],
+                )
+        return list(stages.values())
+
+    def write_json(self, file_path):
+        """writes the summary and every record to a JSON file"""
+        with open(file_path, "w") as profile_file:
+            json.dump(
+                {"stages": self.summary(), "records": self.records},
+                profile_file,
+                indent=2,
+            )
+        logger.info(f"successfully saved profile to {file_path}")
+
+    def _update_open_stage_peaks(self):
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        for open_stage in self._open_stages:
+            open_stage["peak_memory"] = max(open_stage["peak_memory"], peak_memory)
+
+
+class NullProfiler:
+    """Stands in for a StageProfiler when profiling is switched off"""
+
+    records = []
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        yield {}
+
+    def add_record(self, name, seconds, rows=None):
+        pass
+
+    def write_json(self, file_path):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def _reset_peak():
+    # tracemalloc.reset_peak is only available from Python 3.9, before that peaks include earlier stages
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
@@ -0,0 +1,351 @@
+import os
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+
+from diversity_analysis_tool.aggregates import COUNT_COLUMN_NAME, DiversityCounts
+from diversity_analysis_tool.diversity import IS_DECEASED_LABELS
+from diversity_analysis_tool.loading import (
+    REPORT_FILE_EXTENSIONS,
+    read_demographic_data,
+    write_table,
+)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+REPRESENTATION_REPORT_FILE_NAME = "diversity_representation"
+REPRESENTATIVENESS_SCORES_FILE_NAME = "diversity_representativeness_scores"
+REFERENCE_COUNTS_FILE_NAME = "diversity_reference_counts.json"
+
+
+class ReferencePopulation:
+    """
+    A reference population (eg: a census extract) that cohorts are compared with. The share of each
+    category of each column, and of each combination of categories of every pair of columns, is worked out
+    once, so that any number of cohorts can then be scored against it in a single call.
+
+    Cohorts and the reference must be counted with the same transformations and column names, so that
+    their categories match. Missing values are left out of both.
+    """
+
+    def __init__(self, counts, column_names=None):
+        """
+        Args:
+            counts: the DiversityCounts of the reference population
+            column_names (optional): the columns to compare, defaults to every column of counts
+        """
+        self.counts = counts
+        self.column_names = list(
+            column_names if column_names is not None else counts.column_names
+        )
+        self.column_counts = {
+            column_name: counts.column_counts(column_name).to_numpy()
+            for column_name in self.column_names
+        }
+        self.pair_counts = {}
+        for first_position, first_column_name in enumerate(self.column_names):
+            for second_column_name in self.column_names[first_position + 1 :]:
+                self.pair_counts[(first_column_name, second_column_name)] = (
+                    counts.pair_counts(first_column_name, second_column_name)
+                    .reindex(
+                        index=counts.levels[first_column_name],
+                        columns=counts.levels[second_column_name],
+                        fill_value=0,
+                    )
+                    .to_numpy()
+                )
+
+    @classmethod
+    def load(cls, file_path, column_names=None):
+        """reads a reference saved with ReferencePopulation.save"""
+        with open(file_path) as counts_file:
+            return cls(DiversityCounts.from_dict(json.load(counts_file)), column_names)
+
+    def save(self, file_path):
+        """saves the counts of the reference, so that it does not have to be read and transformed again"""
+        with open(file_path, "w") as counts_file:
+            json.dump(self.counts.to_dict(), counts_file)
+        logger.info(f"successfully saved reference to {file_path}")
+
+    def representation(self, cohort_counts):
+        """
+        Over and under representation of each category of each column in each cohort
+        Args:
+            cohort_counts: dictionary of cohort name to DiversityCounts, or a single DiversityCounts
+        Returns: a data frame with the columns 'cohort', 'column', 'category', 'cohort_count', 'cohort_share',
+        'reference_share' and 'representation_ratio' (cohort share / reference share, above 1 for
+        categories with more people than the reference)
+        """
+        cohort_counts = _named_cohorts(cohort_counts)
+        stacked_codes = self._stacked_codes(cohort_counts)
+        tables = []
+        for column_name in self.column_names:
+            labels = self.counts.levels[column_name]
+            reference_counts = self.column_counts[column_name]
+            reference_shares = reference_counts / max(reference_counts.sum(), 1)
+            matrix, _ = self._aligned_counts(
+                stacked_codes, len(cohort_counts), [column_name]
+            )
+            shares = matrix / np.maximum(matrix.sum(axis=1, keepdims=True), 1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratios = shares / reference_shares
+            tables.append(
+                pd.DataFrame(
+                    {
+                        "cohort": np.repeat(list(cohort_counts), len(labels)),
+                        "column": column_name,
+                        "category": np.tile(
+                            np.asarray(labels.astype(str), dtype=object),
+                            len(cohort_counts),
+                        ),
+                        "cohort_count": matrix.ravel(),
+                        "cohort_share": shares.ravel(),
+                        "reference_share": np.tile(
+                            reference_shares, len(cohort_counts)
+                        ),
+                        "representation_ratio": ratios.ravel(),
+                    }
+                )
+            )
+        return pd.concat(tables, ignore_index=True)
+
+    def scores(self, cohort_counts):
+        """
+        How far the distribution of each column, and of each pair of columns, of each cohort is from the
+        reference. People in categories the reference has no one in cannot be compared, they are counted in
+        'unmatched' and left out of the scores.
+        Args:
+            cohort_counts: dictionary of cohort name to DiversityCounts, or a single DiversityCounts
+        Returns: a data frame with the columns 'cohort', 'column_1', 'column_2' (None for a single column),
+        'people', 'unmatched', 'chi_square' (Pearson's, against the counts expected from the reference
+        shares), 'degrees_of_freedom', 'kl_divergence' (of the reference from the cohort, in bits) and
+        'js_divergence' (Jensen-Shannon, in bits, between 0 and 1)
+        """
+        cohort_counts = _named_cohorts(cohort_counts)
+        stacked_codes = self._stacked_codes(cohort_counts)
+        tables = []
+        for column_name in self.column_names:
+            matrix, unmatched = self._aligned_counts(
+                stacked_codes, len(cohort_counts), [column_name]
+            )
+            tables.append(
+                _score_table(
+                    cohort_counts,
+                    column_name,
+                    None,
+                    matrix,
+                    unmatched,
+                    self.column_counts[column_name],
+                )
+            )
+        for (first_column_name, second_column_name), table in self.pair_counts.items():
+            matrix, unmatched = self._aligned_counts(
+                stacked_codes,
+                len(cohort_counts),
+                [first_column_name, second_column_name],
+            )
+            tables.append(
+                _score_table(
+                    cohort_counts,
+                    first_column_name,
+                    second_column_name,
+                    matrix,
+                    unmatched,
+                    table.ravel(),
+                )
+            )
+        return pd.concat(tables, ignore_index=True)
+
+    def _stacked_codes(self, cohort_counts):
+        """
+        the combinations of categories of every cohort stacked together, with the codes of each column
+        translated to the categories of the reference: -1 for a missing value and -2 for a category the
+        reference does not have. Returns the cohort position and count of each combination and the codes.
+        """
+        cohort_positions, weights = [], []
+        codes = {column_name: [] for column_name in self.column_names}
+        for position, counts in enumerate(cohort_counts.values()):
+            cohort_positions.append(np.full(len(counts.cube), position))
+            weights.append(counts.cube[COUNT_COLUMN_NAME].to_numpy())
+            for column_name in self.column_names:
+                label_positions = self.counts.levels[column_name].get_indexer(
+                    counts.levels[column_name]
+                )
+                # the final entry maps missing values (-1) back to -1
+                code_lookup = np.append(
+                    np.where(label_positions >= 0, label_positions, -2), -1
+                )
+                codes[column_name].append(
+                    code_lookup[counts.cube[column_name].to_numpy()]
+                )
+        return (
+            np.concatenate(cohort_positions),
+            np.concatenate(weights),
+            {
+                column_name: np.concatenate(column_codes)
+                for column_name, column_codes in codes.items()
+            },
+        )
+
+    def _aligned_counts(self, stacked_codes, cohort_count, column_names):
+        """
+        counts of each cohort (rows) per cell of the reference (columns) of one column or a pair of columns,
+        and the number of people of each cohort in categories the reference does not have
+        """
+        cohort_positions, weights, codes = stacked_codes
+        present = np.ones(len(weights), dtype=bool)
+        matched = np.ones(len(weights), dtype=bool)
+        cell_positions = cohort_positions
+        cell_count = 1
+        for column_name in column_names:
+            level_count = len(self.counts.levels[column_name])
+            present &= codes[column_name] != -1
+            matched &= codes[column_name] >= 0
+            cell_positions = cell_positions * level_count + codes[column_name]
+            cell_count *= level_count
+        matched &= present
+        matrix = np.bincount(
+            cell_positions[matched],
+            weights=weights[matched],
+            minlength=cohort_count * cell_count,
+        ).reshape(cohort_count, cell_count)
+        unmatched = np.bincount(
+            cohort_positions[present & ~matched],
+            weights=weights[present & ~matched],
+            minlength=cohort_count,
+        )
+        return matrix.astype("int64"), unmatched.astype("int64")
+
+
+def count_reference(
+    assess_diversity,
+    file_path,
+    years_per_band,
+    column_names,
+    reference_column_names=None,
+    chunksize=None,
+):
+    """
+    Reads and counts a reference population with the same transformations as the cohorts
+    Args:
+        assess_diversity: the AssessDiversity the cohorts are transformed with
+        file_path: path to the csv, Parquet or Arrow IPC/Feather file of the reference
+        years_per_band: the number of years in each age band of the cohorts
+        column_names: dictionary of field to the column name of the cohorts, see load_column_names
+        reference_column_names (optional): dictionary of field to the column name in the reference, if its
+        columns are named differently. The columns are renamed to those of the cohorts.
+        chunksize (optional): read the reference this many rows at a time
+    Returns: the DiversityCounts of the reference, or None if it has no rows
+    """
+    if reference_column_names is None:
+        reference_column_names = column_names
+    data = read_demographic_data(file_path, reference_column_names, chunksize)
+    chunks = data if chunksize else [data]
+    renamed_columns = {
+        reference_column_names[field]: column_names[field]
+        for field in column_names
+        if reference_column_names.get(field) is not None
+        and column_names[field] is not None
+    }
+
+    counts = None
+    for chunk_df in chunks:
+        if chunk_df.empty:
+            continue
+        chunk_counts = assess_diversity.count_categories(
+            chunk_df.rename(columns=renamed_columns),
+            years_per_band,
+            column_names["age"],
+            column_names["sex"],
+            column_names["ethnicity"],
+            column_names["race"],
+            column_names["ses"],
+            column_names["is_deceased"],
+        )
+        counts = chunk_counts if counts is None else counts.merge(chunk_counts)
+    if counts is not None and "is_deceased" in counts.levels:
+        counts = counts.rename_levels("is_deceased", IS_DECEASED_LABELS)
+    return counts
+
+
+def write_representativeness_report(
+    reference, cohort_counts, output_directory_path, report_format="csv"
+):
+    """
+    Writes the representation ratios of each category to diversity_representation and the scores of each
+    column and pair of columns to diversity_representativeness_scores in the output directory
+    Args:
+        reference: a ReferencePopulation
+        cohort_counts: dictionary of cohort name to DiversityCounts, or a single DiversityCounts
+        output_directory_path: directory where the tables will be stored
+        report_format (optional): 'csv' (pipe delimited), 'parquet' or 'feather'
+    Returns: the data frames of representation ratios and of scores
+    """
+    representation_df = reference.representation(cohort_counts)
+    scores_df = reference.scores(cohort_counts)
+    for table_df, file_name in [
+        (representation_df, REPRESENTATION_REPORT_FILE_NAME),
+        (scores_df, REPRESENTATIVENESS_SCORES_FILE_NAME),
+    ]:
+        write_table(
+            table_df,
+            os.path.join(
+                output_directory_path, file_name + REPORT_FILE_EXTENSIONS[report_format]
+            ),
+            sep="|",
+        )
+    return representation_df, scores_df
+
+
+def _named_cohorts(cohort_counts):
+    if isinstance(cohort_counts, DiversityCounts):
+        return {"cohort": cohort_counts}
+    return dict(cohort_counts)
+
+
+def _score_table(
+    cohort_counts, first_column_name, second_column_name, matrix, unmatched, reference
+):
+    """scores of every cohort at once, from their counts (rows of matrix) per cell of the reference"""
+    # cells the reference has no one in cannot be compared
+    compared = reference > 0
+    unmatched = unmatched + matrix[:, ~compared].sum(axis=1)
+    matrix = matrix[:, compared].astype("float64")
+    reference_shares = reference[compared] / max(reference[compared].sum(), 1)
+    people = matrix.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shares = matrix / people[:, np.newaxis]
+        expected = people[:, np.newaxis] * reference_shares
+        chi_square = ((matrix - expected) ** 2 / expected).sum(axis=1)
+        kl_divergence = _relative_entropy(shares, reference_shares)
+        mixture = (shares + reference_shares) / 2
+        js_divergence = (
+            _relative_entropy(shares, mixture)
+            + _relative_entropy(reference_shares[np.newaxis, :], mixture)
+        ) / 2
+    empty = people == 0
+    for scores in [chi_square, kl_divergence, js_divergence]:
+        scores[empty] = np.nan
+    return pd.DataFrame(
+        {
+            "cohort": list(cohort_counts),
+            "column_1": first_column_name,
+            "column_2": second_column_name,
+            "people": people.astype("int64"),
+            "unmatched": unmatched,
+            "chi_square": chi_square,
+            "degrees_of_freedom": max(int(compared.sum()) - 1, 0),
+            "kl_divergence": kl_divergence,
+            "js_divergence": js_divergence,
+        }
+    )
+
+
+def _relative_entropy(shares, other_shares):
+    """sum(p * log2(p / q)) along the last axis, with 0 * log(0 / q) taken as 0"""
+    return np.where(shares > 0, shares * np.log2(shares / other_shares), 0.0).sum(
+        axis=-1
+    )
@@ -0,0 +1,282 @@
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+from diversity_analysis_tool.ipums_codes import (
+    IPUMS_EDUC_CODE_DICT,
+    IPUMS_RACE_CODE_DICT,
+    IPUMS_SEX_CODE_DICT,
+)
+from diversity_analysis_tool.nhs_codes import (
+    NHS_ETHNICITY_CODE_DICT,
+    NHS_RACE_CODE_DICT,
+    NHS_SEX_CODE_DICT,
+)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# The fields a coding scheme can map, in the order of the transform routines of AssessDiversity
+SCHEME_FIELDS = ("sex", "ethnicity", "race", "ses")
+
+
+class CodeLookup:
+    """
+    Maps source codes to labels. The code table is compiled once into an index of source codes and an array
+    of label positions. Mapping a column then looks up each distinct value once and translates the codes of
+    the rows with a single array lookup, so no Python code runs per row.
+    """
+
+    def __init__(self, code_dict, missing_label=None, missing_codes=(), ordered=False):
+        """
+        Args:
+            code_dict: dictionary of source code to label, the labels are ordered as listed
+            missing_label (optional): label given to empty values (eg: 'Unknown'). If None empty values
+            stay missing.
+            missing_codes (optional): source codes which should also be treated as empty values (eg: '')
+            ordered (optional): whether the labels have a meaningful order, eg: levels of education
+        """
+        self.code_dict = dict(code_dict)
+        self.missing_label = missing_label
+        self.missing_codes = list(missing_codes)
+        self.ordered = ordered
+
+        label_values = list(self.code_dict.values())
+        if missing_label is None:
+            self.labels = pd.Index(label_values).unique()
+            self.missing_position = -1
+        else:
+            self.labels = pd.Index(label_values + [missing_label]).unique()
+            self.missing_position = self.labels.get_loc(missing_label)
+        self.source_codes = pd.Index(list(self.code_dict.keys()) + self.missing_codes)
+        # one entry per source code, plus a final entry for values matching no source code
+        self.label_lookup = np.append(
+            self.labels.get_indexer(label_values),
+            [self.missing_position] * len(self.missing_codes) + [-1],
+        )
+        self.integer_codes = all(
+            isinstance(code, (int, np.integer)) and not isinstance(code, bool)
+            for code in self.code_dict
+        )
+
+    def map(self, values):
+        """
+        Args:
+            values: a series of source codes. Codes which are not in the code table keep their own value as a
+            label so that they still show up in the report.
+        Returns: a Categorical of labels
+        """
+        if self.integer_codes:
+            values = integer_codes(values)
+        if pd.api.types.is_categorical_dtype(values):
+            value_codes = np.asarray(values.cat.codes, dtype="int64")
+            uniques = pd.Index(values.cat.categories)
+        else:
+            value_codes, uniques = pd.factorize(values)
+            uniques = pd.Index(uniques)
+        label_codes, labels = self.map_codes(value_codes, uniques)
+        return pd.Categorical.from_codes(
+            label_codes, categories=labels, ordered=self.ordered
+        )
+
+    def map_codes(self, value_codes, uniques):
+        """
+        Maps values which are already encoded, eg: a categorical or the dictionary indices of an Arrow column
+        Args:
+            value_codes: integer array of the position of the value of each row in uniques, -1 when empty
+            uniques: a pandas Index of the distinct source codes
+        Returns: a tuple of the integer array of the position of the label of each row in the labels
+        (-1 when missing) and the pandas Index of labels
+        """
+        # values which no row has are left out, so they are not reported as unrecognised
+        present = np.bincount(value_codes[value_codes >= 0], minlength=len(uniques)) > 0
+        unique_label_codes = self.label_lookup[self.source_codes.get_indexer(uniques)]
+        labels = self.labels
+        unrecognised = (unique_label_codes == -1) & present
+        if unrecognised.any():
+            unrecognised_values = list(uniques[unrecognised])
+            logger.warning(f"Found codes with no label: {unrecognised_values}")
+            # values can read the same as a label or as each other, eg: 'White' or 1 and '1'
+            unrecognised_labels = pd.Index(
+                [str(value) for value in unrecognised_values]
+            )
+            labels = labels.append(
+                unrecognised_labels[~unrecognised_labels.isin(labels)].unique()
+            )
+            unique_label_codes[unrecognised] = labels.get_indexer(unrecognised_labels)
+
+        # the final entry maps empty values (-1) to the missing label
+        label_codes = np.append(unique_label_codes, self.missing_position)[value_codes]
+        return label_codes, labels
+
+    def to_dict(self):
+        """Returns: the field entry of a scheme file describing this lookup"""
+        return {
+            "codes": [[code, label] for code, label in self.code_dict.items()],
+            "missing_label": self.missing_label,
+            "missing_codes": self.missing_codes,
+            "ordered": self.ordered,
+        }
+
+    @classmethod
+    def from_dict(cls, field_dict):
+        """
+        Args:
+            field_dict: a field entry of a scheme file, see CodingScheme.from_dict
+        Returns: a CodeLookup
+        """
+        unknown_keys = set(field_dict) - {
+            "codes",
+            "missing_label",
+            "missing_codes",
+            "ordered",
+        }
+        if unknown_keys:
+            raise ValueError(f"Unknown keys {sorted(unknown_keys)} in scheme field")
+        if "codes" not in field_dict:
+            raise ValueError("A scheme field needs a list of [code, label] pairs in 'codes'")
+        return cls(
+            {code: label for code, label in field_dict["codes"]},
+            missing_label=field_dict.get("missing_label"),
+            missing_codes=field_dict.get("missing_codes", ()),
+            ordered=field_dict.get("ordered", False),
+        )
+
+
+class CodingScheme:
+    """
+    A named set of code tables, one per demographic field, eg: the NHS codes for sex, ethnicity and race.
+    Schemes are read from JSON files like:
+
+        {
+          "name": "hospital_a",
+          "fields": {
+            "sex": {"codes": [[1, "Male"], [2, "Female"]], "missing_label": "Unknown"},
+            "ses": {"codes": [["L", "Low"], ["M", "Middle"], ["H", "High"]], "ordered": true}
+          }
+        }
+
+    Each field lists its source codes with their labels (in order, which is the ordinal order when 'ordered'
+    is true), the label of empty values ('missing_label', null to leave them missing) and source codes which
+    mean the value is empty ('missing_codes').
+    """
+
+    def __init__(self, name, lookups):
+        """
+        Args:
+            name: name of the scheme
+            lookups: dictionary of field (one of SCHEME_FIELDS) to CodeLookup
+        """
+        unknown_fields = set(lookups) - set(SCHEME_FIELDS)
+        if unknown_fields:
+            raise ValueError(
+                f"Unknown fields {sorted(unknown_fields)} in scheme {name}, expected some of {list(SCHEME_FIELDS)}"
+            )
+        self.name = name
+        self.lookups = lookups
+
+    @classmethod
+    def from_dict(cls, scheme_dict):
+        return cls(
+            scheme_dict.get("name", "unnamed"),
+            {
+                field: CodeLookup.from_dict(field_dict)
+                for field, field_dict in scheme_dict.get("fields", {}).items()
+            },
+        )
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "fields": {field: lookup.to_dict() for field, lookup in self.lookups.items()},
+        }
+
+    def transform(self, field):
+        """
+        Returns: a transform routine for AssessDiversity mapping the codes of field, or None if the scheme does
+        not cover the field
+        """
+        if field not in self.lookups:
+            return None
+        return SchemeTransform(self, field)
+
+    def digest(self):
+        """a hash of the code tables, which changes whenever the scheme does"""
+        return hashlib.sha256(
+            json.dumps(self.to_dict(), sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()[:16]
+
+
+class SchemeTransform:
+    """
+    A transform routine mapping one field with a coding scheme. It takes (df, column_name) like the other
+    transform routines, and can be sent to worker processes unlike a closure.
+    """
+
+    def __init__(self, scheme, field):
+        self.scheme = scheme
+        self.field = field
+
+    def __call__(self, df, column_name):
+        if column_name not in df:
+            logger.info(f"No {self.field} field is present")
+            return df
+        df = df.copy(deep=False)
+        df[column_name] = self.scheme.lookups[self.field].map(df[column_name])
+        return df
+
+    def __repr__(self):
+        # used to tell whether saved results were made with the same scheme
+        return f"SchemeTransform({self.scheme.name}, {self.field}, {self.scheme.digest()})"
+
+
+def load_scheme(scheme):
+    """
+    Args:
+        scheme: the name of a built in scheme (see BUILT_IN_SCHEMES) or the path to a JSON scheme file
+    Returns: a CodingScheme
+    """
+    if scheme in BUILT_IN_SCHEMES:
+        return BUILT_IN_SCHEMES[scheme]
+    if not os.path.isfile(scheme):
+        raise ValueError(
+            f"{scheme} is neither a built in scheme ({list(BUILT_IN_SCHEMES)}) nor a scheme file"
+        )
+    with open(scheme) as scheme_file:
+        return CodingScheme.from_dict(json.load(scheme_file))
+
+
+def integer_codes(values):
+    """numeric codes as integers (eg: 1.0 as 1), categoricals are left as they are and matched on their categories"""
+    if pd.api.types.is_categorical_dtype(values):
+        return values
+    return values.astype("Int64")
+
+
+BUILT_IN_SCHEMES = {
+    "nhs": CodingScheme(
+        "nhs",
+        {
+            "sex": CodeLookup(NHS_SEX_CODE_DICT, "Unknown"),
+            "ethnicity": CodeLookup(
+                NHS_ETHNICITY_CODE_DICT,
+                NHS_ETHNICITY_CODE_DICT["Unknown"],
+                missing_codes=[""],
+            ),
+            "race": CodeLookup(NHS_RACE_CODE_DICT, NHS_RACE_CODE_DICT["Unknown"]),
+        },
+    ),
+    # for raw IPUMS USA extracts, see clean_ipums_script for cleaning them into labels instead
+    "ipums": CodingScheme(
+        "ipums",
+        {
+            "sex": CodeLookup(IPUMS_SEX_CODE_DICT),
+            "race": CodeLookup(IPUMS_RACE_CODE_DICT),
+            "ses": CodeLookup(IPUMS_EDUC_CODE_DICT, ordered=True),
+        },
+    ),
+}
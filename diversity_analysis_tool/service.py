@@ -0,0 +1,526 @@
+import os
+import json
+import time
+import uuid
+import logging
+import argparse
+import threading
+import functools
+import collections
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from diversity_analysis_tool.diversity import (
+    MISSING_LABEL,
+    AssessDiversity,
+    transform_ses_order,
+)
+from diversity_analysis_tool.disclosure import DisclosureControl
+from diversity_analysis_tool.html_report import write_html_report
+from diversity_analysis_tool.loading import (
+    REPORT_FILE_EXTENSIONS,
+    load_column_names,
+    read_demographic_data,
+)
+from diversity_analysis_tool.schemes import BUILT_IN_SCHEMES, load_scheme
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_PORT = 8787
+DEFAULT_MAX_PENDING = 16
+DEFAULT_TIMEOUT_SECONDS = 600
+# Number of the latest reports the timings of /status are computed over
+TIMING_WINDOW = 1000
+# Content types of uploaded data and the file extension they are saved with
+UPLOAD_EXTENSIONS = {
+    "text/csv": ".csv",
+    "application/vnd.apache.parquet": ".parquet",
+    "application/vnd.apache.arrow.file": ".feather",
+}
+# Report parameters and their types, given as a JSON body or, for uploads, in the query string
+REPORT_PARAMETERS = {
+    "input_path": str,
+    "output_dir": str,
+    "scheme": str,
+    "years_per_band": int,
+    "chunksize": int,
+    "report_type": str,
+    "report_format": str,
+    "render_graphs": bool,
+    "html_report": bool,
+    "sort_rows": bool,
+    "k_anonymity": int,
+    "columns": dict,
+}
+
+# AssessDiversity instances of a worker process by scheme and k, with the modification time of the scheme
+# file they were loaded from, reused across reports
+_assessors = {}
+
+
+class ReportService:
+    """
+    Runs diversity reports for many small requests without paying for start up each time. The worker
+    processes are started once, import pandas, matplotlib and seaborn and load the coding schemes once, and
+    keep their AssessDiversity instances between reports.
+
+    At most workers reports run at the same time and at most max_pending more wait for a worker, further
+    requests are turned away straight away rather than queueing without bound. A report that timed out keeps
+    its slot and uploaded data until its worker is done with it, as a running report cannot be stopped.
+    """
+
+    def __init__(
+        self,
+        output_root,
+        workers=None,
+        max_pending=DEFAULT_MAX_PENDING,
+        timeout=DEFAULT_TIMEOUT_SECONDS,
+    ):
+        """
+        Args:
+            output_root: directory where reports without an output_dir and uploaded data are stored
+            workers (optional): number of worker processes, defaults to the number of CPUs
+            max_pending (optional): number of reports which may wait for a worker, defaults to 16
+            timeout (optional): seconds a request waits for its report, defaults to 600
+        """
+        self.output_root = output_root
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_warm_up
+        )
+        self._slots = threading.BoundedSemaphore(self.workers + max_pending)
+        self._lock = threading.Lock()
+        self._durations = collections.deque(maxlen=TIMING_WINDOW)
+        self._counters = collections.Counter()
+        self._started = time.time()
+        # starts the workers now rather than on the first request
+        for future in [self._executor.submit(_warm_up) for _ in range(self.workers)]:
+            future.result()
+
+    def run(self, parameters, upload=None, upload_content_type="text/csv"):
+        """
+        Runs a report on the worker pool and waits for it
+        Args:
+            parameters: dictionary of report parameters, see REPORT_PARAMETERS and run_report
+            upload (optional): bytes of the data to assess instead of parameters['input_path']
+            upload_content_type (optional): the format of upload, one of UPLOAD_EXTENSIONS
+        Returns: the result of run_report, with the 'queue_seconds' spent waiting for a worker and the
+        'seconds' the whole request took
+        Raises: ServiceBusy when every worker and pending slot is taken, TimeoutError when the report takes
+        longer than the timeout, ValueError for invalid parameters
+        """
+        start = time.perf_counter()
+        if not self._slots.acquire(blocking=False):
+            self._count("rejected")
+            raise ServiceBusy(
+                f"{self.workers} reports running and {self.max_pending} waiting"
+            )
+        upload_file_path = None
+        future = None
+        try:
+            parameters = dict(parameters)
+            report_id = uuid.uuid4().hex
+            if upload is not None:
+                if upload_content_type not in UPLOAD_EXTENSIONS:
+                    raise ValueError(
+                        f"Unknown content type {upload_content_type}, expected one of {list(UPLOAD_EXTENSIONS)}"
+                    )
+                upload_directory_path = os.path.join(self.output_root, "uploads")
+                os.makedirs(upload_directory_path, exist_ok=True)
+                upload_file_path = os.path.join(
+                    upload_directory_path,
+                    report_id + UPLOAD_EXTENSIONS[upload_content_type],
+                )
+                with open(upload_file_path, "wb") as upload_file:
+                    upload_file.write(upload)
+                parameters["input_path"] = upload_file_path
+            if not parameters.get("input_path"):
+                raise ValueError("Either an input_path or uploaded data is needed")
+            parameters.setdefault(
+                "output_dir", os.path.join(self.output_root, report_id)
+            )
+
+            future = self._executor.submit(run_report, parameters, time.time())
+            self._count("submitted")
+        finally:
+            if future is None:
+                self._release(upload_file_path)
+        # the slot and the upload are only given back once the report is done, even after a timeout
+        finish = functools.partial(self._finish, upload_file_path, threading.Event())
+        future.add_done_callback(finish)
+        try:
+            result = future.result(timeout=self.timeout)
+        except TimeoutError:
+            # only stops reports which are still waiting for a worker
+            future.cancel()
+            self._count("timed_out")
+            raise
+        except Exception:
+            finish()
+            self._count("failed")
+            raise
+        # done callbacks can run after result returns
+        finish()
+
+        result["id"] = report_id
+        result["seconds"] = time.perf_counter() - start
+        with self._lock:
+            self._counters["completed"] += 1
+            self._durations.append(result["seconds"])
+        logger.info(
+            f"Report {report_id} of {result['rows']} rows took {result['seconds']:.3f}s"
+        )
+        return result
+
+    def status(self):
+        """
+        Returns: a dictionary of the concurrency limits, the number of requests by outcome and the
+        timings of the latest requests
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            durations = sorted(self._durations)
+        # including reports which timed out but are still running
+        in_flight = counters.get("submitted", 0) - counters.get("finished", 0)
+        timings = {"count": len(durations)}
+        if durations:
+            timings.update(
+                mean_seconds=sum(durations) / len(durations),
+                p50_seconds=durations[len(durations) // 2],
+                p95_seconds=durations[
+                    min(len(durations) - 1, int(len(durations) * 0.95))
+                ],
+                max_seconds=durations[-1],
+            )
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "timeout_seconds": self.timeout,
+            "in_flight": in_flight,
+            "uptime_seconds": time.time() - self._started,
+            "requests": counters,
+            "timings": timings,
+        }
+
+    def close(self):
+        self._executor.shutdown()
+
+    def _count(self, outcome):
+        with self._lock:
+            self._counters[outcome] += 1
+
+    def _finish(self, upload_file_path, finished, future=None):
+        """releases the slot and upload of a report that is done, once, from either run or the done callback"""
+        # under the lock, so that the slot and upload are given back by the time either call returns
+        with self._lock:
+            if finished.is_set():
+                return
+            finished.set()
+            self._counters["finished"] += 1
+            self._release(upload_file_path)
+
+    def _release(self, upload_file_path):
+        self._slots.release()
+        if upload_file_path is not None and os.path.exists(upload_file_path):
+            os.remove(upload_file_path)
+
+
+class ServiceBusy(Exception):
+    """raised when a report cannot be taken on as every worker and pending slot is taken"""
+
+
+def run_report(parameters, submitted_at=None):
+    """
+    Runs one report in a worker process
+    Args:
+        parameters: dictionary with the 'input_path' of the data and the 'output_dir' of the report, and
+        optionally the 'scheme' to map codes with (nhs, ipums or a scheme file), 'years_per_band' (5),
+        'columns' mapping fields to column names, 'chunksize', 'report_type' ('aggregate'), 'report_format'
+        ('csv'), 'render_graphs' (True), 'html_report' (False), 'sort_rows' (True) and 'k_anonymity'
+        submitted_at (optional): time the report was submitted at, to tell how long it waited for a worker
+    Returns: a dictionary with the number of 'rows', the 'output_dir', the 'artifacts' written to it, the
+    'aggregates' ('categories' and 'missing' tables as lists of records), the 'queue_seconds' and the
+    'report_seconds'
+    """
+    queue_seconds = time.time() - submitted_at if submitted_at is not None else None
+    start = time.perf_counter()
+    unknown_parameters = set(parameters) - set(REPORT_PARAMETERS)
+    if unknown_parameters:
+        raise ValueError(
+            f"Unknown parameters {sorted(unknown_parameters)}, expected some of {list(REPORT_PARAMETERS)}"
+        )
+    assess_diversity = _assessor(
+        parameters.get("scheme"), parameters.get("k_anonymity")
+    )
+    column_names = load_column_names(**parameters.get("columns", {}))
+    report_arguments = (
+        parameters.get("years_per_band", 5),
+        column_names["age"],
+        column_names["sex"],
+        column_names["ethnicity"],
+        column_names["race"],
+        column_names["ses"],
+        column_names["is_deceased"],
+        parameters["output_dir"],
+    )
+    report_options = dict(
+        report_format=parameters.get("report_format", "csv"),
+        render_graphs=parameters.get("render_graphs", True),
+        report_type=parameters.get("report_type", "aggregate"),
+        sort_rows=parameters.get("sort_rows", True),
+    )
+    if report_options["report_format"] not in REPORT_FILE_EXTENSIONS:
+        raise ValueError(
+            f"Unknown report format {report_options['report_format']}, expected one of {list(REPORT_FILE_EXTENSIONS)}"
+        )
+    chunksize = parameters.get("chunksize")
+    data = read_demographic_data(parameters["input_path"], column_names, chunksize)
+    if chunksize:
+        counts = assess_diversity.create_diversity_analysis_report_from_chunks(
+            data, *report_arguments, **report_options
+        )
+    else:
+        counts = assess_diversity.create_diversity_analysis_report(
+            data, *report_arguments, **report_options
+        )
+    if counts is not None and parameters.get("html_report"):
+        write_html_report(counts, parameters["output_dir"])
+
+    output_directory_path = parameters["output_dir"]
+    return {
+        "rows": counts.row_count if counts is not None else 0,
+        "output_dir": output_directory_path,
+        "artifacts": sorted(
+            os.path.join(output_directory_path, file_name)
+            for file_name in os.listdir(output_directory_path)
+        )
+        if os.path.isdir(output_directory_path)
+        else [],
+        "aggregates": {
+            "categories": counts.category_table(MISSING_LABEL).to_dict("records"),
+            "missing": counts.missing_table().to_dict("records"),
+        }
+        if counts is not None
+        else None,
+        "queue_seconds": queue_seconds,
+        "report_seconds": time.perf_counter() - start,
+    }
+
+
+def serve(
+    host="127.0.0.1",
+    port=DEFAULT_PORT,
+    output_root="diversity_reports",
+    workers=None,
+    max_pending=DEFAULT_MAX_PENDING,
+    timeout=DEFAULT_TIMEOUT_SECONDS,
+):
+    """
+    Serves reports over HTTP until interrupted:
+
+    - POST /reports with a JSON object of parameters (see run_report) runs a report on a file the service
+      can read, POST /reports?scheme=nhs&... with a text/csv, application/vnd.apache.parquet or
+      application/vnd.apache.arrow.file body runs it on the uploaded data. The response holds the aggregates
+      and the paths of the files written, with the time spent waiting and reporting in a Server-Timing
+      header. 503 is returned when too many reports are running, 504 when a report times out.
+    - GET /status returns the concurrency limits, the number of requests by outcome and their timings.
+
+    Requests can read and write any path the service can, so it only listens on localhost by default.
+    Args:
+        host, port (optional): address to listen on, defaults to 127.0.0.1:8787
+        output_root, workers, max_pending, timeout (optional): see ReportService
+    """
+    service = ReportService(output_root, workers, max_pending, timeout)
+    server = ReportHTTPServer((host, port), service)
+    logger.info(
+        f"Serving reports on http://{host}:{server.server_port} with {service.workers} workers"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+class ReportHTTPServer(ThreadingHTTPServer):
+    """an HTTP server handing each request to a ReportService on its own thread"""
+
+    daemon_threads = True
+
+    def __init__(self, server_address, service):
+        super().__init__(server_address, _ReportRequestHandler)
+        self.service = service
+
+
+class _ReportRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlparse(self.path).path == "/status":
+            self._send_json(HTTPStatus.OK, self.server.service.status())
+        else:
+            self._send_json(
+                HTTPStatus.NOT_FOUND, {"error": f"Unknown path {self.path}"}
+            )
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/reports":
+            self._send_json(
+                HTTPStatus.NOT_FOUND, {"error": f"Unknown path {self.path}"}
+            )
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            content_type = self.headers.get_content_type()
+            if content_type == "application/json":
+                parameters, upload = json.loads(body or b"{}"), None
+            else:
+                parameters, upload = _query_parameters(url.query), body
+            result = self.server.service.run(parameters, upload, content_type)
+        except ServiceBusy as error:
+            self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"error": str(error)})
+        except TimeoutError:
+            self._send_json(
+                HTTPStatus.GATEWAY_TIMEOUT, {"error": "The report took too long"}
+            )
+        except (ValueError, KeyError, OSError) as error:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": str(error)})
+        except Exception as error:
+            logger.exception("Report failed")
+            self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(error)})
+        else:
+            self._send_json(
+                HTTPStatus.OK,
+                result,
+                {
+                    "Server-Timing": (
+                        f"queue;dur={1000 * (result['queue_seconds'] or 0):.1f}, "
+                        f"report;dur={1000 * result['report_seconds']:.1f}, "
+                        f"total;dur={1000 * result['seconds']:.1f}"
+                    )
+                },
+            )
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def _query_parameters(query):
+    """report parameters given in a query string, converted to their types"""
+    parameters = {}
+    for name, values in parse_qs(query).items():
+        parameter_type = REPORT_PARAMETERS.get(name)
+        value = values[-1]
+        if parameter_type is bool:
+            value = value.lower() in ("1", "true", "yes")
+        elif parameter_type is int:
+            value = int(value)
+        elif parameter_type is dict:
+            value = json.loads(value)
+        parameters[name] = value
+    return parameters
+
+
+def _warm_up():
+    """imports the plotting stack and sets the graph style once per worker process"""
+    from diversity_analysis_tool.graph_construction import set_graph_style
+
+    set_graph_style()
+
+
+def _assessor(scheme, k_anonymity):
+    key = (scheme, k_anonymity)
+    # a scheme file edited while the service runs is loaded again
+    scheme_mtime = (
+        os.path.getmtime(scheme)
+        if scheme and scheme not in BUILT_IN_SCHEMES and os.path.isfile(scheme)
+        else None
+    )
+    if key not in _assessors or _assessors[key][0] != scheme_mtime:
+        transforms = {"ethnicity": None, "race": None, "sex": None, "ses": None}
+        if scheme:
+            coding_scheme = load_scheme(scheme)
+            transforms = {field: coding_scheme.transform(field) for field in transforms}
+        if transforms["ses"] is None:
+            transforms["ses"] = transform_ses_order
+        _assessors[key] = (
+            scheme_mtime,
+            AssessDiversity(
+                transforms["ethnicity"],
+                transforms["race"],
+                transforms["sex"],
+                transforms["ses"],
+                disclosure_control=DisclosureControl(k_anonymity)
+                if k_anonymity
+                else None,
+            ),
+        )
+    return _assessors[key][1]
+
+
+def main():
+    """
+    Command line entry point of the report service
+    """
+    parser = argparse.ArgumentParser(
+        description="serve diversity reports over HTTP from warm worker processes"
+    )
+    parser.add_argument(
+        "--host", type=str, default="127.0.0.1", help="Address to listen on."
+    )
+    parser.add_argument(
+        "--port", type=int, default=DEFAULT_PORT, help="Port to listen on."
+    )
+    parser.add_argument(
+        "--output-root",
+        type=str,
+        default="diversity_reports",
+        help="Directory for reports requested without an output_dir and for uploaded data.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of reports run at the same time, defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=DEFAULT_MAX_PENDING,
+        help="Number of reports which may wait for a worker before requests are turned away.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT_SECONDS,
+        help="Seconds a request waits for its report.",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Increase logging verbosity."
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    serve(
+        args.host,
+        args.port,
+        args.output_root,
+        args.workers,
+        args.max_pending,
+        args.timeout,
+    )
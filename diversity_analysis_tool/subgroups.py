@@ -0,0 +1,301 @@
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+from diversity_analysis_tool.aggregates import COUNT_COLUMN_NAME
+from diversity_analysis_tool.loading import REPORT_FILE_EXTENSIONS, write_table
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+SUBGROUP_REPORT_FILE_NAME = "diversity_subgroups"
+DEFAULT_MAX_ORDER = 3
+DEFAULT_MIN_SUPPORT = 0.01
+DEFAULT_MIN_DROP = 0.05
+
+
+def find_underrepresented_subgroups(
+    counts,
+    column_names=None,
+    max_order=DEFAULT_MAX_ORDER,
+    min_support=DEFAULT_MIN_SUPPORT,
+    max_ratio=1.0,
+    min_drop=DEFAULT_MIN_DROP,
+    top=20,
+):
+    """
+    Finds the intersections of categories (eg: age band 70 - 75, Bangladeshi, Female, IMD decile 1) with the
+    fewest people compared with the number expected from the cohort's own marginals, ie: if each column was
+    independent of the others. A subgroup of categories c1..ck is expected to hold N * p(c1) * ... * p(ck)
+    people, where N is the number of people and p(c) the share of people in category c.
+
+    Subgroups are enumerated level by level like Apriori: a subgroup of k columns is only built from a
+    subgroup of its first k - 1 columns that was kept, and is kept itself when at least min_support of the
+    cohort is expected in it. The expected share only shrinks as columns are added, so pruning never loses a
+    subgroup, and at most 1 / min_support subgroups are kept per set of columns whatever the number of
+    levels. Subgroups with no people at all are found as well. Observed numbers are summed from the counts,
+    so rows are never read again.
+
+    Columns where one determines the other (eg: race is a grouping of ethnicity) are never combined, as
+    their empty combinations say nothing about the cohort. A subgroup is only reported if its ratio is lower
+    than the ratio of every subgroup it extends, so a category that changes nothing (eg: is_deceased=False)
+    does not repeat a subgroup.
+    Args:
+        counts: the DiversityCounts of the transformed data
+        column_names (optional): the columns to combine, defaults to every column of counts
+        max_order (optional): largest number of columns in a subgroup, defaults to 3
+        min_support (optional): share of the cohort a subgroup must be expected to hold to be assessed,
+        so that small subgroups are not reported on chance alone. Defaults to 0.01.
+        max_ratio (optional): only subgroups with at most this ratio of observed to expected people are
+        reported, defaults to 1 (no more people than expected)
+        min_drop (optional): share by which the ratio of a subgroup must be lower than the ratio of each
+        subgroup it extends to be reported, defaults to 0.05
+        top (optional): number of subgroups to report, None reports every one
+    Returns: a data frame with one row per subgroup, most under-represented first, with the columns 'order'
+    (number of columns in the subgroup), 'subgroup', one column per column of counts holding the category of
+    the subgroup (or None), 'observed', 'expected' and 'representation_ratio' (observed / expected)
+    """
+    if column_names is None:
+        column_names = counts.column_names
+    column_names = list(column_names)
+    row_count = counts.row_count
+    result_column_names = (
+        ["order", "subgroup"]
+        + column_names
+        + ["observed", "expected", "representation_ratio"]
+    )
+    if row_count == 0:
+        return pd.DataFrame(columns=result_column_names)
+    min_count = min_support * row_count
+
+    # the categories of each column expected to hold enough people, and their share of the cohort
+    singles = {}
+    for column_name in column_names:
+        shares = counts.column_counts(column_name).to_numpy() / row_count
+        single_codes = np.nonzero(shares * row_count >= min_count)[0]
+        singles[column_name] = (single_codes, shares[single_codes])
+
+    nested_column_names = _nested_column_names(counts, column_names)
+
+    # subgroups kept at the current order, by the tuple of their columns: codes (one row per subgroup) and
+    # expected number of people
+    kept = {
+        (column_name,): (single_codes[:, np.newaxis], shares * row_count)
+        for column_name, (single_codes, shares) in singles.items()
+        if len(single_codes)
+    }
+    # ratios of the subgroups kept at the previous order, by the tuple of their columns: sorted keys of
+    # their codes and the ratio of each
+    previous_ratios = {}
+    tables = []
+    for order in range(2, max_order + 1):
+        next_kept = {}
+        for subgroup_column_names, (prefix_codes, prefix_expected) in kept.items():
+            last_position = column_names.index(subgroup_column_names[-1])
+            for column_name in column_names[last_position + 1 :]:
+                if any(
+                    frozenset([prefix_column_name, column_name]) in nested_column_names
+                    for prefix_column_name in subgroup_column_names
+                ):
+                    continue
+                single_codes, shares = singles[column_name]
+                expected = np.outer(prefix_expected, shares).ravel()
+                keep = np.nonzero(expected >= min_count)[0]
+                if not len(keep):
+                    continue
+                prefix_positions, single_positions = np.divmod(keep, len(single_codes))
+                next_kept[subgroup_column_names + (column_name,)] = (
+                    np.column_stack(
+                        [prefix_codes[prefix_positions], single_codes[single_positions]]
+                    ),
+                    expected[keep],
+                )
+        kept = next_kept
+        if not kept:
+            break
+        logger.debug(
+            f"Assessing {sum(len(expected) for _, expected in kept.values())} subgroups of {order} columns"
+        )
+        ratios = {}
+        for subgroup_column_names, (subgroup_codes, expected) in kept.items():
+            observed = _observed_counts(counts, subgroup_column_names, subgroup_codes)
+            ratio = observed / expected
+            ratios[subgroup_column_names] = _ratio_lookup(
+                counts, subgroup_column_names, subgroup_codes, ratio
+            )
+            parent_ratio = np.ones(len(ratio))
+            if order > 2:
+                for position in range(order):
+                    parent_ratio = np.minimum(
+                        parent_ratio,
+                        _parent_ratios(
+                            counts,
+                            previous_ratios,
+                            subgroup_column_names,
+                            subgroup_codes,
+                            position,
+                        ),
+                    )
+            keep = (ratio <= max_ratio) & (ratio < parent_ratio * (1 - min_drop))
+            if keep.any():
+                tables.append(
+                    _subgroup_table(
+                        counts,
+                        column_names,
+                        subgroup_column_names,
+                        subgroup_codes[keep],
+                        observed[keep],
+                        expected[keep],
+                    )
+                )
+        previous_ratios = ratios
+
+    if not tables:
+        return pd.DataFrame(columns=result_column_names)
+    subgroups_df = pd.concat(tables, ignore_index=True)[result_column_names]
+    # of equally under-represented subgroups, the larger ones are the less likely to be chance
+    subgroups_df = subgroups_df.sort_values(
+        ["representation_ratio", "expected"], ascending=[True, False], kind="mergesort"
+    ).reset_index(drop=True)
+    if top is not None:
+        subgroups_df = subgroups_df.head(top)
+    return subgroups_df
+
+
+def write_subgroup_report(
+    counts,
+    output_directory_path,
+    report_format="csv",
+    max_order=DEFAULT_MAX_ORDER,
+    min_support=DEFAULT_MIN_SUPPORT,
+    column_names=None,
+):
+    """
+    Writes the most under-represented subgroups to diversity_subgroups in the output directory, see
+    find_underrepresented_subgroups
+    Args:
+        counts: the DiversityCounts of the transformed data
+        output_directory_path: directory where the table will be stored
+        report_format (optional): 'csv' (pipe delimited), 'parquet' or 'feather'
+        max_order, min_support, column_names (optional): see find_underrepresented_subgroups
+    Returns: the data frame of subgroups
+    """
+    subgroups_df = find_underrepresented_subgroups(
+        counts, column_names, max_order=max_order, min_support=min_support
+    )
+    write_table(
+        subgroups_df,
+        os.path.join(
+            output_directory_path,
+            SUBGROUP_REPORT_FILE_NAME + REPORT_FILE_EXTENSIONS[report_format],
+        ),
+        sep="|",
+    )
+    return subgroups_df
+
+
+def _nested_column_names(counts, column_names):
+    """
+    pairs of columns where one determines the other: each category of one only occurs with a single category
+    of the other. Catch-all categories occurring with every category of the other column (eg: 'Unknown') are
+    left out, as long as the rest of the categories still hold most of the people.
+    """
+    nested_column_names = set()
+    for first_position, first_column_name in enumerate(column_names):
+        for second_column_name in column_names[first_position + 1 :]:
+            table = counts.pair_counts(first_column_name, second_column_name).to_numpy()
+            occurs = table > 0
+            rows = ~occurs.all(axis=1)
+            columns = ~occurs.all(axis=0)
+            table = table[rows][:, columns]
+            occurs = occurs[rows][:, columns]
+            if not table.size or table.sum() * 2 < counts.row_count:
+                continue
+            if (occurs.sum(axis=1) <= 1).all() or (occurs.sum(axis=0) <= 1).all():
+                logger.debug(
+                    f"Not combining {first_column_name} with {second_column_name}, one determines the other"
+                )
+                nested_column_names.add(
+                    frozenset([first_column_name, second_column_name])
+                )
+    return nested_column_names
+
+
+def _subgroup_keys(counts, subgroup_column_names, subgroup_codes):
+    """a single integer per subgroup, from the codes of its categories"""
+    return np.ravel_multi_index(
+        tuple(subgroup_codes.T),
+        tuple(len(counts.levels[column_name]) for column_name in subgroup_column_names),
+    )
+
+
+def _ratio_lookup(counts, subgroup_column_names, subgroup_codes, ratio):
+    keys = _subgroup_keys(counts, subgroup_column_names, subgroup_codes)
+    order = np.argsort(keys)
+    return keys[order], ratio[order]
+
+
+def _parent_ratios(
+    counts, previous_ratios, subgroup_column_names, subgroup_codes, position
+):
+    """ratios of the subgroups made by leaving out the category at position, which were all kept before"""
+    parent_column_names = (
+        subgroup_column_names[:position] + subgroup_column_names[position + 1 :]
+    )
+    parent_keys, parent_ratios = previous_ratios[parent_column_names]
+    keys = _subgroup_keys(
+        counts, parent_column_names, np.delete(subgroup_codes, position, axis=1)
+    )
+    return parent_ratios[np.searchsorted(parent_keys, keys)]
+
+
+def _observed_counts(counts, subgroup_column_names, subgroup_codes):
+    """number of people in each subgroup, summed over the combinations of the counts"""
+    cube_codes = np.column_stack(
+        [counts.cube[column_name].to_numpy() for column_name in subgroup_column_names]
+    )
+    # combinations with a missing value in any of the columns are in none of the subgroups
+    present = (cube_codes >= 0).all(axis=1)
+    level_counts = tuple(
+        len(counts.levels[column_name]) for column_name in subgroup_column_names
+    )
+    cube_keys = np.ravel_multi_index(tuple(cube_codes[present].T), level_counts)
+    unique_keys, key_positions = np.unique(cube_keys, return_inverse=True)
+    key_counts = np.bincount(
+        key_positions,
+        weights=counts.cube[COUNT_COLUMN_NAME].to_numpy()[present],
+        minlength=len(unique_keys),
+    )
+
+    if not len(unique_keys):
+        return np.zeros(len(subgroup_codes))
+    subgroup_keys = _subgroup_keys(counts, subgroup_column_names, subgroup_codes)
+    positions = np.minimum(
+        np.searchsorted(unique_keys, subgroup_keys), len(unique_keys) - 1
+    )
+    return np.where(unique_keys[positions] == subgroup_keys, key_counts[positions], 0.0)
+
+
+def _subgroup_table(
+    counts, column_names, subgroup_column_names, subgroup_codes, observed, expected
+):
+    table = {
+        "order": len(subgroup_column_names),
+        "observed": observed.astype("int64"),
+        "expected": expected,
+        "representation_ratio": observed / expected,
+    }
+    subgroup_labels = []
+    for column_name in column_names:
+        if column_name in subgroup_column_names:
+            labels = np.asarray(counts.levels[column_name].astype(str), dtype=object)[
+                subgroup_codes[:, subgroup_column_names.index(column_name)]
+            ]
+            subgroup_labels.append([f"{column_name}={label}" for label in labels])
+        else:
+            labels = np.full(len(subgroup_codes), None, dtype=object)
+        table[column_name] = labels
+    table["subgroup"] = [", ".join(labels) for labels in zip(*subgroup_labels)]
+    return pd.DataFrame(table)
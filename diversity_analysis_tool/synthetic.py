@@ -0,0 +1,164 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from diversity_analysis_tool.nhs_codes import (
+    NHS_ETHNICITY_CODE_DICT,
+    NHS_SEX_CODE_DICT,
+)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Share of missing values per column in generated NHS cohorts. Ethnicity is the field most often left empty
+# in hospital records.
+NHS_MISSING_RATES = {
+    "age": 0.01,
+    "sex": 0.005,
+    "ethnicity": 0.12,
+    "race": 0.12,
+    "ses": 0.05,
+    "is_deceased": 0.02,
+}
+
+# Rough shares of NHS ethnicity codes, 'Unknown' is left out as it is not a code found in the data
+NHS_ETHNICITY_WEIGHTS = dict(
+    A=0.74,
+    B=0.01,
+    C=0.05,
+    D=0.008,
+    E=0.004,
+    F=0.006,
+    G=0.005,
+    H=0.026,
+    J=0.02,
+    K=0.008,
+    L=0.015,
+    M=0.011,
+    N=0.018,
+    P=0.005,
+    R=0.007,
+    S=0.01,
+    Z=0.032,
+)
+
+NHS_SEX_WEIGHTS = {1: 0.49, 2: 0.505, 8: 0.005}
+
+# Code ranges of the IPUMS USA extract in input/usa_00004.csv
+IPUMS_SEX_CODES = [1, 2]
+IPUMS_RACE_CODES = list(range(1, 10))
+IPUMS_EDUC_CODES = list(range(0, 12))
+IPUMS_RACE_WEIGHTS = [0.72, 0.125, 0.01, 0.015, 0.005, 0.045, 0.05, 0.028, 0.002]
+
+# The sizes the benchmarks run at
+COHORT_SIZES = {"10k": 10_000, "1M": 1_000_000, "50M": 50_000_000}
+
+
+def generate_nhs_cohort(row_count, seed=0, missing_rates=None):
+    """
+    Generates a synthetic demographic data frame coded like NHS hospital data, for testing and benchmarking.
+    Ethnicity codes come from NHS_ETHNICITY_CODE_DICT, race uses the same codes (the NHS groups them into
+    races) and sex codes come from NHS_SEX_CODE_DICT. ses is an index of multiple deprivation decile with
+    its numeric level in ses_level. Coded columns are categoricals so that large cohorts stay small in memory.
+    Args:
+        row_count: number of people in the cohort
+        seed (optional): seed of the random number generator, the same seed gives the same cohort
+        missing_rates (optional): dictionary of column name to share of missing values, defaults to
+        NHS_MISSING_RATES
+    Returns: a data frame with the columns age, sex, ethnicity, race, ses, ses_level and is_deceased
+    """
+    rng = np.random.default_rng(seed)
+    missing_rates = NHS_MISSING_RATES if missing_rates is None else missing_rates
+
+    ethnicity_codes = [code for code in NHS_ETHNICITY_CODE_DICT if code != "Unknown"]
+    ethnicity = _weighted_codes(
+        rng, row_count, [NHS_ETHNICITY_WEIGHTS[code] for code in ethnicity_codes]
+    )
+    deprivation_decile = rng.integers(1, 11, size=row_count, dtype="int8")
+    ses_labels = [f"IMD decile {decile}" for decile in range(1, 11)]
+
+    df = pd.DataFrame(
+        {
+            "age": _ages(rng, row_count),
+            "sex": pd.Categorical.from_codes(
+                _weighted_codes(rng, row_count, list(NHS_SEX_WEIGHTS.values())),
+                categories=list(NHS_SEX_CODE_DICT.keys()),
+            ),
+            "ethnicity": pd.Categorical.from_codes(
+                ethnicity, categories=ethnicity_codes
+            ),
+            # most records give the same code for both, which is what makes them correlated
+            "race": pd.Categorical.from_codes(ethnicity, categories=ethnicity_codes),
+            "ses": pd.Categorical.from_codes(
+                deprivation_decile - 1, categories=ses_labels
+            ),
+            "ses_level": pd.array(deprivation_decile, dtype="Int8"),
+            "is_deceased": pd.array(rng.random(row_count) < 0.03, dtype="boolean"),
+        }
+    )
+    df = _add_missing_values(rng, df, missing_rates)
+    df.loc[df["ses"].isna(), "ses_level"] = None
+    return df
+
+
+def generate_ipums_cohort(row_count, seed=0, missing_rates=None):
+    """
+    Generates a synthetic data frame in the layout of the raw IPUMS USA extract (input/usa_00004.csv), with
+    codes in the IPUMS ranges, for testing and benchmarking clean_ipums_script.
+    Args:
+        row_count: number of people in the cohort
+        seed (optional): seed of the random number generator, the same seed gives the same cohort
+        missing_rates (optional): dictionary of column name to share of missing values, defaults to none
+        missing as IPUMS codes every value
+    Returns: a data frame with the columns YEAR, SEX, AGE, RACE and EDUC
+    """
+    rng = np.random.default_rng(seed)
+    educ_weights = np.array([12, 4, 6, 3, 3, 3, 25, 6, 12, 4, 14, 8], dtype="float64")
+    df = pd.DataFrame(
+        {
+            "YEAR": np.full(row_count, 2018, dtype="int16"),
+            "SEX": np.take(
+                IPUMS_SEX_CODES, _weighted_codes(rng, row_count, [0.49, 0.51])
+            ).astype("int8"),
+            "AGE": _ages(rng, row_count).astype("int16"),
+            "RACE": np.take(
+                IPUMS_RACE_CODES,
+                _weighted_codes(rng, row_count, IPUMS_RACE_WEIGHTS),
+            ).astype("int8"),
+            "EDUC": np.take(
+                IPUMS_EDUC_CODES,
+                _weighted_codes(rng, row_count, educ_weights / educ_weights.sum()),
+            ).astype("int8"),
+        }
+    )
+    return _add_missing_values(rng, df, missing_rates or {})
+
+
+def _weighted_codes(rng, row_count, weights):
+    weights = np.asarray(weights, dtype="float64")
+    cumulative_weights = np.cumsum(weights / weights.sum())
+    return np.searchsorted(
+        cumulative_weights, rng.random(row_count), side="right"
+    ).clip(max=len(weights) - 1)
+
+
+def _ages(rng, row_count):
+    """ages from 0 to 110 which thin out after 65, like a general population"""
+    ages = rng.integers(0, 66, size=row_count)
+    older = rng.random(row_count) < 0.2
+    ages[older] = 65 + rng.exponential(10, size=older.sum()).astype("int64")
+    return pd.array(ages.clip(max=110), dtype="Int16")
+
+
+def _add_missing_values(rng, df, missing_rates):
+    for column_name, missing_rate in missing_rates.items():
+        if column_name not in df or not missing_rate:
+            continue
+        missing = rng.random(len(df)) < missing_rate
+        if pd.api.types.is_integer_dtype(df[column_name]) and not isinstance(
+            df[column_name].dtype, pd.api.extensions.ExtensionDtype
+        ):
+            df[column_name] = df[column_name].astype("Int16")
+        df.loc[missing, column_name] = None
+    return df
@@ -6,9 +6,17 @@ setup(
     version="0.0.3",
     packages=find_packages(),
     entry_points={
-        "console_scripts": ["assess_diversity = diversity_analysis_tool.cli:main"]
+        "console_scripts": [
+            "assess_diversity = diversity_analysis_tool.cli:main",
+            "assess_diversity_service = diversity_analysis_tool.service:main",
+        ]
     },
     test_suite="tests",
-    python_requires=">=3.5",
+    python_requires=">=3.7",
     install_requires=["pandas==1.1.0", "seaborn==0.10.1", "matplotlib==3.3.0",],
+    extras_require={
+        "arrow": ["pyarrow>=3.0.0"],
+        "polars": ["polars>=0.20", "pyarrow>=3.0.0"],
+        "distributed": ["distributed"],
+    },
 )
@@ -0,0 +1,85 @@
+from diversity_analysis_tool.aggregates import DiversityCounts
+
+import numpy as np
+import pandas as pd
+
+
+def test_counts_include_missing_values():
+    test_df = pd.DataFrame([{'sex': 'Male', 'race': 'White'},
+                            {'sex': 'Female', 'race': None},
+                            {'sex': 'Male', 'race': 'White'},
+                            {'sex': None, 'race': 'Asian'}])
+    counts = DiversityCounts.from_frame(test_df)
+
+    assert counts.row_count == 4
+    assert counts.column_counts('sex').to_dict() == {'Female': 1, 'Male': 2}
+    assert counts.column_counts('sex', dropna=False).isna().sum() == 0
+    assert counts.missing_counts().to_dict() == {'sex': 1, 'race': 1}
+
+    pair_df = counts.pair_counts('sex', 'race', 'not provided')
+    expected_df = pd.crosstab(test_df['sex'], test_df['race'].fillna('not provided'))
+    pd.testing.assert_frame_equal(pair_df, expected_df, check_like=True, check_names=False)
+
+
+def test_merged_counts_equal_counts_of_whole_frame():
+    test_df = pd.DataFrame({'age_band': pd.Categorical(['0 - 5', '5 - 10', None, '90plus', '5 - 10'],
+                                                       categories=['0 - 5', '5 - 10', '90plus'], ordered=True),
+                            'sex': ['Male', 'Female', 'Female', None, 'Unknown']})
+    whole_counts = DiversityCounts.from_frame(test_df)
+    merged_counts = DiversityCounts.combine([DiversityCounts.from_frame(test_df.iloc[:2]),
+                                             DiversityCounts.from_frame(test_df.iloc[2:])])
+
+    assert merged_counts.row_count == whole_counts.row_count
+    assert list(merged_counts.levels['age_band']) == ['0 - 5', '5 - 10', '90plus']
+    for column_name in ['age_band', 'sex']:
+        pd.testing.assert_series_equal(merged_counts.column_counts(column_name, dropna=False).sort_index(),
+                                       whole_counts.column_counts(column_name, dropna=False).sort_index())
+    pd.testing.assert_frame_equal(merged_counts.pair_counts('age_band', 'sex').sort_index(axis=1),
+                                  whole_counts.pair_counts('age_band', 'sex').sort_index(axis=1))
+
+
+def test_merged_ordered_levels_keep_their_order():
+    levels = ['Nursery', 'Grade 5', 'Grade 12', 'College']
+    first_counts = DiversityCounts.from_frame(pd.DataFrame({'educ': pd.Categorical(['College', 'Grade 12'], categories=levels[2:], ordered=True)}))
+    second_counts = DiversityCounts.from_frame(pd.DataFrame({'educ': pd.Categorical(['Nursery', 'Grade 5', 'College'], categories=levels[:2] + levels[3:], ordered=True)}))
+
+    merged_counts = first_counts.merge(second_counts)
+
+    assert list(merged_counts.levels['educ']) == levels
+    assert merged_counts.column_counts('educ').to_dict() == {'Nursery': 1, 'Grade 5': 1, 'Grade 12': 1, 'College': 2}
+
+
+def test_merged_ranked_levels_are_in_rank_order_after_a_round_trip():
+    ranks = {'Nursery': 1, 'Grade 5': 2, 'Grade 12': 3, 'College': 4}
+    first_counts = DiversityCounts.from_frame(pd.DataFrame({'educ': ['Grade 12', 'College']})).rank_levels('educ', ranks)
+    second_counts = DiversityCounts.from_frame(pd.DataFrame({'educ': ['Grade 5', 'Nursery', 'Other']})).rank_levels('educ', ranks)
+
+    merged_counts = DiversityCounts.from_dict(first_counts.to_dict()).merge(DiversityCounts.from_dict(second_counts.to_dict()))
+
+    assert list(merged_counts.levels['educ']) == ['Nursery', 'Grade 5', 'Grade 12', 'College', 'Other']
+    assert merged_counts.row_count == 5
+
+
+def test_rename_levels_merges_equal_labels():
+    counts = DiversityCounts.from_frame(pd.DataFrame({'is_deceased': [True, 'True', False, np.nan]}))
+    renamed_counts = counts.rename_levels('is_deceased', {True: 'Yes', 'True': 'Yes', False: 'No'})
+
+    assert renamed_counts.column_counts('is_deceased').to_dict() == {'Yes': 2, 'No': 1}
+    assert renamed_counts.missing_counts().to_dict() == {'is_deceased': 1}
+
+
+def test_aggregate_tables():
+    test_df = pd.DataFrame({'sex': ['Male', 'Female', None, 'Male'],
+                            'race': ['White', None, 'Asian', 'White']})
+    counts = DiversityCounts.from_frame(test_df)
+
+    category_df = counts.category_table('not provided')
+    assert category_df.set_index(['column', 'category'])['count'].to_dict() == {
+        ('sex', 'Male'): 2, ('sex', 'Female'): 1, ('sex', 'not provided'): 1,
+        ('race', 'White'): 2, ('race', 'Asian'): 1, ('race', 'not provided'): 1}
+    pair_df = counts.pair_table()
+    assert pair_df.to_dict('records') == [
+        {'column_1': 'sex', 'category_1': 'Male', 'column_2': 'race', 'category_2': 'White', 'count': 2}]
+    assert counts.pair_table('not provided')['count'].sum() == 4
+    missing_df = counts.missing_table()
+    assert missing_df['missing_rate'].tolist() == [0.25, 0.25]
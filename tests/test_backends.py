@@ -0,0 +1,79 @@
+from diversity_analysis_tool.diversity import AssessDiversity
+from diversity_analysis_tool.diversity import transform_desktop_application_database_sex
+from diversity_analysis_tool.diversity import transform_nhs_ethnicity
+from diversity_analysis_tool.diversity import transform_nhs_race
+from diversity_analysis_tool.diversity import transform_nhs_sex
+from diversity_analysis_tool.diversity import transform_ses_order
+from diversity_analysis_tool.schemes import BUILT_IN_SCHEMES
+
+import pandas as pd
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+
+REPORT_ARGUMENTS = (5, 'age', 'sex', 'ethnicity', 'race', 'educ', 'is_deceased')
+
+
+def nhs_cohort():
+    test_df = pd.DataFrame({'age': [3, None, 91, 45, 45, 0],
+                            'sex': [1, 2, None, 9, 1, 2],
+                            'ethnicity': ['A', 'R', '', 'Z', None, 'A'],
+                            'race': ['A', 'B', 'C', None, 'A', 'A'],
+                            'educ': ['low', 'high', 'mid', None, 'low', 'high'],
+                            'ses_level': [1, 3, 2, None, 1, 3],
+                            'is_deceased': [True, False, None, False, True, False]})
+    test_df['is_deceased'] = test_df['is_deceased'].astype('boolean')
+    return test_df
+
+
+def test_arrow_table_is_transformed_and_counted_like_a_data_frame():
+    test_df = nhs_cohort()
+    assess_diversity = AssessDiversity(transform_nhs_ethnicity, transform_nhs_race, transform_nhs_sex, transform_ses_order)
+    table = pa.Table.from_pandas(test_df, preserve_index=False)
+
+    transformed_table = assess_diversity.transform(table, *REPORT_ARGUMENTS)
+
+    assert isinstance(transformed_table, pa.Table)
+    assert transformed_table.schema.names == ['age_band', 'sex', 'ethnicity', 'race', 'is_deceased', 'educ']
+    assert pa.types.is_dictionary(transformed_table.schema.field('ethnicity').type)
+    expected_df = assess_diversity.transform(test_df, *REPORT_ARGUMENTS).reset_index(drop=True)
+    actual_df = transformed_table.to_pandas()
+    for column_name in ['age_band', 'sex', 'ethnicity', 'race', 'educ']:
+        assert actual_df[column_name].tolist() == expected_df[column_name].tolist()
+        assert actual_df[column_name].cat.categories.tolist() == expected_df[column_name].cat.categories.tolist()
+    expected_counts = assess_diversity.count_categories(test_df, *REPORT_ARGUMENTS)
+    actual_counts = assess_diversity.count_categories(table, *REPORT_ARGUMENTS)
+    pd.testing.assert_frame_equal(actual_counts.cube, expected_counts.cube)
+    assert actual_counts.categorical == expected_counts.categorical
+    assert actual_counts.ordered == expected_counts.ordered
+
+
+def test_record_batches_and_scheme_routines_make_the_same_report(tmp_path):
+    test_df = pd.DataFrame({'age': [23, 47, 47, 81, 12] * 4, 'sex': [1, 2, 2, 8, None] * 4, 'race': [1, 2, 7, 1, None] * 4})
+    ipums = BUILT_IN_SCHEMES['ipums']
+    assess_diversity = AssessDiversity(None, ipums.transform('race'), transform_desktop_application_database_sex, None)
+    batches = pa.Table.from_pandas(test_df, preserve_index=False).to_batches(max_chunksize=7)
+
+    arrow_counts = assess_diversity.create_diversity_analysis_report_from_chunks(
+        batches, 5, 'age', 'sex', None, 'race', None, None, str(tmp_path / 'arrow'), render_graphs=False)
+    pandas_counts = assess_diversity.create_diversity_analysis_report(
+        test_df, 5, 'age', 'sex', None, 'race', None, None, str(tmp_path / 'pandas'), render_graphs=False)
+
+    pd.testing.assert_frame_equal(arrow_counts.category_table('missing'), pandas_counts.category_table('missing'))
+    pd.testing.assert_frame_equal(arrow_counts.pair_table('missing'), pandas_counts.pair_table('missing'))
+    arrow_report_df = pd.read_csv(tmp_path / 'arrow' / 'diversity_analysis_report.csv', sep='|')
+    pandas_report_df = pd.read_csv(tmp_path / 'pandas' / 'diversity_analysis_report.csv', sep='|')
+    assert arrow_report_df.fillna('').value_counts().to_dict() == pandas_report_df.fillna('').value_counts().to_dict()
+
+
+def test_polars_frame_is_transformed_to_a_polars_frame():
+    pl = pytest.importorskip('polars')
+    test_df = nhs_cohort()
+    assess_diversity = AssessDiversity(transform_nhs_ethnicity, transform_nhs_race, transform_nhs_sex, transform_ses_order)
+
+    transformed_frame = assess_diversity.transform(pl.from_pandas(test_df), *REPORT_ARGUMENTS, sort_rows=False)
+
+    assert isinstance(transformed_frame, pl.DataFrame)
+    assert transformed_frame['ethnicity'].to_list() == ['British', 'Chinese', 'Unknown', 'Not stated', 'Unknown', 'British']
+    pd.testing.assert_frame_equal(assess_diversity.count_categories(pl.from_pandas(test_df), *REPORT_ARGUMENTS).cube,
+                                  assess_diversity.count_categories(test_df, *REPORT_ARGUMENTS).cube)
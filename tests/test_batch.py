@@ -0,0 +1,56 @@
+from diversity_analysis_tool.batch import create_batch_report
+from diversity_analysis_tool.batch import find_input_files
+from diversity_analysis_tool.disclosure import DisclosureControl
+from diversity_analysis_tool.diversity import AssessDiversity
+from diversity_analysis_tool.diversity import transform_nhs_ethnicity
+from diversity_analysis_tool.diversity import transform_nhs_sex
+
+import pandas as pd
+
+
+def test_batch_report_merges_site_counts(tmp_path):
+    input_path = tmp_path / 'input'
+    input_path.mkdir()
+    pd.DataFrame([{'sex': 1, 'ethnicity': 'A', 'age': 34},
+                  {'sex': 2, 'ethnicity': 'M', 'age': 91}]).to_csv(input_path / 'site_a.csv', index=False)
+    pd.DataFrame([{'sex': 2, 'ethnicity': 'A', 'age': 3},
+                  {'sex': 8, 'ethnicity': None, 'age': 36},
+                  {'sex': 1, 'ethnicity': 'R', 'age': None}]).to_csv(input_path / 'site_b.csv', index=False)
+
+    input_file_paths = find_input_files(str(input_path))
+    assert [path.split('/')[-1] for path in input_file_paths] == ['site_a.csv', 'site_b.csv']
+
+    diversity_analyser = AssessDiversity(transform_nhs_ethnicity, None, transform_nhs_sex, None)
+    site_counts = create_batch_report(diversity_analyser, input_file_paths, 5, 'age', 'sex', 'ethnicity', None,
+                                      None, None, str(tmp_path / 'output'), workers=2)
+
+    all_sites_counts = site_counts['all_sites']
+    assert all_sites_counts.row_count == 5
+    assert all_sites_counts.column_counts('sex').to_dict() == {'Male': 2, 'Female': 2, 'Not specified': 1,
+                                                               'Unknown': 0}
+    assert list(all_sites_counts.column_counts('age_band')[lambda counts: counts > 0].index) == \
+        ['0 - 5', '30 - 35', '35 - 40', '90plus']
+    for directory_name in ['site_a', 'site_b', 'all_sites']:
+        assert (tmp_path / 'output' / directory_name / 'age_band_sex_stacked_bar_chart.png').exists()
+    counts_df = pd.read_csv(tmp_path / 'output' / 'all_sites' / 'diversity_counts.csv', sep='|')
+    assert counts_df['count'].sum() == 5
+
+
+def test_batch_report_protects_the_merged_counts_once(tmp_path):
+    input_path = tmp_path / 'input'
+    input_path.mkdir()
+    # site_a coarsens its two oldest bands into 85plus, site_b its two youngest into 80 - 90
+    pd.DataFrame({'age': [82] * 10 + [87] * 3 + [92] * 3, 'sex': ['F'] * 16}).to_csv(input_path / 'site_a.csv', index=False)
+    pd.DataFrame({'age': [82] * 3 + [87] * 10 + [92] * 10, 'sex': ['F'] * 23}).to_csv(input_path / 'site_b.csv', index=False)
+    disclosure_control = DisclosureControl(k=5, quasi_identifiers=['age_band'], method='coarsen', max_suppressed=0)
+    diversity_analyser = AssessDiversity(None, None, None, None, disclosure_control=disclosure_control)
+
+    site_counts = create_batch_report(diversity_analyser, find_input_files(str(input_path)), 5, 'age', 'sex', None, None,
+                                      None, None, str(tmp_path / 'output'), workers=2, render_graphs=False)
+
+    assert list(site_counts['site_a'].levels['age_band'])[-2:] == ['80 - 85', '85plus']
+    assert list(site_counts['site_b'].levels['age_band'])[-2:] == ['80 - 90', '90plus']
+    all_sites_counts = site_counts['all_sites']
+    assert all_sites_counts.column_counts('age_band')[lambda counts: counts > 0].to_dict() == {
+        '80 - 85': 13, '85 - 90': 13, '90plus': 13}
+    assert (tmp_path / 'output' / 'all_sites' / 'diversity_disclosure_changes.csv').exists()
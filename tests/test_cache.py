@@ -0,0 +1,54 @@
+from diversity_analysis_tool.cache import ReportCache
+from diversity_analysis_tool.diversity import AssessDiversity
+from diversity_analysis_tool.diversity import transform_nhs_sex
+from diversity_analysis_tool.diversity import transform_ses_order
+from diversity_analysis_tool.schemes import BUILT_IN_SCHEMES
+from diversity_analysis_tool.synthetic import generate_nhs_cohort
+
+import os
+
+COLUMN_NAMES = ('age', 'sex', 'ethnicity', 'race', 'ses', 'is_deceased')
+
+
+def test_report_is_reused_from_cache(tmp_path, monkeypatch):
+    cohort_df = generate_nhs_cohort(300)
+    cache = ReportCache(str(tmp_path / 'cache'))
+    diversity_analyser = AssessDiversity(None, None, transform_nhs_sex, transform_ses_order, cache=cache)
+    counts = diversity_analyser.create_diversity_analysis_report(
+        cohort_df, 5, *COLUMN_NAMES, str(tmp_path / 'first'), report_type='aggregate')
+    assert len(os.listdir(tmp_path / 'cache')) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError('the report should come from the cache')
+
+    monkeypatch.setattr(diversity_analyser, '_create_report', fail)
+    cached_counts = diversity_analyser.create_diversity_analysis_report(
+        cohort_df.copy(), 5, *COLUMN_NAMES, str(tmp_path / 'second'), report_type='aggregate')
+
+    assert cached_counts.to_frame()['count'].tolist() == counts.to_frame()['count'].tolist()
+    assert sorted(os.listdir(tmp_path / 'first')) == sorted(os.listdir(tmp_path / 'second'))
+    assert (tmp_path / 'second' / 'sex_bar_chart.png').exists()
+
+    # other data or other parameters are not served from the cache
+    key = cache.key(cohort_df, {'years_per_band': 5})
+    assert cache.key(cohort_df.iloc[1:], {'years_per_band': 5}) != key
+    assert cache.key(cohort_df, {'years_per_band': 10}) != key
+
+
+def test_least_recently_used_reports_are_evicted(tmp_path):
+    cache = ReportCache(str(tmp_path / 'cache'), max_bytes=0)
+    diversity_analyser = AssessDiversity(None, None, transform_nhs_sex, None, cache=cache)
+    cohort_df = generate_nhs_cohort(100)
+    diversity_analyser.create_diversity_analysis_report(
+        cohort_df, 5, *COLUMN_NAMES, str(tmp_path / 'output'), render_graphs=False)
+
+    assert os.listdir(tmp_path / 'cache') == []
+    assert (tmp_path / 'output' / 'diversity_analysis_report.csv').exists()
+
+
+def test_editing_a_code_table_changes_the_report_parameters(monkeypatch):
+    diversity_analyser = AssessDiversity(None, None, transform_nhs_sex, None)
+    parameters = diversity_analyser.report_parameters(5, dict(zip(COLUMN_NAMES, COLUMN_NAMES)))
+    monkeypatch.setitem(BUILT_IN_SCHEMES['nhs'].lookups['sex'].code_dict, 9, 'Indeterminate')
+
+    assert diversity_analyser.report_parameters(5, dict(zip(COLUMN_NAMES, COLUMN_NAMES))) != parameters
@@ -0,0 +1,30 @@
+from diversity_analysis_tool.clean_ipums_script import clean_ipums
+from diversity_analysis_tool.clean_ipums_script import rename_by_code
+from diversity_analysis_tool.synthetic import generate_ipums_cohort
+
+import pandas as pd
+
+
+def test_rename_by_code_maps_every_coded_column():
+    test_df = pd.DataFrame({'SEX': [1, 2, None], 'RACE': [1, 4, 12], 'EDUC': [0, 11, 6]})
+
+    actual_df = rename_by_code(test_df)
+
+    assert actual_df['SEX'].tolist()[:2] == ['Male', 'Female']
+    assert pd.isna(actual_df['SEX'].iloc[2])
+    # codes with no label keep their code
+    assert actual_df['RACE'].tolist() == ['White', 'Chinese', '12']
+    assert actual_df['EDUC'].tolist() == ['N/A or no schooling', '5+ years of college', 'Grade 12']
+    assert actual_df['SES_LEVEL'].tolist() == [0, 11, 6]
+
+
+def test_clean_ipums_in_chunks_matches_whole_extract(tmp_path):
+    raw_file_path = tmp_path / 'usa_extract.csv'
+    generate_ipums_cohort(1000, missing_rates={'SEX': 0.1}).assign(PERWT=1).to_csv(raw_file_path, index=False)
+
+    assert clean_ipums(str(raw_file_path), str(tmp_path / 'chunked.csv'), chunksize=300) == 1000
+    clean_ipums(str(raw_file_path), str(tmp_path / 'whole.csv'), chunksize=None)
+
+    chunked_df = pd.read_csv(tmp_path / 'chunked.csv')
+    assert chunked_df.columns.tolist() == ['year', 'sex', 'age', 'race', 'educ', 'ses_level']
+    pd.testing.assert_frame_equal(chunked_df, pd.read_csv(tmp_path / 'whole.csv'))
@@ -0,0 +1,81 @@
+from diversity_analysis_tool.aggregates import DiversityCounts
+from diversity_analysis_tool.disclosure import DisclosureControl
+from diversity_analysis_tool.disclosure import equivalence_classes
+from diversity_analysis_tool.diversity import AssessDiversity
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def small_cohort():
+    # 40 people in common classes, 3 older men with low ses and 2 people with nothing known
+    return pd.DataFrame({'age_band': pd.Categorical(['80 - 85'] * 20 + ['85 - 90'] * 20 + ['90plus'] * 3 + [None] * 2,
+                                                    categories=['80 - 85', '85 - 90', '90plus'], ordered=True),
+                         'sex': pd.Categorical(['Female'] * 40 + ['Male'] * 3 + [None] * 2),
+                         'ses': pd.Categorical(['high'] * 40 + ['low'] * 3 + [None] * 2)})
+
+
+def test_suppress_blanks_small_classes_in_counts_and_rows():
+    cohort_df = small_cohort()
+    counts = DiversityCounts.from_frame(cohort_df)
+
+    plan = DisclosureControl(k=5, quasi_identifiers=['age_band', 'sex', 'ses']).protect(counts)
+
+    classes_df = equivalence_classes(plan.counts, ['age_band', 'sex', 'ses'])
+    known = classes_df[['age_band', 'sex', 'ses']].notna().any(axis=1)
+    assert (classes_df.loc[known, 'count'] >= 5).all()
+    assert plan.counts.row_count == len(cohort_df)
+    assert plan.counts.missing_counts()['sex'] == 5
+    assert plan.changes[['action', 'classes', 'people']].values.tolist() == [['suppressed', 1, 3]]
+    protected_df = plan.protect_rows(cohort_df)
+    pd.testing.assert_frame_equal(DiversityCounts.from_frame(protected_df).to_frame(), plan.counts.to_frame())
+
+
+def test_coarsen_merges_adjacent_age_bands_before_suppressing():
+    cohort_df = small_cohort()
+    cohort_df['ses'] = pd.Categorical(['high'] * 43 + [None] * 2)
+    cohort_df['sex'] = pd.Categorical(['Female'] * 43 + [None] * 2)
+
+    plan = DisclosureControl(k=5, quasi_identifiers=['age_band', 'sex', 'ses'], method='coarsen', max_suppressed=0).protect(DiversityCounts.from_frame(cohort_df))
+
+    assert list(plan.counts.levels['age_band']) == ['80 - 85', '85plus']
+    assert plan.changes[['action', 'category', 'new_category']].values.tolist() == [['coarsened', '85 - 90', '85plus'], ['coarsened', '90plus', '85plus']]
+    assert plan.protect_rows(cohort_df)['age_band'].value_counts().to_dict() == {'80 - 85': 20, '85plus': 23}
+
+
+def test_chunked_report_is_protected(tmp_path):
+    rng = np.random.default_rng(0)
+    ages = np.r_[rng.integers(20, 60, 2000), [95, 96]]
+    input_df = pd.DataFrame({'age': ages, 'sex': rng.choice(['F', 'M'], len(ages)), 'educ': rng.choice(['low', 'high'], len(ages))})
+    assess_diversity = AssessDiversity(None, None, None, None, disclosure_control=DisclosureControl(k=3))
+
+    counts = assess_diversity.create_diversity_analysis_report_from_chunks(
+        [input_df[:1000], input_df[1000:]], 5, 'age', 'sex', None, None, 'educ', None, str(tmp_path), render_graphs=False)
+
+    report_df = pd.read_csv(tmp_path / 'diversity_analysis_report.csv', sep='|')
+    assert len(report_df) == len(input_df)
+    assert report_df['age_band'].isna().sum() == 2
+    assert report_df['age_band'].value_counts().min() >= 3
+    assert counts.column_counts('age_band')['90plus'] == 0
+    assert not (tmp_path / 'diversity_analysis_report_unprotected.csv').exists()
+    assert (tmp_path / 'diversity_disclosure_changes.csv').exists()
+
+
+def test_is_deceased_quasi_identifier_keeps_its_row_values(tmp_path):
+    input_df = pd.DataFrame({'age': [30] * 20, 'sex': ['F'] * 10 + ['M'] * 10, 'is_deceased': [True] * 10 + [False] * 10})
+    assess_diversity = AssessDiversity(None, None, None, None, disclosure_control=DisclosureControl(2, ['sex', 'is_deceased']))
+
+    assess_diversity.create_diversity_analysis_report(
+        input_df, 5, 'age', 'sex', None, None, None, 'is_deceased', str(tmp_path / 'whole'), render_graphs=False)
+    assess_diversity.create_diversity_analysis_report_from_chunks(
+        [input_df[:7], input_df[7:]], 5, 'age', 'sex', None, None, None, 'is_deceased', str(tmp_path / 'chunks'), render_graphs=False)
+
+    for directory_name in ['whole', 'chunks']:
+        report_df = pd.read_csv(tmp_path / directory_name / 'diversity_analysis_report.csv', sep='|')
+        assert report_df.groupby('sex')['is_deceased'].agg(list).to_dict() == {'F': ['Yes'] * 10, 'M': ['No'] * 10}
+
+
+def test_unknown_method_is_rejected():
+    with pytest.raises(ValueError):
+        DisclosureControl(method='perturb')
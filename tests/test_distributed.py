@@ -0,0 +1,55 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from diversity_analysis_tool.distributed import create_distributed_report
+from diversity_analysis_tool.distributed import plan_partitions
+from diversity_analysis_tool.diversity import AssessDiversity
+from diversity_analysis_tool.diversity import transform_nhs_sex
+from diversity_analysis_tool.diversity import transform_ses_order
+from diversity_analysis_tool.loading import read_demographic_data
+from diversity_analysis_tool.loading import write_table
+from diversity_analysis_tool.synthetic import generate_nhs_cohort
+
+import pandas as pd
+import pytest
+
+COLUMN_NAMES = ('age', 'sex', 'ethnicity', 'race', 'ses', 'is_deceased')
+
+
+def test_partitions_cover_every_row_once(tmp_path):
+    cohort_df = generate_nhs_cohort(1000)
+    csv_file_path = str(tmp_path / 'shard.csv')
+    parquet_file_path = str(tmp_path / 'shard.parquet')
+    cohort_df.to_csv(csv_file_path, index=False)
+    cohort_df.to_parquet(parquet_file_path, index=False, row_group_size=150)
+    column_names = dict(zip(COLUMN_NAMES, COLUMN_NAMES))
+
+    partitions = plan_partitions([csv_file_path, parquet_file_path], partition_bytes=4000)
+
+    for file_path in [csv_file_path, parquet_file_path]:
+        file_partitions = [partition for partition in partitions if partition['file_path'] == file_path]
+        assert len(file_partitions) > 1
+        partition_dfs = [read_demographic_data(file_path, column_names, **partition['position'])
+                         for partition in file_partitions]
+        pd.testing.assert_series_equal(pd.concat(partition_dfs, ignore_index=True)['age'].astype('float64'), cohort_df['age'].astype('float64'))
+
+
+@pytest.mark.parametrize('chunksize', [None, 40])
+def test_distributed_report_matches_single_process_counts(tmp_path, chunksize):
+    cohort_df = generate_nhs_cohort(900)
+    input_file_paths = [str(tmp_path / 'shard_0.csv'), str(tmp_path / 'shard_1.parquet'), str(tmp_path / 'shard_2.feather')]
+    for shard_df, file_path in zip([cohort_df.iloc[:300], cohort_df.iloc[300:600], cohort_df.iloc[600:]], input_file_paths):
+        write_table(shard_df.reset_index(drop=True), file_path)
+    diversity_analyser = AssessDiversity(None, None, transform_nhs_sex, transform_ses_order)
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        counts = create_distributed_report(diversity_analyser, input_file_paths, 5, *COLUMN_NAMES, str(tmp_path / 'output'),
+                                           executor=executor, partition_bytes=3000, chunksize=chunksize, render_graphs=False)
+
+    expected_counts = diversity_analyser.count_categories(
+        pd.concat([read_demographic_data(file_path, dict(zip(COLUMN_NAMES, COLUMN_NAMES))) for file_path in input_file_paths]),
+        5, *COLUMN_NAMES)
+    assert counts.row_count == 900
+    for column_name in ['age_band', 'sex', 'ethnicity', 'race']:
+        pd.testing.assert_series_equal(counts.column_counts(column_name, dropna=False).sort_index(),
+                                       expected_counts.column_counts(column_name, dropna=False).sort_index())
+    assert (tmp_path / 'output' / 'diversity_category_counts.csv').exists()
@@ -4,9 +4,15 @@ from diversity_analysis_tool.diversity import transform_nhs_sex
 from diversity_analysis_tool.diversity import transform_nhs_ethnicity
 from diversity_analysis_tool.diversity import transform_nhs_race
 from diversity_analysis_tool.diversity import transform_ses_order
+from diversity_analysis_tool.nhs_codes import NHS_ETHNICITY_CODE_DICT
+from diversity_analysis_tool.nhs_codes import NHS_RACE_CODE_DICT
 
 import pandas as pd
 
+NHS_SEX_CATEGORIES = ['Male', 'Female', 'Not specified', 'Unknown']
+NHS_ETHNICITY_CATEGORIES = list(pd.unique(list(NHS_ETHNICITY_CODE_DICT.values())))
+NHS_RACE_CATEGORIES = list(pd.unique(list(NHS_RACE_CODE_DICT.values())))
+
 
 def test_transform():
     test_df =  pd.DataFrame([{'person_id': 1, 'sex': 1, 'ethnicity': 'A', 'age': 34,
@@ -26,6 +32,8 @@ def test_transform():
                                          {'age_band': '40 - 45', 'sex': 'Not specified', 'ethnicity': 'Chinese',
                                           'is_deceased': True}])
     expected_results_df['age_band']=pd.Categorical(expected_results_df['age_band'], categories=['30 - 35','35 - 40','40 - 45'], ordered=True)
+    expected_results_df['sex']=pd.Categorical(expected_results_df['sex'], categories=NHS_SEX_CATEGORIES)
+    expected_results_df['ethnicity']=pd.Categorical(expected_results_df['ethnicity'], categories=NHS_ETHNICITY_CATEGORIES)
     check_data_sets_equal(actual_results_df, expected_results_df)
 
 
@@ -64,6 +72,19 @@ def test_transform_age_bands():
     check_data_sets_equal(actual_results_df, expected_results_df)
 
 
+def test_transform_age_bands_orders_bands_from_one_hundred():
+    test_df =  pd.DataFrame([{'person_id': 1, 'age': 104},
+                             {'person_id': 2, 'age': 0},
+                             {'person_id': 3, 'age': 15},
+                             {'person_id': 4, 'age': None},
+                             {'person_id': 5, 'age': 131}])
+    actual_results_df = create_age_bands(test_df, 'age', 0, 120, 10)
+
+    assert list(actual_results_df['age_band'].cat.categories) == ['0 - 10', '10 - 20', '100 - 110', '120plus']
+    assert actual_results_df['age_band'].cat.ordered
+    assert list(actual_results_df['age_band'].astype(object).fillna('missing')) == ['100 - 110', '0 - 10', '10 - 20',
+                                                                                   'missing', '120plus']
+
 def test_transform_nhs_sex():
     test_df =  pd.DataFrame([{'person_id': 1, 'sex': 1},
                              {'person_id': 2, 'sex': 2},
@@ -77,6 +98,7 @@ def test_transform_nhs_sex():
                                         {'person_id': 3, 'sex': 'Not specified'},
                                         {'person_id': 4, 'sex': 'Unknown'},
                                         {'person_id': 5, 'sex': 'Unknown'}])
+    expected_results_df['sex']=pd.Categorical(expected_results_df['sex'], categories=NHS_SEX_CATEGORIES)
     check_data_sets_equal(actual_results_df, expected_results_df)
 
 
@@ -93,6 +115,7 @@ def test_transform_nhs_ethnicity():
                                         {'person_id': 3, 'ethnicity': 'Not stated'},
                                         {'person_id': 4, 'ethnicity': 'Unknown'},
                                         {'person_id': 5, 'ethnicity': 'Unknown'}])
+    expected_results_df['ethnicity']=pd.Categorical(expected_results_df['ethnicity'], categories=NHS_ETHNICITY_CATEGORIES)
     check_data_sets_equal(actual_results_df, expected_results_df)
 
 
@@ -108,9 +131,112 @@ def test_transform_nhs_race():
                                         {'person_id': 3, 'race': 'Other Ethnic Groups'},
                                         {'person_id': 4, 'race': 'Unknown'},
                                         {'person_id': 5, 'race': 'Unknown'}])
+    expected_results_df['race']=pd.Categorical(expected_results_df['race'], categories=NHS_RACE_CATEGORIES)
     check_data_sets_equal(actual_results_df, expected_results_df)
 
 
+def test_transform_nhs_sex_keeps_unrecognised_codes():
+    test_df =  pd.DataFrame([{'person_id': 1, 'sex': 1},
+                             {'person_id': 2, 'sex': 3}])
+
+    actual_results_df = transform_nhs_sex(test_df, 'sex')
+
+    assert list(actual_results_df['sex']) == ['Male', '3']
+    assert list(actual_results_df['sex'].cat.categories) == NHS_SEX_CATEGORIES + ['3']
+
+
+def test_transform_does_not_modify_input():
+    test_df =  pd.DataFrame([{'person_id': 1, 'sex': 1, 'ethnicity': 'A', 'race': 'A', 'age': 34},
+                             {'person_id': 2, 'sex': 2, 'ethnicity': None, 'race': None, 'age': None}])
+    original_df = test_df.copy()
+    diversity_analyser = AssessDiversity(transform_nhs_ethnicity, transform_nhs_race, transform_nhs_sex, transform_ses_order)
+    actual_results_df = diversity_analyser.transform(test_df, 5, 'age', 'sex', 'ethnicity', 'race', None, None)
+
+    pd.testing.assert_frame_equal(test_df, original_df)
+    assert 'person_id' not in actual_results_df
+    assert list(actual_results_df['race'].astype(object)) == ['White', 'Unknown']
+
+
+def test_chunked_report_counts_match_whole_frame(tmp_path):
+    test_df =  pd.DataFrame([{'sex': 1, 'ethnicity': 'A', 'age': 34, 'is_deceased': True},
+                             {'sex': 2, 'ethnicity': 'M', 'age': 38, 'is_deceased': False},
+                             {'sex': 8, 'ethnicity': None, 'age': 92, 'is_deceased': True},
+                             {'sex': 1, 'ethnicity': 'R', 'age': None, 'is_deceased': False},
+                             {'sex': 2, 'ethnicity': 'A', 'age': 3, 'is_deceased': None}])
+    diversity_analyser = AssessDiversity(transform_nhs_ethnicity, None, transform_nhs_sex, None)
+    chunks = [test_df.iloc[:2], test_df.iloc[2:4], test_df.iloc[4:]]
+    counts = diversity_analyser.create_diversity_analysis_report_from_chunks(
+        chunks, 5, 'age', 'sex', 'ethnicity', None, None, 'is_deceased', str(tmp_path))
+
+    assert counts.row_count == 5
+    assert counts.column_counts('age_band')[lambda counts: counts > 0].to_dict() == {
+        '0 - 5': 1, '30 - 35': 1, '35 - 40': 1, '90plus': 1}
+    assert counts.column_counts('is_deceased').to_dict() == {'No': 2, 'Yes': 2}
+    assert counts.missing_counts().to_dict() == {'age_band': 1, 'sex': 0, 'ethnicity': 0, 'is_deceased': 1}
+    report_df = pd.read_csv(tmp_path / 'diversity_analysis_report.csv', sep='|')
+    assert len(report_df) == 5
+    assert (tmp_path / 'age_band_sex_stacked_bar_chart.png').exists()
+
+
+def test_chunked_ses_levels_keep_the_order_of_the_whole_frame(tmp_path):
+    test_df = pd.DataFrame({'age': [40, 52, 19, 67, 33, 25],
+                            'educ': ['Grade 12', 'College', 'College', 'Nursery', 'Grade 5', 'Grade 12'],
+                            'ses_level': [3, 4, 4, 1, 2, 3]})
+    diversity_analyser = AssessDiversity(None, None, None, transform_ses_order)
+    whole_counts = diversity_analyser.count_categories(test_df, 5, 'age', None, None, None, 'educ', None)
+    # the first chunk has none of the low ses levels
+    chunked_counts = diversity_analyser.create_diversity_analysis_report_from_chunks(
+        [test_df.iloc[:3], test_df.iloc[3:]], 5, 'age', None, None, None, 'educ', None, str(tmp_path),
+        render_graphs=False, report_type='aggregate')
+
+    assert list(whole_counts.levels['educ']) == ['Nursery', 'Grade 5', 'Grade 12', 'College']
+    assert list(chunked_counts.levels['educ']) == list(whole_counts.levels['educ'])
+    assert chunked_counts.column_counts('educ').to_dict() == whole_counts.column_counts('educ').to_dict()
+
+
+def test_aggregate_report_writes_counts_instead_of_rows(tmp_path):
+    test_df = pd.DataFrame([{'sex': 1, 'ethnicity': 'A', 'age': 34},
+                            {'sex': 2, 'ethnicity': 'M', 'age': 38},
+                            {'sex': 8, 'ethnicity': None, 'age': 92},
+                            {'sex': 1, 'ethnicity': 'A', 'age': None}])
+    diversity_analyser = AssessDiversity(transform_nhs_ethnicity, None, transform_nhs_sex, None)
+    chunks = [test_df.iloc[:2], test_df.iloc[2:]]
+    diversity_analyser.create_diversity_analysis_report_from_chunks(
+        chunks, 5, 'age', 'sex', 'ethnicity', None, None, None, str(tmp_path), report_type='aggregate',
+        render_graphs=False)
+
+    assert not (tmp_path / 'diversity_analysis_report.csv').exists()
+    category_df = pd.read_csv(tmp_path / 'diversity_category_counts.csv', sep='|')
+    assert category_df.set_index(['column', 'category']).loc['sex', 'count'].to_dict() == {
+        'Male': 2, 'Female': 1, 'Not specified': 1}
+    pair_df = pd.read_csv(tmp_path / 'diversity_pair_counts.csv', sep='|')
+    assert pair_df.groupby(['column_1', 'column_2'])['count'].sum().unique().tolist() == [4]
+    missing_df = pd.read_csv(tmp_path / 'diversity_missing_counts.csv', sep='|')
+    assert missing_df.set_index('column')['missing'].to_dict() == {'age_band': 1, 'sex': 0, 'ethnicity': 0}
+
+
+def test_report_without_graphs_does_not_import_plotting_libraries(tmp_path):
+    import subprocess
+    import sys
+
+    script = f"""
+import sys
+import pandas as pd
+from diversity_analysis_tool.diversity import AssessDiversity, transform_nhs_sex
+test_df = pd.DataFrame({{'sex': [1, 2, 8], 'age': [34, 38, 92]}})
+AssessDiversity(None, None, transform_nhs_sex, None).create_diversity_analysis_report(
+    test_df, 5, 'age', 'sex', None, None, None, None, {str(tmp_path)!r}, render_graphs=False)
+assert 'matplotlib' not in sys.modules and 'seaborn' not in sys.modules
+from diversity_analysis_tool.diversity import GraphUtility
+from diversity_analysis_tool.graph_construction import GraphUtility as graph_utility_class
+assert GraphUtility is graph_utility_class
+"""
+    subprocess.run([sys.executable, '-c', script], check=True)
+
+    assert (tmp_path / 'diversity_analysis_report.csv').exists()
+    assert not list(tmp_path.glob('*.png'))
+
+
 
 def check_data_sets_equal(first_df, second_df) -> None:
     """
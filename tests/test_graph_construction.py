@@ -0,0 +1,37 @@
+from diversity_analysis_tool.graph_construction import GraphUtility
+
+import pandas as pd
+
+
+def test_build_graph_from_one_count_table(tmp_path):
+    test_df = pd.DataFrame({'age_band': pd.Categorical(['0 - 5', '5 - 10', None, '5 - 10'], ordered=True),
+                            'sex': ['Male', 'Female', None, 'Female'],
+                            'race': ['White', None, 'Asian', 'White']})
+    grapher = GraphUtility(test_df, str(tmp_path))
+
+    assert grapher._missing_counts(['age_band', 'sex', 'race']).to_dict() == {'age_band': 1, 'sex': 1, 'race': 1}
+    assert list(grapher._column_counts('sex').index) == ['Male', 'Female']
+    pair_df = grapher._pair_counts('age_band', 'race', 'not provided')
+    assert pair_df.loc['All', 'All'] == 3
+    assert pair_df.loc['5 - 10'].to_dict() == {'White': 1, 'not provided': 1, 'All': 2}
+
+    grapher.build_graph()
+    for file_name in ['age_band_bar_chart.png', 'sex_bar_chart.png', 'race_bar_chart.png',
+                      'age_band_race_stacked_bar_chart.png', 'race_sex_stacked_bar_chart.png',
+                      'Missingness_bar_chart.png']:
+        assert (tmp_path / file_name).exists()
+
+
+def test_build_graph_closes_figures_and_renders_in_processes(tmp_path):
+    import matplotlib.pyplot as plt
+
+    test_df = pd.DataFrame({'age_band': ['0 - 5', '5 - 10', '5 - 10'],
+                            'sex': ['Male', 'Female', None]})
+    (tmp_path / 'serial').mkdir()
+    GraphUtility(test_df, str(tmp_path / 'serial')).build_graph()
+    assert plt.get_fignums() == []
+
+    (tmp_path / 'parallel').mkdir()
+    GraphUtility(test_df, str(tmp_path / 'parallel')).build_graph(processes=2)
+    assert sorted(path.name for path in (tmp_path / 'parallel').iterdir()) == \
+        sorted(path.name for path in (tmp_path / 'serial').iterdir())
@@ -0,0 +1,27 @@
+from diversity_analysis_tool.aggregates import DiversityCounts
+from diversity_analysis_tool.html_report import write_html_report
+
+import json
+import pandas as pd
+
+
+def test_html_report_embeds_the_counts_it_is_drawn_from(tmp_path):
+    test_df = pd.DataFrame({'age_band': pd.Categorical(['0 - 5', '5 - 10', None, '5 - 10'], ordered=True),
+                            'sex': ['Male', 'Female', None, 'Female'],
+                            'race': ['White', None, '</script>', 'White']})
+    counts = DiversityCounts.from_frame(test_df)
+
+    html_file_path, json_file_path = write_html_report(counts, str(tmp_path), title='Cohort <A>')
+
+    with open(json_file_path) as json_file:
+        data = json.load(json_file)
+    assert data['people'] == 4
+    assert data['pairs'] == [['age_band', 'race'], ['race', 'sex'], ['age_band', 'sex']]
+    pd.testing.assert_frame_equal(DiversityCounts.from_dict(data['counts']).to_frame(), counts.to_frame())
+    with open(html_file_path) as html_file:
+        page = html_file.read()
+    assert '<title>Cohort &lt;A&gt;</title>' in page
+    # only the page's own two script elements are closed
+    assert page.count('</script>') == 2
+    embedded = page.split('id="diversity-data">')[1].split('</script>')[0]
+    assert json.loads(embedded.replace('<\\/', '</')) == data
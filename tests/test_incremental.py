@@ -0,0 +1,70 @@
+from diversity_analysis_tool.diversity import AssessDiversity
+from diversity_analysis_tool.diversity import transform_nhs_sex
+from diversity_analysis_tool.diversity import transform_ses_order
+from diversity_analysis_tool.incremental import create_incremental_report
+from diversity_analysis_tool.incremental import load_state
+from diversity_analysis_tool.incremental import STATE_FILE_NAME
+from diversity_analysis_tool.synthetic import generate_nhs_cohort
+
+import pandas as pd
+import pytest
+
+COLUMN_NAMES = ('age', 'sex', 'ethnicity', 'race', 'ses', 'is_deceased')
+
+
+def assess(input_file_paths, output_path, chunksize=None):
+    diversity_analyser = AssessDiversity(None, None, transform_nhs_sex, transform_ses_order)
+    return create_incremental_report(diversity_analyser, [str(path) for path in input_file_paths], 5,
+                                     *COLUMN_NAMES, str(output_path), chunksize=chunksize, render_graphs=False)
+
+
+def assert_same_counts(first_counts, second_counts):
+    assert first_counts.row_count == second_counts.row_count
+    for column_name in first_counts.column_names:
+        pd.testing.assert_series_equal(first_counts.column_counts(column_name, dropna=False).sort_index(),
+                                       second_counts.column_counts(column_name, dropna=False).sort_index())
+
+
+@pytest.mark.parametrize('chunksize', [None, 70])
+def test_re_run_only_reads_appended_rows(tmp_path, chunksize):
+    cohort_df = generate_nhs_cohort(500)
+    file_path = tmp_path / 'extract.csv'
+    cohort_df.iloc[:300].to_csv(file_path, index=False)
+    assess([file_path], tmp_path / 'output', chunksize)
+
+    cohort_df.iloc[300:].to_csv(file_path, index=False, header=False, mode='a')
+    new_file_path = tmp_path / 'extract_2.csv'
+    cohort_df.iloc[:100].to_csv(new_file_path, index=False)
+    counts = assess([file_path, new_file_path], tmp_path / 'output', chunksize)
+
+    state = load_state(str(tmp_path / 'output' / STATE_FILE_NAME))
+    assert state['files']['extract.csv']['rows'] == 500
+    assert state['files']['extract_2.csv']['rows'] == 100
+    assert_same_counts(counts, assess([file_path, new_file_path], tmp_path / 'fresh_output'))
+    assert counts.row_count == 600
+    assert (tmp_path / 'output' / 'diversity_category_counts.csv').exists()
+
+
+def test_rewritten_file_is_assessed_again(tmp_path):
+    cohort_df = generate_nhs_cohort(200)
+    file_path = tmp_path / 'extract.csv'
+    cohort_df.to_csv(file_path, index=False)
+    assess([file_path], tmp_path / 'output')
+
+    cohort_df.iloc[:150].to_csv(file_path, index=False)
+    counts = assess([file_path], tmp_path / 'output')
+
+    assert counts.row_count == 150
+
+
+def test_re_run_reads_rows_appended_to_parquet_files(tmp_path):
+    pytest.importorskip('pyarrow')
+    cohort_df = generate_nhs_cohort(400)
+    file_path = tmp_path / 'extract.parquet'
+    cohort_df.iloc[:250].to_parquet(file_path, index=False)
+    assess([file_path], tmp_path / 'output')
+
+    cohort_df.to_parquet(file_path, index=False, row_group_size=100)
+    counts = assess([file_path], tmp_path / 'output', chunksize=60)
+
+    assert_same_counts(counts, assess([file_path], tmp_path / 'fresh_output'))
@@ -0,0 +1,39 @@
+from diversity_analysis_tool.aggregates import DiversityCounts
+from diversity_analysis_tool.indices import diversity_indices
+from diversity_analysis_tool.indices import index_values
+from diversity_analysis_tool.indices import write_index_report
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def test_index_values_of_known_distributions():
+    values = index_values([[25, 25, 25, 25], [100, 0, 0, 0], [0, 0, 0, 0]])
+
+    assert values['shannon'][:2] == pytest.approx([np.log(4), 0.0])
+    assert values['simpson'][:2] == pytest.approx([0.25, 1.0])
+    assert values['gini_simpson'][:2] == pytest.approx([0.75, 0.0])
+    assert values['effective_groups'][:2] == pytest.approx([4.0, 1.0])
+    assert np.isnan(values['shannon'][2])
+
+
+def test_bootstrap_intervals_are_reproducible_and_cover_the_estimate(tmp_path):
+    rng = np.random.default_rng(0)
+    cohort_df = pd.DataFrame({'age_band': pd.Categorical(rng.choice(['0 - 40', '40 - 80'], 5000)),
+                              'ethnicity': pd.Categorical(rng.choice(['A', 'B', 'C'], 5000, p=[0.6, 0.3, 0.1]))})
+    counts = DiversityCounts.from_frame(cohort_df)
+
+    indices_df = diversity_indices(counts, strata_column_names=['age_band'], bootstrap_samples=200, seed=3)
+
+    assert indices_df[['column', 'stratum']].fillna('all').values.tolist() == [
+        ['age_band', 'all'], ['ethnicity', 'all'], ['ethnicity', '0 - 40'], ['ethnicity', '40 - 80']]
+    ethnicity = indices_df.iloc[1]
+    assert ethnicity['people'] == 5000
+    assert ethnicity['gini_simpson_low'] < ethnicity['gini_simpson'] < ethnicity['gini_simpson_high']
+    assert ethnicity['effective_groups_high'] < 3
+    pd.testing.assert_frame_equal(
+        indices_df, diversity_indices(counts, strata_column_names=['age_band'], bootstrap_samples=200, seed=3, processes=2))
+    written_df = write_index_report(counts, str(tmp_path), bootstrap_samples=0)
+    assert (tmp_path / 'diversity_indices.csv').exists()
+    assert written_df['shannon_low'].isna().all()
@@ -0,0 +1,80 @@
+import json
+
+from diversity_analysis_tool.diversity import AssessDiversity
+from diversity_analysis_tool.diversity import transform_nhs_sex
+from diversity_analysis_tool.loading import load_column_names
+from diversity_analysis_tool.loading import read_demographic_data
+from diversity_analysis_tool.loading import read_table
+
+import pandas as pd
+import pytest
+
+
+def test_load_column_names_from_file_and_options(tmp_path):
+    config_file_path = tmp_path / 'columns.json'
+    config_file_path.write_text(json.dumps({'age': 'AGE', 'sex': 'SEX', 'ethnicity': None}))
+
+    column_names = load_column_names(str(config_file_path), sex='GENDER', race=None)
+
+    assert column_names == {'age': 'AGE', 'sex': 'GENDER', 'ethnicity': None, 'race': 'race', 'ses': 'educ',
+                            'is_deceased': 'is_deceased'}
+
+
+def test_read_demographic_data_only_reads_mapped_columns(tmp_path):
+    file_path = tmp_path / 'extract.csv'
+    pd.DataFrame([{'PERSON': 1, 'AGE': 34, 'SEX': 1, 'NOTES': 'a', 'is_deceased': True},
+                  {'PERSON': 2, 'AGE': None, 'SEX': 2, 'NOTES': 'b', 'is_deceased': False}]).to_csv(file_path,
+                                                                                                    index=False)
+    column_names = load_column_names(age='AGE', sex='SEX')
+
+    df = read_demographic_data(str(file_path), column_names)
+
+    assert list(df.columns) == ['AGE', 'SEX', 'is_deceased']
+    assert str(df['AGE'].dtype) == 'float32'
+    assert list(df['SEX'].cat.categories) == [1, 2]
+    assert str(df['is_deceased'].dtype) == 'category'
+
+    chunks = list(read_demographic_data(str(file_path), column_names, chunksize=1))
+    assert len(chunks) == 2
+
+    diversity_analyser = AssessDiversity(None, None, transform_nhs_sex, None)
+    results_df = diversity_analyser.transform(df, 5, 'AGE', 'SEX', None, None, None, 'is_deceased')
+    assert list(results_df.columns) == ['age_band', 'sex', 'is_deceased']
+    assert list(results_df['sex'].astype(object)) == ['Male', 'Female']
+
+
+def test_read_demographic_data_accepts_fractional_ages_and_coded_flags(tmp_path):
+    file_path = tmp_path / 'extract.csv'
+    pd.DataFrame({'age': [34.5, 0.25, None, 91], 'sex': [1, 2, 2, 1], 'is_deceased': ['Y', 'N', None, 'N']}).to_csv(file_path, index=False)
+
+    df = read_demographic_data(str(file_path), load_column_names())
+
+    assert df['age'].tolist()[:2] == [34.5, 0.25]
+    assert list(df['is_deceased'].cat.categories) == ['N', 'Y']
+    diversity_analyser = AssessDiversity(None, None, transform_nhs_sex, None)
+    counts = diversity_analyser.create_diversity_analysis_report(
+        df, 5, 'age', 'sex', None, None, None, 'is_deceased', str(tmp_path / 'output'), render_graphs=False)
+    assert counts.column_counts('age_band')[['0 - 5', '30 - 35', '90plus']].tolist() == [1, 1, 1]
+    assert counts.column_counts('is_deceased').to_dict() == {'N': 2, 'Y': 1}
+
+
+def test_parquet_report_round_trip_keeps_categoricals(tmp_path):
+    pytest.importorskip('pyarrow')
+    input_file_path = tmp_path / 'extract.parquet'
+    pd.DataFrame([{'age': 34, 'sex': 1, 'notes': 'a'},
+                  {'age': 92, 'sex': 2, 'notes': 'b'},
+                  {'age': 3, 'sex': 8, 'notes': 'c'}]).to_parquet(input_file_path)
+
+    df = read_demographic_data(str(input_file_path), load_column_names())
+    assert list(df.columns) == ['age', 'sex']
+    assert str(df['age'].dtype) == 'float32'
+
+    diversity_analyser = AssessDiversity(None, None, transform_nhs_sex, None)
+    chunks = read_demographic_data(str(input_file_path), load_column_names(), chunksize=2)
+    diversity_analyser.create_diversity_analysis_report_from_chunks(
+        chunks, 5, 'age', 'sex', None, None, None, None, str(tmp_path / 'output'), report_format='parquet')
+
+    report_df = read_table(str(tmp_path / 'output' / 'diversity_analysis_report.parquet'))
+    assert len(report_df) == 3
+    assert str(report_df['sex'].dtype) == 'category'
+    assert sorted(report_df['sex'].astype(object)) == ['Female', 'Male', 'Not specified']
@@ -0,0 +1,60 @@
+from diversity_analysis_tool.diversity import AssessDiversity, transform_nhs_sex, transform_ses_order
+from diversity_analysis_tool.profiling import PROFILE_FILE_NAME, StageProfiler
+from diversity_analysis_tool.synthetic import generate_nhs_cohort
+
+import json
+import tracemalloc
+
+
+def test_stage_profiler_records_nested_stages():
+    finished_stages = []
+    profiler = StageProfiler(callback=lambda record: finished_stages.append(record['stage']))
+
+    for _ in range(2):
+        with profiler.stage('report', rows=10):
+            with profiler.stage('transform', rows=10):
+                data = list(range(100000))
+    profiler.add_record('graph', 0.5)
+
+    assert finished_stages == ['report/transform', 'report', 'report/transform', 'report', 'graph']
+    summary = {stage['stage']: stage for stage in profiler.summary()}
+    assert summary['report']['calls'] == 2
+    assert summary['report']['rows'] == 20
+    # the list allocated in the inner stage counts towards the peak of the outer one too
+    assert summary['report']['peak_memory_delta_mb'] >= summary['report/transform']['peak_memory_delta_mb'] > 0
+    assert summary['graph']['seconds'] == 0.5
+    assert data
+
+
+def test_stage_profiler_stops_only_the_tracing_it_started():
+    profiler = StageProfiler()
+    with profiler.stage('report'):
+        with profiler.stage('transform'):
+            assert tracemalloc.is_tracing()
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing()
+
+    tracemalloc.start()
+    try:
+        with profiler.stage('report'):
+            pass
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_chunked_report_writes_profile(tmp_path):
+    cohort_df = generate_nhs_cohort(1000)
+    profiler = StageProfiler(trace_memory=False)
+    assess_diversity = AssessDiversity(None, None, transform_nhs_sex, transform_ses_order, profiler=profiler)
+    chunks = (cohort_df.iloc[start:start + 400] for start in range(0, 1000, 400))
+    assess_diversity.create_diversity_analysis_report_from_chunks(
+        chunks, 5, 'age', 'sex', None, None, 'ses', 'is_deceased', str(tmp_path))
+
+    with open(tmp_path / PROFILE_FILE_NAME) as profile_file:
+        summary = {stage['stage']: stage for stage in json.load(profile_file)['stages']}
+    assert summary['report']['rows'] == 1000
+    assert summary['report/transform']['calls'] == 3
+    assert summary['report/transform/create_age_bands']['rows'] == 1000
+    assert summary['report/transform/transform_sex']['rows'] == 1000
+    assert summary['report/build_graph/sex_bar_chart']['calls'] == 1
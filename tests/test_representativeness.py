@@ -0,0 +1,45 @@
+from diversity_analysis_tool.aggregates import DiversityCounts
+from diversity_analysis_tool.representativeness import ReferencePopulation
+from diversity_analysis_tool.representativeness import write_representativeness_report
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def cohort(sexes, ses_levels):
+    return DiversityCounts.from_frame(pd.DataFrame({'sex': pd.Categorical(sexes), 'ses': pd.Categorical(ses_levels)}))
+
+
+def test_identical_cohort_scores_zero_and_skewed_cohort_is_flagged():
+    reference = ReferencePopulation(cohort(['Female', 'Male'] * 500, ['low', 'high'] * 250 + ['high', 'low'] * 250))
+    cohorts = {'same': cohort(['Male', 'Female'] * 50, ['high', 'low'] * 25 + ['low', 'high'] * 25),
+               'skewed': cohort(['Female'] * 80 + ['Male'] * 20 + [None, 'Other'], ['low'] * 102)}
+
+    all_scores_df = reference.scores(cohorts)
+    scores_df = all_scores_df[all_scores_df['column_2'].isna()].set_index(['cohort', 'column_1'])
+    representation_df = reference.representation(cohorts).set_index(['cohort', 'column', 'category'])
+
+    assert scores_df.loc[('same', 'sex'), 'chi_square'] == pytest.approx(0)
+    assert scores_df.loc[('same', 'sex'), 'js_divergence'] == pytest.approx(0)
+    # 'Other' is not in the reference and the missing value is left out
+    assert scores_df.loc[('skewed', 'sex'), 'people'] == 100
+    assert scores_df.loc[('skewed', 'sex'), 'unmatched'] == 1
+    assert scores_df.loc[('skewed', 'sex'), 'chi_square'] == pytest.approx(36)
+    assert scores_df.loc[('skewed', 'sex'), 'kl_divergence'] == pytest.approx(1 - (0.8 * -np.log2(0.8) + 0.2 * -np.log2(0.2)))
+    assert 0 < scores_df.loc[('skewed', 'sex'), 'js_divergence'] < 1
+    assert representation_df.loc[('skewed', 'sex', 'Female'), 'representation_ratio'] == pytest.approx(1.6)
+    assert representation_df.loc[('skewed', 'ses', 'high'), 'representation_ratio'] == 0
+    assert all_scores_df[all_scores_df['column_2'] == 'ses']['degrees_of_freedom'].tolist() == [3, 3]
+
+
+def test_saved_reference_scores_the_same(tmp_path):
+    reference = ReferencePopulation(cohort(['Female', 'Male', 'Male'] * 100, ['low', 'middle', 'high'] * 100))
+    reference.save(str(tmp_path / 'reference.json'))
+    trial = cohort(['Female', 'Male'] * 30, ['high'] * 60)
+
+    _, scores_df = write_representativeness_report(ReferencePopulation.load(str(tmp_path / 'reference.json')), trial, str(tmp_path))
+
+    pd.testing.assert_frame_equal(scores_df, reference.scores(trial))
+    assert (tmp_path / 'diversity_representation.csv').exists()
+    assert (tmp_path / 'diversity_representativeness_scores.csv').exists()
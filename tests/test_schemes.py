@@ -0,0 +1,77 @@
+import json
+import pickle
+
+from diversity_analysis_tool.diversity import transform_nhs_ethnicity
+from diversity_analysis_tool.diversity import transform_nhs_sex
+from diversity_analysis_tool.schemes import BUILT_IN_SCHEMES
+from diversity_analysis_tool.schemes import CodeLookup
+from diversity_analysis_tool.schemes import CodingScheme
+from diversity_analysis_tool.schemes import load_scheme
+
+import pandas as pd
+import pytest
+
+
+def test_scheme_file_maps_codes_with_its_missing_policy(tmp_path):
+    scheme_file_path = tmp_path / 'hospital_a.json'
+    scheme_file_path.write_text(json.dumps({
+        'name': 'hospital_a',
+        'fields': {
+            'sex': {'codes': [[1, 'Male'], [2, 'Female']], 'missing_label': 'Unknown', 'missing_codes': [0]},
+            'ses': {'codes': [['L', 'Low'], ['M', 'Middle'], ['H', 'High']], 'ordered': True},
+        },
+    }))
+    scheme = load_scheme(str(scheme_file_path))
+    test_df = pd.DataFrame({'sex': [2.0, 1.0, None, 0.0, 3.0], 'ses': ['H', None, 'L', 'M', 'L']})
+
+    actual_df = scheme.transform('ses')(scheme.transform('sex')(test_df, 'sex'), 'ses')
+
+    assert actual_df['sex'].tolist() == ['Female', 'Male', 'Unknown', 'Unknown', '3']
+    assert actual_df['ses'].cat.ordered
+    assert actual_df['ses'].cat.categories.tolist() == ['Low', 'Middle', 'High']
+    assert actual_df['ses'].max() == 'High'
+    assert pd.isna(actual_df['ses'].iloc[1])
+    assert scheme.transform('race') is None
+    # the input is left as it is
+    assert test_df['sex'].iloc[0] == 2.0
+
+
+def test_scheme_round_trips_through_dict_and_pickle():
+    scheme = BUILT_IN_SCHEMES['ipums']
+
+    copied_scheme = CodingScheme.from_dict(json.loads(json.dumps(scheme.to_dict())))
+    transform = pickle.loads(pickle.dumps(scheme.transform('ses')))
+
+    assert copied_scheme.digest() == scheme.digest()
+    assert repr(transform) == repr(scheme.transform('ses'))
+
+
+def test_nhs_scheme_matches_nhs_transforms():
+    test_df = pd.DataFrame({'sex': [1, 2, 8, None], 'ethnicity': ['R', '', None, 'A']})
+    transform_sex = BUILT_IN_SCHEMES['nhs'].transform('sex')
+    transform_ethnicity = BUILT_IN_SCHEMES['nhs'].transform('ethnicity')
+
+    pd.testing.assert_frame_equal(transform_sex(test_df, 'sex'), transform_nhs_sex(test_df, 'sex'))
+    pd.testing.assert_frame_equal(transform_ethnicity(test_df, 'ethnicity'), transform_nhs_ethnicity(test_df, 'ethnicity'))
+
+
+def test_unrecognised_values_reading_like_a_label_share_it():
+    race_lookup = BUILT_IN_SCHEMES['nhs'].lookups['race']
+    assert 'White' in race_lookup.labels
+
+    actual = race_lookup.map(pd.Series(['A', 'White', 'White', None], dtype=object))
+    mixed = CodeLookup({'L': 'Low', 'H': 'High'}).map(pd.Series([1, '1', 'H', 1], dtype=object))
+
+    assert actual.tolist() == ['White', 'White', 'White', 'Unknown']
+    assert list(actual.categories) == list(race_lookup.labels)
+    assert mixed.tolist() == ['1', '1', 'High', '1']
+    assert list(mixed.categories) == ['Low', 'High', '1']
+
+
+def test_invalid_schemes_raise():
+    with pytest.raises(ValueError):
+        load_scheme('no_such_scheme')
+    with pytest.raises(ValueError):
+        CodeLookup.from_dict({'codes': [[1, 'Male']], 'labels': []})
+    with pytest.raises(ValueError):
+        CodingScheme('bad', {'height': CodeLookup({})})
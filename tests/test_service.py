@@ -0,0 +1,86 @@
+from diversity_analysis_tool.service import ReportHTTPServer, ReportService, ServiceBusy, _assessor
+
+from concurrent.futures import TimeoutError
+
+import os
+import json
+import time
+import threading
+import urllib.request
+import pandas as pd
+import pytest
+
+
+def test_service_runs_reports_from_paths_and_uploads(tmp_path):
+    input_df = pd.DataFrame({'age': [23, 47, 47, 81], 'sex': ['Female', 'Male', None, 'Female'], 'educ': ['low', 'high', 'high', None]})
+    input_df.to_csv(tmp_path / 'cohort.csv', index=False)
+    service = ReportService(str(tmp_path / 'reports'), workers=1, max_pending=1)
+    server = ReportHTTPServer(('127.0.0.1', 0), service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    try:
+        request = urllib.request.Request(url + '/reports', data=json.dumps({'input_path': str(tmp_path / 'cohort.csv'), 'output_dir': str(tmp_path / 'out'), 'render_graphs': False}).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            result = json.load(response)
+            assert 'report;dur=' in response.headers['Server-Timing']
+        assert result['rows'] == 4
+        assert str(tmp_path / 'out' / 'diversity_category_counts.csv') in result['artifacts']
+        categories = {(row['column'], row['category']): row['count'] for row in result['aggregates']['categories']}
+        assert categories[('sex', 'Female')] == 2
+
+        request = urllib.request.Request(url + '/reports?render_graphs=false&html_report=true', data=(tmp_path / 'cohort.csv').read_bytes(), headers={'Content-Type': 'text/csv'})
+        with urllib.request.urlopen(request) as response:
+            result = json.load(response)
+        assert result['rows'] == 4
+        assert result['output_dir'].startswith(str(tmp_path / 'reports'))
+        assert any(path.endswith('diversity_report.html') for path in result['artifacts'])
+        assert not list((tmp_path / 'reports' / 'uploads').iterdir())
+
+        with urllib.request.urlopen(url + '/status') as response:
+            status = json.load(response)
+        assert status['workers'] == 1
+        assert status['requests']['completed'] == 2
+        assert status['in_flight'] == 0
+        assert status['timings']['count'] == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+def test_timed_out_report_keeps_its_slot_and_upload_until_it_finishes(tmp_path):
+    upload = pd.DataFrame({'age': [23, 47, 81] * 1000, 'sex': ['Female', 'Male', None] * 1000}).to_csv(index=False).encode()
+    service = ReportService(str(tmp_path / 'reports'), workers=1, max_pending=0, timeout=0.001)
+    try:
+        with pytest.raises(TimeoutError):
+            service.run({'render_graphs': True}, upload)
+        assert service.status()['in_flight'] == 1
+        assert len(list((tmp_path / 'reports' / 'uploads').iterdir())) == 1
+        with pytest.raises(ServiceBusy):
+            service.run({'render_graphs': False}, upload)
+
+        deadline = time.time() + 120
+        while service.status()['in_flight'] and time.time() < deadline:
+            time.sleep(0.05)
+        status = service.status()
+        assert status['in_flight'] == 0
+        assert status['requests']['timed_out'] == 1
+        assert not list((tmp_path / 'reports' / 'uploads').iterdir())
+    finally:
+        service.close()
+
+
+def test_edited_scheme_file_is_loaded_again(tmp_path):
+    scheme_file_path = tmp_path / 'hospital_a.json'
+    test_df = pd.DataFrame({'sex': [1, 2]})
+    scheme_file_path.write_text(json.dumps({'name': 'hospital_a', 'fields': {'sex': {'codes': [[1, 'Male'], [2, 'Female']]}}}))
+    first_assessor = _assessor(str(scheme_file_path), None)
+    assert _assessor(str(scheme_file_path), None) is first_assessor
+
+    scheme_file_path.write_text(json.dumps({'name': 'hospital_a', 'fields': {'sex': {'codes': [[1, 'M'], [2, 'F']]}}}))
+    os.utime(scheme_file_path, (time.time() + 10, time.time() + 10))
+    second_assessor = _assessor(str(scheme_file_path), None)
+
+    assert second_assessor is not first_assessor
+    assert second_assessor.transform_sex_routine(test_df, 'sex')['sex'].tolist() == ['M', 'F']
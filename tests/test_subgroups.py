@@ -0,0 +1,52 @@
+from diversity_analysis_tool.aggregates import DiversityCounts
+from diversity_analysis_tool.subgroups import find_underrepresented_subgroups
+from diversity_analysis_tool.subgroups import write_subgroup_report
+
+import numpy as np
+import pandas as pd
+
+
+def independent_cohort(row_count, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'age_band': pd.Categorical(rng.choice(['0 - 40', '40 - 80', '80plus'], row_count)),
+                         'sex': pd.Categorical(rng.choice(['Female', 'Male'], row_count)),
+                         'ses': pd.Categorical(rng.choice(['low', 'middle', 'high'], row_count))})
+
+
+def test_finds_planted_three_way_subgroup():
+    cohort_df = independent_cohort(60000)
+    planted = (cohort_df['age_band'] == '80plus') & (cohort_df['sex'] == 'Female') & (cohort_df['ses'] == 'low')
+    # keeps a tenth of the older women with low ses, which barely changes any pair of fields
+    cohort_df = cohort_df[~planted | (np.arange(len(cohort_df)) % 10 == 0)]
+    counts = DiversityCounts.from_frame(cohort_df)
+
+    subgroups_df = find_underrepresented_subgroups(counts, max_order=3)
+
+    top_subgroup = subgroups_df.iloc[0]
+    assert top_subgroup['subgroup'] == 'age_band=80plus, sex=Female, ses=low'
+    assert top_subgroup['order'] == 3
+    assert top_subgroup['observed'] == planted.values[::10].sum()
+    assert top_subgroup['representation_ratio'] < 0.2
+    assert (subgroups_df['representation_ratio'] <= 1).all()
+    # extending the planted subgroup with a fourth field that changes nothing is not reported again
+    cohort_df = cohort_df.assign(is_deceased=pd.Categorical(np.where(np.arange(len(cohort_df)) % 50 == 0, 'Deceased', 'Alive')))
+    subgroups_df = find_underrepresented_subgroups(DiversityCounts.from_frame(cohort_df), max_order=4, min_support=0.001)
+    assert 'age_band=80plus, sex=Female, ses=low' in subgroups_df['subgroup'].tolist()
+    assert not subgroups_df['subgroup'].str.contains('is_deceased=Alive').any()
+
+
+def test_min_support_prunes_small_subgroups_and_nested_fields_are_not_combined(tmp_path):
+    cohort_df = independent_cohort(20000)
+    # race is a grouping of ethnicity, so most of their combinations are empty by definition
+    ethnicity = np.random.default_rng(1).choice(['Indian', 'Chinese', 'Irish', 'British'], len(cohort_df))
+    cohort_df['ethnicity'] = pd.Categorical(ethnicity)
+    cohort_df['race'] = pd.Categorical(np.where(np.isin(ethnicity, ['Indian', 'Chinese']), 'Asian', 'White'))
+    counts = DiversityCounts.from_frame(cohort_df)
+
+    subgroups_df = find_underrepresented_subgroups(counts, max_order=3, min_support=0.05, top=None)
+
+    assert (subgroups_df['expected'] >= 0.05 * len(cohort_df)).all()
+    assert not (subgroups_df['ethnicity'].notna() & subgroups_df['race'].notna()).any()
+    written_df = write_subgroup_report(counts, str(tmp_path), max_order=2)
+    assert (tmp_path / 'diversity_subgroups.csv').exists()
+    assert written_df['order'].eq(2).all()
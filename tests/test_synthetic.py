@@ -0,0 +1,34 @@
+from diversity_analysis_tool.diversity import AssessDiversity
+from diversity_analysis_tool.diversity import transform_nhs_ethnicity
+from diversity_analysis_tool.diversity import transform_nhs_race
+from diversity_analysis_tool.diversity import transform_nhs_sex
+from diversity_analysis_tool.diversity import transform_ses_order
+from diversity_analysis_tool.synthetic import generate_ipums_cohort
+from diversity_analysis_tool.synthetic import generate_nhs_cohort
+
+import pandas as pd
+
+
+def test_generate_nhs_cohort_is_reproducible_and_transformable():
+    cohort_df = generate_nhs_cohort(20000, seed=3)
+
+    pd.testing.assert_frame_equal(cohort_df, generate_nhs_cohort(20000, seed=3))
+    assert 0.1 < cohort_df['ethnicity'].isna().mean() < 0.14
+    assert (cohort_df['ses'].isna() == cohort_df['ses_level'].isna()).all()
+
+    diversity_analyser = AssessDiversity(transform_nhs_ethnicity, transform_nhs_race, transform_nhs_sex,
+                                         transform_ses_order)
+    results_df = diversity_analyser.transform(cohort_df, 5, 'age', 'sex', 'ethnicity', 'race', 'ses',
+                                              'is_deceased')
+    assert len(results_df) == 20000
+    assert results_df['ethnicity'].notna().all()
+    assert list(results_df['ses'].cat.categories) == [f'IMD decile {decile}' for decile in range(1, 11)]
+
+
+def test_generate_ipums_cohort_uses_ipums_codes():
+    cohort_df = generate_ipums_cohort(5000)
+
+    assert list(cohort_df.columns) == ['YEAR', 'SEX', 'AGE', 'RACE', 'EDUC']
+    assert set(cohort_df['SEX']) == {1, 2}
+    assert cohort_df['RACE'].between(1, 9).all()
+    assert cohort_df['EDUC'].between(0, 11).all()